@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+end to end benchmark on synthetic pathology reports; a tab delimited
+instances file (INSTANCES_FILE layout) is generated at the requested scale
+and each stage is timed on its own: pattern compilation, text
+standardization, n-gram creation, vector creation (make_vectors.py),
+vector_to_array, the decoder (with small stand-in models trained on the
+synthetic vectors) and final_output; seconds, throughput and peak resident
+memory per stage are written as json, and two runs can be compared
+usage:
+    python benchmark.py run [--reports 10000] [--tests EGFR ALK] [--output benchmark.json]
+    python benchmark.py generate --reports 1000000 Input/synthetic_reports.txt
+    python benchmark.py compare baseline.json benchmark.json [--threshold 0.1]
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+import numpy as np
+import make_vectors
+
+TRAIN_BATCH = 'BENCHMARK'
+# share of reports without any test keyword (most reports in an extract)
+KEYWORD_FREE = 0.6
+# reports per test whose vectors the stand-in models are trained on,
+# and the number of features the models select
+MODEL_SAMPLE = 5000
+MODEL_FEATURES = 1000
+# relative slowdown (throughput) or memory growth flagged as a regression
+THRESHOLD = 0.1
+STAGES = ['pattern_compilation', 'standardize_text', 'make_ngrams', 'vector_creation', \
+    'vector_to_array', 'decoder', 'final_output']
+# classes of the stand-in models (see result/method_label_mapping.txt)
+MODEL_CLASSES = {'reported': [4, 5], 'insufficient': [3, 0], 'positive': [1, 2], 'method': [0, 2, 3]}
+
+# report text building blocks
+SECTION_HEADERS = ['FINAL DIAGNOSIS:', 'Comment:', 'Clinical History:', 'Addendum', 'Note:', \
+    'Impression:', 'FLOW CYTOMETRY', 'Fluorescence in situ hybridization:']
+WORDS = ('the tumor cells are positive for was were is be can may will generally specimen lung ' + \
+    'adenocarcinoma biopsy right upper lobe margin negative no evidence of malignancy see comment ' + \
+    'mutation detected exon 19 deletion performed on block A1 by PCR immunohistochemistry ' + \
+    'fluorescence in situ hybridization FISH Vysis rearrangement not identified result pending ' + \
+    'TTF-1 Dr. Smith MD 45% 12/03/2014 p.E746_A750del and or').split()
+# (L858R is an EGFR mutation; it counts as a mention of the test)
+TEST_MENTIONS = ['EGFR', 'ALK', 'EGFR', 'ALK', 'EML4-ALK', 'L858R', 'KRAS', 'ROS1', 'PD-L1', 'HER2']
+INSUFFICIENT_PHRASES = ['insufficient tumor for testing', 'technical difficulties', \
+    'cytoprep slides reviewed']
+
+
+def accession_number(rng):
+    '''
+    random accession number (e.g. S14-20513)
+    '''
+    return '{}{:02d}-{}'.format(rng.choice('SPCH'), rng.randint(10, 20), rng.randint(100, 99999))
+
+
+def synthetic_report(rng, keyword_free):
+    '''
+    (accession number, report text) of one synthetic report; sections of
+    sentences with test mentions (unless keyword_free), accession numbers
+    of other reports and occasional insufficient/cytology language
+    '''
+    pathnum = accession_number(rng)
+    mention_rate = 0.0 if keyword_free else rng.choice([0.05, 0.15, 0.4])
+    lines = []
+    for i in range(rng.randint(1, 8)):
+        if rng.random() < 0.4:
+            lines.append(rng.choice(SECTION_HEADERS))
+        sentences = []
+        for j in range(rng.randint(1, 4)):
+            tokens = []
+            for k in range(rng.randint(5, 18)):
+                r = rng.random()
+                if r < mention_rate:
+                    tokens.append(rng.choice(TEST_MENTIONS))
+                elif r < mention_rate + 0.02:
+                    tokens.append(accession_number(rng))
+                else:
+                    tokens.append(rng.choice(WORDS))
+            sentences.append(' '.join(tokens) + rng.choice(['.', '.', ';', ',', ':']))
+        lines.append(' '.join(sentences))
+    if rng.random() < 0.1:
+        lines.append(rng.choice(INSUFFICIENT_PHRASES))
+    if rng.random() < 0.3:
+        lines.append('See also ' + (pathnum if rng.random() < 0.5 else accession_number(rng)))
+    return pathnum, '<newline>'.join(lines)
+
+
+def generate_reports(instances_file, num_reports, seed=0, keyword_free=KEYWORD_FREE):
+    '''
+    write a synthetic instances file with the default make_vectors columns
+    (report id, accession number and text at REPORT_ID_COL, ACC_NUM_COL, TEXT_COL)
+    '''
+    rng = random.Random(seed)
+    num_cols = max(make_vectors.REPORT_ID_COL, make_vectors.ACC_NUM_COL, make_vectors.TEXT_COL) + 1
+    with open(instances_file, 'w') as out:
+        out.write('\t'.join('column_{}'.format(i) for i in range(num_cols)) + '\n')
+        for i in range(num_reports):
+            pathnum, text = synthetic_report(rng, rng.random() < keyword_free)
+            columns = [''] * num_cols
+            columns[make_vectors.REPORT_ID_COL] = 'R{:08d}'.format(i)
+            columns[make_vectors.ACC_NUM_COL] = pathnum
+            columns[make_vectors.TEXT_COL] = text
+            out.write('\t'.join(columns) + '\n')
+
+
+def memory_status(field):
+    '''
+    memory use in MB from /proc/self/status (linux only)
+    '''
+    for line in open('/proc/self/status'):
+        if line.startswith(field + ':'):
+            return int(line.split()[1]) / 1024.0
+
+
+def reset_peak_rss():
+    '''
+    reset the resident set high water mark (linux); False if it can't be
+    reset, in which case peaks are the process wide maximum so far
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    try:
+        return memory_status('VmHWM')
+    except (IOError, OSError):
+        # ru_maxrss is in KB on linux, bytes on mac
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2.0 ** 20 if sys.platform == 'darwin' else 1024.0)
+
+
+class StageTimer(object):
+    '''
+    wall time, number of items and peak resident memory of each stage
+    '''
+    def __init__(self):
+        self.stages = {}
+
+    def start(self, stage):
+        reset_peak_rss()
+        self.current = stage
+        self.begin = time.perf_counter()
+
+    def stop(self, items):
+        seconds = time.perf_counter() - self.begin
+        self.add(self.current, seconds, items)
+
+    def add(self, stage, seconds, items):
+        '''
+        add time and items to a stage (stages can be timed in parts)
+        '''
+        result = self.stages.setdefault(stage, {'seconds': 0.0, 'items': 0, 'peak_rss_mb': 0.0})
+        result['seconds'] += seconds
+        result['items'] += items
+        result['per_second'] = result['items'] / max(result['seconds'], 1e-9)
+        result['peak_rss_mb'] = max(result['peak_rss_mb'], round(peak_rss(), 1))
+
+    def summary(self):
+        for stage in STAGES:
+            if stage in self.stages:
+                result = self.stages[stage]
+                print ('{}: {} items in {:.2f} seconds ({:.1f} per second), {:.1f} MB peak rss'.format(\
+                    stage, result['items'], result['seconds'], result['per_second'], result['peak_rss_mb']))
+
+
+def time_standardization(timer, instances_file, patterns):
+    '''
+    standardize_text (the combined pattern version of make_standardized_text)
+    on every report; returns the number of reports
+    '''
+    timer.start('standardize_text')
+    num_reports = 0
+    for report_id, pathnum, text in make_vectors.read_instances(make_vectors.open_instances(instances_file)):
+        make_vectors.standardize_text(patterns['trees'], text)
+        num_reports += 1
+    timer.stop(num_reports)
+    return num_reports
+
+
+def time_ngrams(timer, instances_file, patterns, test_names):
+    '''
+    make_ngrams alone on the reports that mention each test (the text
+    munging that produces its tokens isn't timed)
+    '''
+    reset_peak_rss()
+    seconds = 0.0
+    num_reports = 0
+    for report_id, pathnum, text in make_vectors.read_instances(make_vectors.open_instances(instances_file)):
+        for test_name in test_names:
+            text_tokens, vector = make_vectors.strip_test_name(\
+                patterns['targets'][test_name]['test_instance'], text, {})
+            text_tokens, vector = make_vectors.add_standardized_features(text_tokens, pathnum, patterns, vector)
+            text_tokens = make_vectors.ngram_tokens(text_tokens)
+            if 'TEST_INSTANCE' in text_tokens:
+                begin = time.perf_counter()
+                make_vectors.make_ngrams(text_tokens, vector, test_name)
+                seconds += time.perf_counter() - begin
+                num_reports += 1
+    timer.add('make_ngrams', seconds, num_reports)
+
+
+def train_models(work_dir, vector_files, seed=0):
+    '''
+    small stand-in models (feature selection -> linear SVM, like the trained
+    pipelines) for each algorithm, trained on the first MODEL_SAMPLE vectors
+    of each test with labels from a random linear score; laid out in
+    work_dir the way svm_pipeline.load_models expects them
+    '''
+    try:
+        import joblib
+    except ImportError:
+        # (sklearn < 0.21 without the standalone package)
+        from sklearn.externals import joblib
+    from sklearn.pipeline import Pipeline
+    from sklearn.feature_selection import SelectKBest, chi2
+    from sklearn.svm import LinearSVC
+    import svm_pipeline
+    rows = []
+    for vector_file in vector_files:
+        with open(vector_file, 'r') as f:
+            for i, lines in enumerate(f):
+                if i >= MODEL_SAMPLE:
+                    break
+                rows.append(lines.rstrip('\n').split('\t')[1::2])
+    counts = {}
+    for features in rows:
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+    for label_file in ['result_label_mapping.txt', 'method_label_mapping.txt']:
+        shutil.copy(label_file, work_dir)
+    for i, (algorithm, label) in enumerate(svm_pipeline.ALGORITHM_ORDER):
+        rng = np.random.RandomState(seed + i)
+        features = sorted(k for k, v in counts.items() if v >= 2)
+        rng.shuffle(features)
+        features = features[:max(50, len(features) * 2 // 3)]
+        os.makedirs(work_dir + os.sep + algorithm)
+        with open(work_dir + os.sep + algorithm + os.sep + TRAIN_BATCH + '_features_mapping.txt', 'w') as out:
+            for j, feature in enumerate(features):
+                out.write('{}\t{}\n'.format(feature, j))
+        with open(work_dir + os.sep + algorithm + os.sep + 'num_features.txt', 'w') as out:
+            out.write(str(len(features)))
+        index = dict((feature, j) for j, feature in enumerate(features))
+        X = np.zeros((len(rows), len(features)))
+        for r, row in enumerate(rows):
+            for feature in row:
+                if feature in index:
+                    X[r, index[feature]] = 1
+        score = X.dot(rng.randn(len(features)))
+        classes = MODEL_CLASSES[algorithm]
+        y = np.array([classes[min(len(classes) - 1, int(s > np.median(score)) + \
+            int(len(classes) > 2 and s > np.percentile(score, 80)))] for s in score])
+        clf = Pipeline([('feature_selection', SelectKBest(chi2, k=min(len(features), MODEL_FEATURES))), \
+            ('classifier', LinearSVC())])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            clf.fit(X, y)
+        joblib.dump(clf, work_dir + os.sep + algorithm + os.sep + TRAIN_BATCH + '.pkl')
+    for d in ['rule_based_reported', 'final_output']:
+        os.makedirs(work_dir + os.sep + d)
+
+
+def time_classification(timer, vector_file, test_name, models):
+    '''
+    vector_to_array and the decoder for each algorithm in cascade order
+    (as svm_pipeline.run_cascade routes the instances), then final_output
+    on the pos/neg instance files of the cascade; run in the model directory
+    '''
+    import decoder
+    import final_output
+    import svm_pipeline
+    import vector_to_array
+    instances = svm_pipeline.read_feature_vectors(vector_file)
+    ids = svm_pipeline.report_ids(instances)
+    labels = {'rule_based_reported': dict((report_id, 'NotReported' if 'NO_KEYWORD_IN_TEXT' in features \
+        else 'Reported') for report_id, features in instances)}
+    for algorithm, label in svm_pipeline.ALGORITHM_ORDER:
+        model = models[algorithm]
+        batch_set = svm_pipeline.batch_instances(algorithm, labels)
+        timer.start('vector_to_array')
+        arrays = [vector_to_array.sparse_array(features, model['feature_mapping']) \
+            for report_id, features in instances if report_id in batch_set]
+        timer.stop(len(arrays))
+        timer.start('decoder')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            output = decoder.classify(model['clf'], arrays, model['num_features'], \
+                model['features'], model['class_map'])
+        timer.stop(len(arrays))
+        rows = [report_id for report_id in ids if report_id in batch_set]
+        labels[algorithm] = dict(zip(rows, output))
+        svm_pipeline.write_instances(algorithm, test_name, labels[algorithm], \
+            decoder.positive_labels(algorithm))
+    timer.start('final_output')
+    counts = final_output.output_final_class_labels(test_name, 'final_output', vector_file)
+    timer.stop(counts['reports'])
+
+
+def run_benchmark(num_reports, test_names, seed=0, work_dir=None, instances_file=None):
+    '''
+    generate the reports (unless an instances file is given) and time
+    each stage; returns the json serializable results
+    '''
+    keep = work_dir is not None
+    work_dir = os.path.abspath(work_dir or tempfile.mkdtemp())
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    repo_dir = os.getcwd()
+    timer = StageTimer()
+    config = {'tests': test_names, 'seed': seed}
+    try:
+        if instances_file is None:
+            instances_file = work_dir + os.sep + 'synthetic_reports.txt'
+            begin = time.perf_counter()
+            generate_reports(instances_file, num_reports, seed)
+            config['generate_seconds'] = round(time.perf_counter() - begin, 3)
+        config['instances_file'] = instances_file
+
+        # built from the json and compiled up front (not lazily, from the bundle), so the
+        # stage times all of the pattern compilation, as it did before lazy compilation
+        timer.start('pattern_compilation')
+        patterns = make_vectors.prepare_patterns(test_names, sources=make_vectors.bundle_sources(\
+            *make_vectors.load_pattern_resources(), test_names=test_names), lazy=False)
+        timer.stop(1)
+        num_reports = time_standardization(timer, instances_file, patterns)
+        config['reports'] = num_reports
+        time_ngrams(timer, instances_file, patterns, test_names)
+        timer.start('vector_creation')
+        make_vectors.vector_creation(instances_file=instances_file, test_names=test_names, \
+            output_dir=work_dir)
+        timer.stop(num_reports)
+
+        vector_files = [make_vectors.vector_file(test_name, work_dir) for test_name in test_names]
+        model_dir = work_dir + os.sep + 'models'
+        os.makedirs(model_dir)
+        train_models(model_dir, vector_files, seed)
+        os.chdir(model_dir)
+        import svm_pipeline
+        models = svm_pipeline.load_models(TRAIN_BATCH)
+        for test_name, vector_file in zip(test_names, vector_files):
+            time_classification(timer, vector_file, test_name, models)
+    finally:
+        os.chdir(repo_dir)
+        if not keep:
+            shutil.rmtree(work_dir)
+    timer.summary()
+    return {'config': config, 'environment': {'python': platform.python_version(), \
+        'platform': platform.platform(), 'cpus': os.cpu_count(), 'numpy': np.__version__}, \
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': timer.stages}
+
+
+def compare_runs(baseline, current, threshold=THRESHOLD):
+    '''
+    print throughput and peak memory per stage of two benchmark results;
+    returns the stages whose throughput dropped (or peak rss grew) by
+    more than threshold
+    '''
+    regressions = []
+    print ('{:<20} {:>14} {:>14} {:>8} {:>10} {:>10} {:>8}'.format('stage', 'baseline/s', 'current/s', \
+        'change', 'base MB', 'cur MB', 'change'))
+    for stage in STAGES:
+        if stage not in baseline['stages'] or stage not in current['stages']:
+            continue
+        old, new = baseline['stages'][stage], current['stages'][stage]
+        speed = new['per_second'] / old['per_second'] - 1 if old['per_second'] else 0.0
+        memory = new['peak_rss_mb'] / old['peak_rss_mb'] - 1 if old['peak_rss_mb'] else 0.0
+        flags = []
+        if speed < -threshold:
+            flags.append('SLOWER')
+        if memory > threshold:
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append(stage)
+        print ('{:<20} {:>14.1f} {:>14.1f} {:>+7.1%} {:>10.1f} {:>10.1f} {:>+7.1%} {}'.format(stage, \
+            old['per_second'], new['per_second'], speed, old['peak_rss_mb'], new['peak_rss_mb'], \
+            memory, ' '.join(flags)))
+    if baseline['config'].get('reports') != current['config'].get('reports'):
+        print ('note: runs over different numbers of reports ({} vs {})'.format(\
+            baseline['config'].get('reports'), current['config'].get('reports')))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='end to end benchmark on synthetic reports')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='generate reports and time each stage')
+    run_parser.add_argument('--reports', type=int, default=10000)
+    run_parser.add_argument('--tests', nargs='+', default=['EGFR', 'ALK'])
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--input', help='existing instances file instead of synthetic reports')
+    run_parser.add_argument('--work-dir', help='keep the reports, vectors and models here')
+    run_parser.add_argument('--output', default='benchmark.json')
+    generate_parser = subparsers.add_parser('generate', help='only write a synthetic instances file')
+    generate_parser.add_argument('instances_file')
+    generate_parser.add_argument('--reports', type=int, default=10000)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    compare_parser = subparsers.add_parser('compare', help='flag regressions between two runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args()
+    if args.command == 'run':
+        results = run_benchmark(args.reports, args.tests, args.seed, args.work_dir, args.input)
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print ('results written to {}'.format(args.output))
+    elif args.command == 'generate':
+        generate_reports(args.instances_file, args.reports, args.seed)
+    elif args.command == 'compare':
+        regressions = compare_runs(json.load(open(args.baseline)), json.load(open(args.current)), \
+            args.threshold)
+        if regressions:
+            print ('regressions: {}'.format(', '.join(regressions)))
+            raise SystemExit(1)
+    else:
+        parser.print_help()
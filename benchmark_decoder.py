@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+micro-benchmark of sparse matrix assembly in the decoder; the original
+element by element dok_matrix fill vs. decoder.make_matrix (csr built
+from indptr/indices arrays) on synthetic sparse arrays
+usage: python benchmark_decoder.py [--instances 1000000] [--features 5000]
+'''
+import argparse
+import itertools
+import random
+import tracemalloc
+from datetime import datetime
+import numpy as np
+from scipy.sparse import dok_matrix
+import decoder
+
+
+def dok_assembly(instances, num_features, feature_d):
+    '''
+    the original decoder matrix assembly
+    '''
+    X = dok_matrix((len(instances), num_features),dtype = np.float64)
+    for index in range(len(instances)):
+        features =  instances[index]
+        for feat in features:
+            if feat in feature_d.keys():
+                X[index,int(feat)]=1
+    X.tocsc()
+    return X
+
+
+def csr_assembly(instances, num_features, feature_d):
+    '''
+    the decoder matrix assembly, one BATCH_SIZE matrix at a time
+    '''
+    for start in range(0, len(instances), decoder.BATCH_SIZE):
+        X = decoder.make_matrix(instances[start:start + decoder.BATCH_SIZE], num_features, feature_d)
+    return X
+
+
+def make_instances(num_instances, num_features, mean_features):
+    '''
+    lists of feature indices (as strings, the way they are read from the
+    sparse arrays) with a skewed feature frequency, like n-gram features
+    '''
+    random.seed(0)
+    cum_weights = list(itertools.accumulate(1.0 / (i + 1) for i in range(num_features)))
+    population = [str(i) for i in range(num_features)]
+    return [random.choices(population, cum_weights=cum_weights, k=random.randint(1, 2 * mean_features)) \
+        for _ in range(num_instances)]
+
+
+def memory_status(field):
+    '''
+    memory use in MB from /proc/self/status (linux only)
+    '''
+    for line in open('/proc/self/status'):
+        if line.startswith(field + ':'):
+            return int(line.split()[1]) / 1024.0
+
+
+def measure(function, instances, num_features, feature_d):
+    '''
+    wall time (seconds) and peak memory above the starting point (MB) of an
+    assembly function; uses the resettable resident set high water mark on
+    linux (no overhead), otherwise tracemalloc (slow for the dok assembly)
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        start = memory_status('VmRSS')
+    except (IOError, OSError):
+        start = None
+        tracemalloc.start()
+    begin = datetime.today()
+    X = function(instances, num_features, feature_d)
+    seconds = (datetime.today() - begin).total_seconds()
+    if start is not None:
+        peak = memory_status('VmHWM') - start
+    else:
+        peak = tracemalloc.get_traced_memory()[1] / 2.0 ** 20
+        tracemalloc.stop()
+    return seconds, peak, X
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark decoder sparse matrix assembly')
+    parser.add_argument('--instances', type=int, default=1000000)
+    parser.add_argument('--features', type=int, default=5000)
+    parser.add_argument('--mean-features', type=int, default=30, \
+        help='average number of features per instance')
+    args = parser.parse_args()
+
+    instances = make_instances(args.instances, args.features, args.mean_features)
+    feature_d = dict((str(i), str(i)) for i in range(args.features))
+    print ('{} instances, {} features'.format(args.instances, args.features))
+    results = {}
+    for name, function in [('dok', dok_assembly), ('csr', csr_assembly)]:
+        seconds, peak, X = measure(function, instances, args.features, feature_d)
+        results[name] = X
+        print ('{}: {:.2f} seconds, {:.1f} MB peak'.format(name, seconds, peak))
+    # the last batch of the csr assembly has to match the same rows of the dok matrix
+    start = (args.instances - 1) // decoder.BATCH_SIZE * decoder.BATCH_SIZE
+    if (results['dok'].tocsr()[start:] != results['csr']).nnz:
+        print ('ERR: matrices differ')
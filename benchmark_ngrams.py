@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+micro-benchmark of n-gram creation; make_ngrams (every window feature)
+vs. make_pruned_ngrams (only the features in the model feature mappings)
+on the standardized tokens of the reports in an instances file
+usage: python benchmark_ngrams.py [instances file] [--test EGFR] [--batch IR_10469] [--vocabulary-size N]
+'''
+import argparse
+import random
+import tracemalloc
+from datetime import datetime
+import make_vectors
+
+# timing runs per function (the fastest one is reported)
+REPEAT = 5
+
+
+def report_tokens(instances_file, test_name, patterns):
+    '''
+    standardized tokens (as make_vector hands them to make_ngrams)
+    of the reports that mention the test
+    '''
+    target = patterns['targets'][test_name]
+    tokens = []
+    for report_id, pathnum, text in make_vectors.read_instances(make_vectors.open_instances(instances_file)):
+        text, vector = make_vectors.strip_test_name(target['test_instance'], text, {})
+        text, vector = make_vectors.add_standardized_features(text, pathnum, patterns, vector)
+        text = make_vectors.ngram_tokens(text)
+        if 'TEST_INSTANCE' in text:
+            tokens.append(text)
+    return tokens
+
+
+def measure(function, tokens):
+    '''
+    seconds per report (best of REPEAT runs), and the average (tracemalloc)
+    peak of the memory allocated while making one report's n-grams, in KB
+    '''
+    seconds = None
+    for i in range(REPEAT):
+        begin = datetime.today()
+        vectors = [function(text, {}) for text in tokens]
+        elapsed = (datetime.today() - begin).total_seconds()
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    peaks = 0
+    tracemalloc.start()
+    for text in tokens:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        function(text, {})
+        peaks += tracemalloc.get_traced_memory()[1] - start
+    tracemalloc.stop()
+    return seconds / len(tokens), peaks / 1024.0 / len(tokens), vectors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark pruned n-gram creation')
+    parser.add_argument('input', nargs='?', default=make_vectors.INSTANCES_FILE)
+    parser.add_argument('--test', default=make_vectors.TEST_NAME)
+    parser.add_argument('--batch', default='IR_10469', help='training batch of the feature mappings')
+    parser.add_argument('--vocabulary-size', type=int, \
+        help='random sample of the model vocabulary (e.g. the features a smaller model selected)')
+    args = parser.parse_args()
+
+    patterns = make_vectors.prepare_patterns([args.test])
+    vocabulary = make_vectors.load_model_vocabulary(args.batch)
+    if args.vocabulary_size:
+        random.seed(0)
+        vocabulary = set(random.sample(sorted(vocabulary), args.vocabulary_size)).union(\
+            make_vectors.PIPELINE_FEATURES)
+    ngram_vocabulary = make_vectors.make_ngram_vocabulary(vocabulary)
+    tokens = report_tokens(args.input, args.test, patterns)
+    print ('{} reports mention {}, {} features in the model vocabulary'.format(\
+        len(tokens), args.test, len(vocabulary)))
+
+    windows = lambda text, vector: [w for w in make_vectors.test_instance_windows(text)]
+    print ('test instance windows (part of both): {:.3f} ms per report'.format(\
+        measure(windows, tokens)[0] * 1000))
+    full = lambda text, vector: make_vectors.make_ngrams(text, vector, args.test)
+    pruned = lambda text, vector: make_vectors.make_pruned_ngrams(text, vector, args.test, ngram_vocabulary)
+    results = {}
+    for name, function in [('all n-grams', full), ('pruned', pruned)]:
+        seconds, kilobytes, vectors = measure(function, tokens)
+        results[name] = vectors
+        print ('{}: {:.3f} ms and {:.1f} KB allocated per report, {:.1f} features per report'.format(\
+            name, seconds * 1000, kilobytes, sum(len(v) for v in vectors) / float(len(vectors))))
+    # the pruned n-grams have to be the model features of the full n-grams, in the same order
+    mismatches = sum(1 for expected, observed in zip(results['all n-grams'], results['pruned']) \
+        if list(make_vectors.prune_vector(expected, vocabulary).items()) != list(observed.items()))
+    if mismatches:
+        print ('ERR: {} reports differ'.format(mismatches))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+start up benchmark; time to the first classified report in a fresh python
+process (imports, patterns, models and one report through vector creation
+and the cascade), with the pattern bundle (see pattern_bundle.py), with
+the patterns built from the json resources, and with the patterns built
+from the json resources and compiled up front ("eager", the start up
+before lazy pattern compilation)
+every run is a new process; the median of the runs is reported
+usage: python benchmark_startup.py [instances file] [--test EGFR] [--batch IR_10469] [--runs 5] [--output startup.json]
+'''
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# processes per mode
+RUNS = 5
+STEPS = ['imports', 'patterns', 'models', 'first report']
+MODES = ['bundle', 'json', 'eager']
+
+
+def first_report(instances_file, test_name, train_batch, mode):
+    '''
+    (in the child process) seconds of each start up step, the label of the
+    first report and whether sklearn had to be imported, printed as json
+    '''
+    seconds = {}
+    begin = time.perf_counter()
+    import make_vectors
+    import pattern_bundle
+    import svm_pipeline
+    import final_output
+    seconds['imports'] = time.perf_counter() - begin
+    if mode != 'bundle':
+        pattern_bundle.BUNDLE_FILE = None
+    begin = time.perf_counter()
+    patterns = make_vectors.prepare_patterns([test_name], lazy=mode != 'eager')
+    seconds['patterns'] = time.perf_counter() - begin
+    begin = time.perf_counter()
+    models = svm_pipeline.load_models(train_batch)
+    seconds['models'] = time.perf_counter() - begin
+    begin = time.perf_counter()
+    report = next(make_vectors.read_instances(make_vectors.open_instances(instances_file)))
+    report_id, test_results = make_vectors.vectorize(report, patterns)
+    instances = [(report_id, list(test_results[0][0].keys()))]
+    labels = svm_pipeline.run_cascade(instances, test_name, train_batch, models=models, verbose=False)
+    label = final_output.final_label(dict(svm_pipeline.final_report_labels([report_id], labels))[report_id])
+    seconds['first report'] = time.perf_counter() - begin
+    print (json.dumps({'seconds': seconds, 'label': label, 'sklearn': 'sklearn' in sys.modules, \
+        'bundle': pattern_bundle.load_bundle(make_vectors.RESOURCE_DIR) is not None}))
+
+
+def measure(instances_file, test_name, train_batch, mode):
+    '''
+    run first_report in a new process; the step times plus the wall time
+    from starting the process to its result (interpreter start up included)
+    '''
+    begin = time.perf_counter()
+    child = subprocess.Popen([sys.executable, __file__, instances_file, '--test', test_name, \
+        '--batch', train_batch, '--child', mode], stdout=subprocess.PIPE, universal_newlines=True)
+    result = None
+    for line in child.stdout:
+        if line.startswith('{"seconds"'):
+            result = json.loads(line)
+            result['seconds']['total'] = time.perf_counter() - begin
+    if child.wait() != 0 or result is None:
+        raise RuntimeError('start up run ({}) failed'.format(mode))
+    return result
+
+
+def benchmark(instances_file, test_name, train_batch, runs=RUNS):
+    '''
+    median seconds per step (and in total) of each mode
+    '''
+    results = {}
+    for mode in MODES:
+        measured = [measure(instances_file, test_name, train_batch, mode) for run in range(runs)]
+        results[mode] = {'seconds': dict((step, round(statistics.median(m['seconds'][step] \
+            for m in measured), 4)) for step in STEPS + ['total']), 'label': measured[0]['label'], \
+            'sklearn': measured[0]['sklearn'], 'bundle': measured[0]['bundle']}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time to the first classified report')
+    parser.add_argument('input', nargs='?', default='Input/IR 10469_Path_Text_2020-06-29.txt')
+    parser.add_argument('--test', default='EGFR')
+    parser.add_argument('--batch', default='IR_10469', help='training batch of the models')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        first_report(args.input, args.test, args.batch, args.child)
+        sys.exit(0)
+    results = benchmark(args.input, args.test, args.batch, args.runs)
+    for mode in MODES:
+        print ('{:7} {} (first report labeled {}; sklearn {}imported{})'.format(mode, \
+            ', '.join('{} {:.3f} s'.format(step, results[mode]['seconds'][step]) for step in STEPS + ['total']), \
+            results[mode]['label'], '' if results[mode]['sklearn'] else 'not ', \
+            '' if mode != 'bundle' or results[mode]['bundle'] else '; no up to date bundle, run pattern_bundle.py build'))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+equivalence harness for the optimized vector creation code paths;
+runs the original implementation next to the optimized one over a corpus
+(and synthetic reports) and reports any report where the outputs differ
+usage: python check_equivalence.py [instances file]
+'''
+from datetime import datetime
+import itertools
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import final_output
+import make_vectors
+
+# synthetic token lists for the test instance window check
+NUM_SYNTHETIC_REPORTS = 50
+SYNTHETIC_REPORT_TOKENS = 5000
+SYNTHETIC_TOKENS = ['TEST_INSTANCE', '_SECTION_', 'PUNCTUATION', 'SPECIMEN_LABEL', 'OTHER_TEST', \
+    'COMMENT', 'RESULT', 'NEGATIVE', 'POSITIVE', 'MUT_ANALYSIS', 'FISH', 'DATE', 'NO', 'MUTATION']
+# synthetic reports citing prior accession numbers for the accession check
+NUM_ACC_REPORTS = 200
+MAX_CITED_ACCS = 60
+ACC_FILLER = ['see prior', 'compare with', 'as in', 'block', 'per', 'and', '(see', 'case', 'M', 'UM']
+ACC_SENTENCE = 'EGFR mutation analysis was performed on the tumor and no mutation was detected in exons 18-21.'
+# synthetic stage labels and input order file for the final output check
+NUM_LABELED_REPORTS = 60
+NUM_REPEATED_IDS = 15
+FINAL_OUTPUT_CHUNK = 7
+# (report id, accession, text) edge cases added to the corpus of the standardization check;
+# insufficient language that only get_insufficient matches once standardized
+EDGE_REPORTS = [('edge-insufficient-newline', '', 'Specimen quantity insufficient\nWould recommend repeat biopsy.'), \
+    ('edge-insufficient-comma', '', 'Specimen quantity insufficient,may need repeat biopsy.')]
+
+
+def check_standardization(instances_file):
+    '''
+    compare the TEST_INSTANCE/OTHER_TEST/section standardized text from the
+    per pattern make_standardized_text loop and the combined pattern engine,
+    and the feature vector of every report (including the EDGE_REPORTS) from
+    make_test_vectors with the full make_vector one, which reports without
+    a test mention skip
+    '''
+    test_patterns, other_patterns, section_patterns = make_vectors.load_pattern_resources()
+    compiled_test_patterns = make_vectors.compile_patterns(test_patterns, True, '[\W\^]', '[\W$]')
+    compiled_other_patterns = make_vectors.compile_patterns(other_patterns, False, '[\W\^]', '[\W$]')
+    compiled_section_patterns = make_vectors.compile_patterns(section_patterns, True, '^', '$')
+    pattern_trees = make_vectors.make_pattern_trees(test_patterns, other_patterns, section_patterns)
+    patterns = make_vectors.prepare_patterns([make_vectors.TEST_NAME])
+
+    num_reports = 0
+    mismatches = []
+    vector_mismatches = []
+    loop_time = engine_time = 0.0
+    for report_id, pathnum, text in itertools.chain(make_vectors.read_instances(\
+        make_vectors.open_instances(instances_file)), EDGE_REPORTS):
+        num_reports += 1
+        if make_vectors.make_test_vectors(text, pathnum, patterns)[0][0] != make_vectors.make_vector(\
+            text, pathnum, patterns, make_vectors.TEST_NAME, int(make_vectors.get_cyto(text))):
+            vector_mismatches.append(report_id)
+        text, vector = make_vectors.strip_test_name(\
+            compiled_test_patterns[make_vectors.TEST_NAME], text, {})
+        begin = datetime.today()
+        expected = make_vectors.make_standardized_text(compiled_test_patterns, text, \
+            compiled_other_patterns, num_reports, compiled_section_patterns)
+        loop_time += (datetime.today() - begin).total_seconds()
+        begin = datetime.today()
+        observed = make_vectors.standardize_text(pattern_trees, text)
+        engine_time += (datetime.today() - begin).total_seconds()
+        if observed != expected:
+            mismatches.append(report_id)
+
+    print ('{} reports compared, {} mismatches'.format(num_reports, len(mismatches)))
+    for report_id in mismatches:
+        print ('MISMATCH {}'.format(report_id))
+    print ('per pattern loop {:.2f} seconds, combined engine {:.2f} seconds'.format(\
+        loop_time, engine_time))
+    print ('{} feature vector mismatches against the full vector creation path'.format(len(vector_mismatches)))
+    for report_id in vector_mismatches:
+        print ('VECTOR MISMATCH {}'.format(report_id))
+    return not mismatches and not vector_mismatches
+
+
+def original_test_instance_windows(text):
+    '''
+    the original per mention window and section search of make_ngrams
+    (rescans the text before each test instance)
+    '''
+    for v in range(len(text)):
+        current = text[v]
+        if current == 'TEST_INSTANCE':
+            section = None
+            try:
+                ## find the first and closest second section to the test instance
+                reversed_snippet = [text[b] for b in range(v-1, -1, -1)]
+                if '_SECTION_' in reversed_snippet:
+                    section = reversed_snippet[reversed_snippet.index('_SECTION_') - 1]
+            except IndexError:
+                pass
+            pre_window_index = max(v - make_vectors.PRE_WINDOW,0)
+            post_window_index = min(len(text), v + make_vectors.POST_WINDOW)
+            window = text[pre_window_index:post_window_index]
+            breaks = [i for i in range(len(window)) if \
+            (window[i] == "_SECTION_" or window[i] == "PUNCTUATION" \
+             or  window[i] == "SPECIMEN_LABEL" or window[i] == "OTHER_TEST")]
+            breaks.append(0)
+            pre_break = max([x + 1 for x in breaks if x < len(window)/ 2])
+            breaks[-1] = len(window)
+            post_break = min([x for x in breaks if x > len(window)/ 2])
+            post_window_index = post_break + pre_window_index
+            pre_window_index = pre_break + pre_window_index
+            yield v, section, pre_window_index, post_window_index
+
+
+def synthetic_reports():
+    '''
+    token lists with hundreds of test instances (and breaks right next to
+    them) plus short edge cases: sections right before a mention, mentions
+    at the start and end of the text, and no sections at all
+    '''
+    random.seed(0)
+    reports = [['TEST_INSTANCE'], ['_SECTION_', 'TEST_INSTANCE'], ['TEST_INSTANCE', '_SECTION_'], \
+        ['COMMENT', '_SECTION_', 'TEST_INSTANCE', 'NEGATIVE'], ['TEST_INSTANCE', 'TEST_INSTANCE'], \
+        ['NEGATIVE', 'TEST_INSTANCE', 'PUNCTUATION', 'TEST_INSTANCE', 'OTHER_TEST'], []]
+    for i in range(NUM_SYNTHETIC_REPORTS):
+        reports.append([random.choice(SYNTHETIC_TOKENS) for j in range(random.randint(1, SYNTHETIC_REPORT_TOKENS))])
+    return reports
+
+
+def check_windows():
+    '''
+    compare the test instance windows (and so the n-gram features)
+    of the original search and make_vectors.test_instance_windows
+    '''
+    reports = synthetic_reports()
+    mismatches = 0
+    original_time = index_time = 0.0
+    for text in reports:
+        begin = datetime.today()
+        expected = list(original_test_instance_windows(text))
+        original_time += (datetime.today() - begin).total_seconds()
+        begin = datetime.today()
+        observed = list(make_vectors.test_instance_windows(text))
+        index_time += (datetime.today() - begin).total_seconds()
+        if observed != expected or make_vectors.make_ngrams(text, {}, 'TEST') != \
+            original_ngrams(text, 'TEST'):
+            mismatches += 1
+    print ('{} synthetic reports ({} test instances) compared, {} mismatches'.format(len(reports), \
+        sum(text.count('TEST_INSTANCE') for text in reports), mismatches))
+    print ('original window search {:.2f} seconds, window index {:.2f} seconds'.format(\
+        original_time, index_time))
+    return not mismatches
+
+
+def original_get_other_acc_num(text, pathnum):
+    '''
+    the original accession number search (one substitution over the
+    whole text per accession number found)
+    '''
+    other_acc_bool = False
+    pathnum = pathnum.replace('-', '')
+    for acc in re.finditer('[\W]([\(]?[A-Z]{1,2}[\- ]?[\d]{2,4}[\- ]{1,3}[\d]{2,8}[\)]?)[\W]', text):
+        current_acc = re.sub('[\- ]', '', acc.group(1))
+        if current_acc == pathnum:
+            text = re.sub(re.sub('[\(\)]', '' ,acc.group(1)), ' THIS_ACC_NUM ', text)
+        else:
+            text = re.sub(re.sub('[\(\)]', '', acc.group(1)), ' OTHER_ACC_NUM ', text)
+            other_acc_bool = True
+    return other_acc_bool, text
+
+
+def synthetic_acc_reports():
+    '''
+    (text, accession number) of reports that cite up to MAX_CITED_ACCS
+    accession numbers; repeated and parenthesized numbers, the report's own
+    number, and (in some reports) numbers that overlap each other
+    (S12-345 and AS12-3456) or the replacements
+    '''
+    random.seed(1)
+    reports = []
+    for i in range(NUM_ACC_REPORTS):
+        pathnum = 'S{}-{}'.format(random.randint(10, 99), random.randint(100, 99999))
+        cited = [pathnum]
+        overlapping = random.random() < 0.2
+        for j in range(random.randint(0, MAX_CITED_ACCS)):
+            # M and UM numbers can run into the replacements (... OTHER_ACC_NUM 12-345)
+            number = '{}{}{}{}{}'.format(random.choice(['S', 'AS', 'SP'] + (['M', 'UM'] if overlapping else [])), \
+                random.choice(['', '-', ' ']), random.randint(10, 9999), random.choice(['-', ' ', ' - ']), \
+                random.randint(10, 99999999))
+            cited.append(number)
+            if overlapping and random.random() < 0.1:
+                # a number inside a longer one
+                cited.append('A' + number + str(random.randint(0, 9)))
+        words = []
+        for j in range(len(cited) * 3):
+            number = random.choice(cited)
+            words.append(random.choice(ACC_FILLER))
+            words.append('(' + number + ')' if random.random() < 0.2 else number)
+            words.append(ACC_SENTENCE)
+        reports.append((' '.join(words) + '.', pathnum))
+    return reports
+
+
+def check_acc_nums(instances_file):
+    '''
+    compare the original accession number search and
+    make_vectors.get_other_acc_num on synthetic and corpus reports
+    '''
+    reports = synthetic_acc_reports()
+    reports.extend((text, pathnum) for report_id, pathnum, text in make_vectors.read_instances(\
+        make_vectors.open_instances(instances_file)))
+    mismatches = 0
+    original_time = single_pass_time = 0.0
+    for text, pathnum in reports:
+        begin = datetime.today()
+        expected = original_get_other_acc_num(text, pathnum)
+        original_time += (datetime.today() - begin).total_seconds()
+        begin = datetime.today()
+        observed = make_vectors.get_other_acc_num(text, pathnum)
+        single_pass_time += (datetime.today() - begin).total_seconds()
+        if observed != expected:
+            mismatches += 1
+    print ('{} reports ({} synthetic) compared for accession numbers, {} mismatches'.format(\
+        len(reports), NUM_ACC_REPORTS, mismatches))
+    print ('original accession search {:.2f} seconds, single pass {:.2f} seconds'.format(\
+        original_time, single_pass_time))
+    return not mismatches
+
+
+def original_final_labels(test_name):
+    '''
+    the original final_output aggregation; {report id: final label} from
+    the insufficient, positive, and method pos/neg instance files
+    '''
+    report_label_dict = {}
+    for algorithm in ['insufficient','positive','method']:
+        system_labels = [x.strip().split('\t') for x in open(algorithm + \
+            os.sep + test_name + '_pos_instances.txt','r').readlines()] + \
+            [y.strip().split('\t') for y in open(algorithm + os.sep + \
+             test_name + '_neg_instances.txt','r').readlines()]
+        for each in system_labels:
+            report_id = each[0]
+            report_label_dict[report_id] = report_label_dict.get(report_id, {})
+            report_label_dict[report_id][algorithm] = each[1]
+    return dict((report_id, final_output.final_label(algorithm_labels)) for report_id, algorithm_labels \
+        in report_label_dict.items())
+
+
+def write_synthetic_labels(test_name):
+    '''
+    pos/neg instance files of NUM_LABELED_REPORTS reports (in the current
+    directory) and an input order file of most of them, shuffled, with
+    NUM_REPEATED_IDS report ids repeated and an id without labels
+    '''
+    random.seed(2)
+    report_ids = [str(i) for i in range(NUM_LABELED_REPORTS)]
+    stages = dict((algorithm, {'pos': [], 'neg': []}) for algorithm in final_output.ALGORITHMS)
+    for report_id in report_ids:
+        if random.random() < 0.5:
+            stages['insufficient'][random.choice(['pos', 'neg'])].append((report_id, \
+                random.choice(['Insufficient', 'Unknown'])))
+        else:
+            stages['positive'][random.choice(['pos', 'neg'])].append((report_id, \
+                random.choice(['Positive', 'Negative'])))
+            stages['method'][random.choice(['pos', 'neg'])].append((report_id, \
+                random.choice(['FISH', 'MutationalAnalysis', 'Other'])))
+    for algorithm, files in stages.items():
+        os.makedirs(algorithm)
+        for kind, labels in files.items():
+            random.shuffle(labels)
+            with open(algorithm + os.sep + test_name + '_' + kind + '_instances.txt', 'w') as out:
+                out.writelines(report_id + '\t' + label + '\n' for report_id, label in labels)
+    order = report_ids[:-5] + ['unlabeled']
+    random.shuffle(order)
+    for report_id in random.sample(order, NUM_REPEATED_IDS):
+        order.insert(random.randint(0, len(order)), report_id)
+    with open('input_order.txt', 'w') as out:
+        out.writelines(report_id + '\tfeature\n' for report_id in order)
+    return order
+
+
+def check_final_output():
+    '''
+    compare the merge joined final_output, in input order with repeated
+    report ids in the input order file (and sorted in runs of
+    FINAL_OUTPUT_CHUNK lines), with the original aggregation: one line per
+    labeled report, at the first occurrence of its id in the input order
+    and the reports missing from it last, in report id order
+    '''
+    test_name = make_vectors.TEST_NAME
+    directory = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp_dir)
+        order = write_synthetic_labels(test_name)
+        labels = original_final_labels(test_name)
+        ordered = [report_id for i, report_id in enumerate(order) if report_id in labels \
+            and report_id not in order[:i]]
+        expected = [(report_id, labels[report_id]) for report_id in ordered] + \
+            sorted((report_id, label) for report_id, label in labels.items() if report_id not in order)
+        final_output.output_final_class_labels(test_name, '.', 'input_order.txt', FINAL_OUTPUT_CHUNK)
+        observed = [tuple(line.rstrip('\n').split('\t')) for line in open(test_name + '_final_output.txt')]
+    finally:
+        os.chdir(directory)
+        shutil.rmtree(tmp_dir)
+    mismatches = sum(1 for o, e in itertools.zip_longest(observed, expected) if o != e)
+    print ('{} final output lines compared ({} repeated report ids in the input order), {} mismatches'.format(\
+        len(expected), NUM_REPEATED_IDS, mismatches))
+    return not mismatches
+
+
+def original_ngrams(text, test_name):
+    '''
+    make_ngrams features with the windows of the original search
+    '''
+    windows = make_vectors.test_instance_windows
+    make_vectors.test_instance_windows = original_test_instance_windows
+    try:
+        return make_vectors.make_ngrams(text, {}, test_name)
+    finally:
+        make_vectors.test_instance_windows = windows
+
+
+if __name__ == '__main__':
+    INSTANCES_FILE = sys.argv[1] if len(sys.argv) > 1 else make_vectors.INSTANCES_FILE
+    passed = check_windows()
+    passed = check_acc_nums(INSTANCES_FILE) and passed
+    passed = check_final_output() and passed
+    if not check_standardization(INSTANCES_FILE) or not passed:
+        sys.exit(1)
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+long running classification service; the patterns and the four models are
+loaded once and reports are classified as they come in over a local HTTP
+(or unix) socket, returning the same label as final_output.py
+requests that arrive together are classified in one batch
+usage:
+    python classify_service.py serve [--port 8642 | --socket /tmp/classify.sock] [--tests EGFR ALK]
+    python classify_service.py client --input <instances file> [--test EGFR] [--batch-size 1]
+
+    POST /classify {"test": "EGFR", "reports": [{"report_id": "1", "accession": "...", "text": "..."}]}
+        -> {"labels": [{"report_id": "1", "label": "Negative by MutationalAnalysis"}]}
+    GET /stats -> number of requests, reports, batches and p50/p99 latency (ms)
+'''
+import argparse
+import collections
+import http.client
+import http.server
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import make_vectors
+import svm_pipeline
+import final_output
+
+
+HOST = '127.0.0.1'
+PORT = 8642
+# most reports classified together, and how long (seconds) the first
+# request of a batch waits for others to arrive
+MAX_BATCH = 64
+BATCH_WAIT = 0.005
+# number of most recent request latencies the percentiles are computed over
+LATENCY_WINDOW = 10000
+
+
+class ClassificationService(object):
+    '''
+    warm patterns and models, and a batching thread that classifies
+    the reports of queued requests together
+    '''
+    def __init__(self, test_names=None, train_batch=None):
+        self.test_names = test_names or svm_pipeline.TEST_NAMES
+        self.train_batch = train_batch or svm_pipeline.TRAIN_BATCH
+        patterns = make_vectors.prepare_patterns(self.test_names)
+        # per test, so a request only vectorizes its own test (the trees are shared)
+        self.patterns = dict((test_name, dict(patterns, targets={test_name: patterns['targets'][test_name]})) \
+            for test_name in self.test_names)
+        self.models = svm_pipeline.load_models(self.train_batch)
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.counts = {'requests': 0, 'reports': 0, 'batches': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        batcher = threading.Thread(target=self.run_batches)
+        batcher.daemon = True
+        batcher.start()
+
+    def classify(self, reports, test_name):
+        '''
+        final label for each (accession, text) pair; the reports are
+        vectorized and run through the cascade in memory
+        '''
+        instances = []
+        for i, (pathnum, text) in enumerate(reports):
+            vector, path = make_vectors.make_test_vectors(make_vectors.clean_text(text), \
+                pathnum, self.patterns[test_name])[0]
+            # batch positions as ids; report ids from different requests may collide
+            instances.append((str(i), list(vector.keys())))
+        labels = svm_pipeline.run_cascade(instances, test_name, self.train_batch, \
+            models=self.models, verbose=False)
+        report_labels = dict(svm_pipeline.final_report_labels(svm_pipeline.report_ids(instances), labels))
+        return [final_output.final_label(report_labels[report_id]) for report_id, features in instances]
+
+    def submit(self, reports, test_name):
+        '''
+        queue a request and wait for its labels
+        '''
+        if test_name not in self.test_names:
+            raise ValueError('test {} is not served (one of {})'.format(test_name, ', '.join(self.test_names)))
+        request = {'test': test_name, 'reports': reports, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['labels']
+
+    def run_batches(self):
+        '''
+        take the next request, gather the requests that arrive within
+        BATCH_WAIT (up to MAX_BATCH reports) and classify them per test
+        '''
+        while True:
+            batch = [self.requests.get()]
+            num_reports = len(batch[0]['reports'])
+            deadline = time.perf_counter() + BATCH_WAIT
+            while num_reports < MAX_BATCH:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_reports += len(request['reports'])
+            for test_name in self.test_names:
+                test_batch = [request for request in batch if request['test'] == test_name]
+                if test_batch:
+                    self.classify_batch(test_batch, test_name)
+            with self.lock:
+                self.counts['batches'] += 1
+
+    def classify_batch(self, batch, test_name):
+        '''
+        classify the reports of several requests for one test together
+        '''
+        try:
+            labels = self.classify([report for request in batch for report in request['reports']], test_name)
+        except Exception as e:
+            for request in batch:
+                request['error'] = e
+                request['done'].set()
+            return
+        start = 0
+        for request in batch:
+            request['labels'] = labels[start:start + len(request['reports'])]
+            start += len(request['reports'])
+            request['done'].set()
+
+    def record(self, seconds, num_reports, error=False):
+        '''
+        keep the latency of a request for the percentiles
+        '''
+        with self.lock:
+            self.latencies.append(seconds)
+            self.counts['requests'] += 1
+            self.counts['reports'] += num_reports
+            self.counts['errors'] += int(error)
+
+    def stats(self):
+        '''
+        request counts and p50/p99 latency (ms) over the last LATENCY_WINDOW requests
+        '''
+        with self.lock:
+            stats = dict(self.counts)
+            latencies = list(self.latencies)
+        stats['tests'] = self.test_names
+        stats.update(latency_percentiles(latencies))
+        return stats
+
+
+def latency_percentiles(latencies):
+    '''
+    p50 and p99 (in milliseconds) of a list of latencies in seconds
+    '''
+    if not latencies:
+        return {'p50_ms': None, 'p99_ms': None}
+    latencies = sorted(latencies)
+    return dict(('p{}_ms'.format(p), round(latencies[min(len(latencies) - 1, \
+        int(len(latencies) * p / 100.0))] * 1000, 3)) for p in (50, 99))
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    POST /classify and GET /stats
+    '''
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.respond(404, {'error': 'unknown path {}'.format(self.path)})
+        self.respond(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/classify':
+            return self.respond(404, {'error': 'unknown path {}'.format(self.path)})
+        begin = time.perf_counter()
+        service = self.server.service
+        reports = []
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            reports = request['reports'] if 'reports' in request else [request]
+            test_name = request.get('test', service.test_names[0])
+            labels = service.submit([(report.get('accession', ''), report['text']) for report in reports], \
+                test_name)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            service.record(time.perf_counter() - begin, len(reports), error=True)
+            return self.respond(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+        except Exception as e:
+            service.record(time.perf_counter() - begin, len(reports), error=True)
+            return self.respond(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        service.record(time.perf_counter() - begin, len(reports))
+        self.respond(200, {'labels': [{'report_id': report.get('report_id'), 'label': label} \
+            for report, label in zip(reports, labels)]})
+
+    def respond(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # per request logging would dominate the latency of single reports
+        pass
+
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # unix sockets have no client address; the handler expects a (host, port)
+        request, client_address = self.socket.accept()
+        return request, ('local', 0)
+
+
+def serve(service, port=PORT, socket_path=None):
+    '''
+    serve requests until interrupted, on a unix socket if socket_path
+    is given, otherwise on HOST:port
+    '''
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixServer(socket_path, ServiceHandler)
+        address = socket_path
+    else:
+        server = TCPServer((HOST, port), ServiceHandler)
+        address = 'http://{}:{}'.format(HOST, port)
+    server.service = service
+    print ('serving {} on {}'.format(', '.join(service.test_names), address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''
+    HTTP connection over a unix socket
+    '''
+    def __init__(self, socket_path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient(object):
+    '''
+    local client for the service; keeps one connection open
+    '''
+    def __init__(self, port=PORT, socket_path=None):
+        if socket_path:
+            self.connection = UnixHTTPConnection(socket_path)
+        else:
+            self.connection = http.client.HTTPConnection(HOST, port)
+
+    def request(self, method, path, body=None):
+        self.connection.request(method, path, body=body and json.dumps(body), \
+            headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status != 200:
+            raise RuntimeError('{} {}'.format(response.status, result.get('error')))
+        return result
+
+    def classify(self, reports, test_name):
+        '''
+        labels for a list of (report id, accession, text)
+        '''
+        return self.request('POST', '/classify', {'test': test_name, 'reports': \
+            [{'report_id': report_id, 'accession': pathnum, 'text': text} \
+            for report_id, pathnum, text in reports]})['labels']
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+
+def run_client(client, instances_file, test_name, batch_size, output_file=None):
+    '''
+    send the reports of an instances file to the service, batch_size
+    reports per request, and print the client side latency percentiles;
+    labels are written like final_output.py's <TEST>_final_output.txt
+    '''
+    instances = make_vectors.read_instances(make_vectors.open_instances(instances_file))
+    latencies = []
+    out = open(output_file, 'w') if output_file else None
+    try:
+        while True:
+            reports = [(report_id, pathnum, text) for report_id, pathnum, text in \
+                itertools.islice(instances, batch_size)]
+            if not reports:
+                break
+            begin = time.perf_counter()
+            labels = client.classify(reports, test_name)
+            latencies.append(time.perf_counter() - begin)
+            if out:
+                for result in labels:
+                    out.write(result['report_id'] + '\t' + result['label'] + '\n')
+    finally:
+        if out:
+            out.close()
+    print ('client: {} requests {}'.format(len(latencies), latency_percentiles(latencies)))
+    print ('service: {}'.format(client.stats()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EGFR/ALK classification service')
+    parser.add_argument('command', choices=['serve', 'client'])
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--socket', help='unix socket path (instead of a TCP port)')
+    parser.add_argument('--tests', nargs='+', default=svm_pipeline.TEST_NAMES, help='tests to serve')
+    parser.add_argument('--input', default=make_vectors.INSTANCES_FILE, help='client: instances file')
+    parser.add_argument('--test', default=svm_pipeline.TEST_NAME, help='client: test to classify')
+    parser.add_argument('--batch-size', type=int, default=1, help='client: reports per request')
+    parser.add_argument('--output', help='client: file to write the labels to')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(ClassificationService(args.tests), args.port, args.socket)
+    else:
+        run_client(ServiceClient(args.port, args.socket), args.input, args.test, args.batch_size, args.output)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+combined regex engine for text standardization
+
+each pattern category (tests, sections, other keywords) is merged into a tree
+of combined alternations; every pattern is one (non-capturing) alternative in
+the alternation of each of its ancestors, and the leaves hold the compiled
+pattern and its standardization
+a whole subtree is skipped with one scan when none of its patterns match the
+current text, otherwise the patterns are applied in their original order,
+so the output is identical to running every re.sub in turn
+'''
+import re
+
+# number of children per combined node; wider trees are cheaper to compile
+# and shallower to descend, narrower trees scan less text per hit
+BRANCHING = 8
+
+
+def build_pattern_tree(pattern_dictionary, uppercase_boolean, cushion1, cushion2, standardization=None, \
+    lazy=False):
+    '''
+    flatten a pattern dictionary into (pattern, replacement) leaves in the same
+    order that make_vectors.compile_patterns uses, then nest them in combined
+    alternations that share the "cushions" around the primary capture group
+    standardization overrides the dictionary key as the replacement text
+    (e.g. every test name becomes OTHER_TEST)
+    lazy compiles each pattern the first time it is used (see LazyPattern)
+    '''
+    return compile_tree(tree_sources(pattern_dictionary, uppercase_boolean, cushion1, cushion2, \
+        standardization), lazy)
+
+
+def tree_sources(pattern_dictionary, uppercase_boolean, cushion1, cushion2, standardization=None):
+    '''
+    the pattern tree of build_pattern_tree as regex sources; nested
+    [pattern, replacement, None] and [combined pattern, [children], first
+    leaf index] lists, which can be saved as json (see pattern_bundle.py)
+    '''
+    leaves = []
+    for key, val in pattern_dictionary.items():
+        k = key.replace('<newline>', '\n')
+        replacement = ' ' + (standardization or k) + ' '
+        for each in val:
+            leaves.append(('(' + each + ')', replacement))
+            if uppercase_boolean:
+                leaves.append(('(' + each.upper() + ')', replacement))
+    return _make_node(leaves, 0, len(leaves), cushion1, cushion2)
+
+
+def _make_node(leaves, start, end, cushion1, cushion2):
+    '''
+    sources of a single pattern, or of the alternation over leaves start..end
+    and its children
+    '''
+    if end - start == 1:
+        pattern, replacement = leaves[start]
+        return [cushion1 + pattern + cushion2, replacement, None]
+    combined = cushion1 + '(?:' + '|'.join(non_capturing(leaves[i][0]) \
+        for i in range(start, end)) + ')' + cushion2
+    step = max(1, -(-(end - start) // BRANCHING))
+    children = [_make_node(leaves, i, min(i + step, end), cushion1, cushion2) \
+        for i in range(start, end, step)]
+    return [combined, children, start]
+
+
+def compile_tree(sources, lazy=False):
+    '''
+    nodes are (compiled pattern, replacement, None) for single patterns and
+    (combined pattern, [children], first leaf index) for alternations
+    '''
+    source, children, first = sources
+    pattern = LazyPattern(source, re.MULTILINE) if lazy else re.compile(source, re.MULTILINE)
+    if first is None:
+        return (pattern, children, None)
+    return (pattern, [compile_tree(child, lazy) for child in children], first)
+
+
+class LazyPattern(object):
+    '''
+    regex compiled the first time it is used; the methods of the compiled
+    pattern then take the place of the ones below on the instance, so later
+    calls go straight to it
+    most of the patterns in the trees are never reached for a given report
+    (their combined alternation doesn't match), so a short run only compiles
+    the ones it needs
+    '''
+    METHODS = ['search', 'match', 'sub', 'subn', 'findall', 'finditer']
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def compile(self):
+        compiled = re.compile(self.pattern, self.flags)
+        for name in self.METHODS:
+            setattr(self, name, getattr(compiled, name))
+        return compiled
+
+    def search(self, *args):
+        return self.compile().search(*args)
+
+    def match(self, *args):
+        return self.compile().match(*args)
+
+    def sub(self, *args):
+        return self.compile().sub(*args)
+
+    def subn(self, *args):
+        return self.compile().subn(*args)
+
+    def findall(self, *args):
+        return self.compile().findall(*args)
+
+    def finditer(self, *args):
+        return self.compile().finditer(*args)
+
+
+def non_capturing(pattern):
+    '''
+    turn the capturing groups of a pattern into non-capturing ones; a combined
+    alternation only tells whether any of its patterns match, so it needs no
+    groups, and the regex engine can rule out an alternative on its first
+    literal or character class (without entering it) when the alternative
+    does not open a group
+    '''
+    output = []
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            output.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_class:
+            # a closing bracket right after "[" or "[^" is a literal
+            if c == ']' and pattern[i - 1] != '[' and pattern[i - 2:i] != '[^':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(' and pattern[i + 1:i + 2] != '?':
+            c = '(?:'
+        output.append(c)
+        i += 1
+    return ''.join(output)
+
+
+def apply_pattern_tree(node, text):
+    '''
+    substitute every pattern in the tree (in order) into the text, skipping
+    any combined node that has no match in the current text
+    '''
+    pattern, children, first = node
+    if first is None:
+        return pattern.sub(children, text)
+    if pattern.search(text) is None:
+        return text
+    for child in children:
+        text = apply_pattern_tree(child, text)
+    return text
+
+
+
+def tree_matches(node, text):
+    '''
+    whether any pattern in the tree matches the text
+    '''
+    return node[0].search(text) is not None
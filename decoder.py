@@ -7,63 +7,157 @@
 
 ### turn feature vectors into arrays for sci-learn SVM ###
 import os
+import sys
+import bisect
+import itertools
 import numpy as np
-from scipy.sparse import dok_matrix
-import sklearn
-from sklearn.externals import joblib
-print('The scikit-learn version is {}.'.format(sklearn.__version__))
+from scipy.sparse import csr_matrix
+import linear_scorer
 
-def main(num_features, model_file, algorithm, train_batch, test_name, label):
-    feature_d = dict((x.strip().split('\t')[1],x.split('\t')[0]) for x in \
+# number of instances per sparse matrix handed to the model
+BATCH_SIZE = 100000
+
+def load_features(algorithm, train_batch):
+    '''
+    feature index -> feature name for the training batch feature set
+    '''
+    return dict((x.strip().split('\t')[1],x.split('\t')[0]) for x in \
         open(algorithm + os.sep + train_batch + '_features_mapping.txt','r').readlines())
-    sparse_arrays_file =  algorithm + os.sep + test_name + '_sparse_arrays.txt'
-    class_map_file = label + '_label_mapping.txt'
 
-    # maintain order of instances for decoding batch classification
-    instances = [x.strip().split() for x in \
-        open(sparse_arrays_file,'r').readlines()]
+def load_class_map(label):
+    '''
+    integer class -> label name (e.g. 4 -> Reported) for the label type
+    '''
+    class_map_file = label + '_label_mapping.txt'
     class_map=dict((x.strip().split('\t')[1], int(x.strip().split('\t')[0])) \
         for x in open(class_map_file,'r').readlines())
-    reverse_class_map = dict((v,k) for k,v in class_map.items())    
-    X = dok_matrix((len(instances), num_features),dtype = np.float64)
-    index = 0
-    print ('{} instances'.format(len(instances)))
-    for index in range(len(instances)):
-        #instance_id = instances[index][0]
-        features =  instances[index][1:]
-        for feat in features:
-            if feat in feature_d.keys():
-                X[index,int(feat)]=1
+    return dict((v,k) for k,v in class_map.items())    
 
-    X.tocsc()
+def load_model(model_file, use_scorer=True):
+    '''
+    exported linear scorer (see linear_scorer.py) if there is an up to date
+    one next to the pickle, otherwise unpickle the trained sklearn pipeline
+    '''
+    if use_scorer:
+        scorer = linear_scorer.load_scorer(model_file)
+        if scorer is not None:
+            return scorer
+    # sklearn is only imported (which takes about a second) when a pickle is loaded
+    first_import = 'sklearn' not in sys.modules
+    import sklearn
+    try:
+        import joblib
+    except ImportError:
+        # (sklearn < 0.21 without the standalone package)
+        from sklearn.externals import joblib
+    if first_import:
+        print('The scikit-learn version is {}.'.format(sklearn.__version__))
     clf = joblib.load(model_file)
     # the insufficient model was pickled with a float for feature nums? temp hack fix
     clf.named_steps.feature_selection.k = int(clf.named_steps.feature_selection.k)
+    return clf
+
+def make_matrix(instances, num_features, feature_d):
+    '''
+    binary sparse matrix from lists of feature indices (one list per instance)
+    built directly in csr format from indptr/indices arrays
+    '''
+    rows = [sorted(set(int(feat) for feat in features if feat in feature_d)) \
+        for features in instances]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows)), \
+        out=indptr[1:])
+    indices = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int32, count=indptr[-1])
+    data = np.ones(len(indices), dtype=np.float64)
+    return csr_matrix((data, indices, indptr), shape=(len(rows), num_features))
+
+def positive_labels(algorithm):
+    '''
+    labels that count as a "positive" classification for each algorithm
+    (and are passed along to downstream algorithms as such)
+    '''
+    if algorithm == 'positive' : 
+        return set(['Positive'])
+    elif algorithm == 'method':
+        return set(['MutationalAnalysis','FISH'])
+    elif algorithm == 'insufficient':
+        return set(['Insufficient'])
+    else:
+        return set(['Negative','Positive', 'Reported'])
+
+def classify(clf, instances, num_features, feature_d, reverse_class_map):
+    '''
+    label name for each instance (list of feature indices); the instances
+    are turned into a matrix and classified BATCH_SIZE at a time
+    '''
+    output = []
+    for start in range(0, len(instances), BATCH_SIZE):
+        X = make_matrix(instances[start:start + BATCH_SIZE], num_features, feature_d)
+        output.extend(reverse_class_map[y] for y in clf.predict(X))
+    return output
+
+def classify_store(clf, store, rows, column_map, num_features, reverse_class_map):
+    '''
+    label name for each of the given rows of a feature store (see
+    feature_store.py); column_map maps the store vocabulary to model columns
+    '''
+    output = []
+    for start in range(0, len(rows), BATCH_SIZE):
+        X = store.matrix(rows[start:start + BATCH_SIZE], column_map, num_features)
+        output.extend(reverse_class_map[y] for y in clf.predict(X))
+    return output
+
+def classify_shared(make_batch, num_rows, scorers):
+    '''
+    labels from several models over the rows of one shared matrix; the
+    matrix is built BATCH_SIZE rows at a time by make_batch(start, end) and
+    each scorer is (clf, reverse_class_map, positions), positions being the
+    (sorted) rows that model classifies; returns the labels of each scorer
+    '''
+    outputs = [[] for scorer in scorers]
+    for start in range(0, num_rows, BATCH_SIZE):
+        end = min(start + BATCH_SIZE, num_rows)
+        X = make_batch(start, end)
+        for (clf, reverse_class_map, positions), output in zip(scorers, outputs):
+            lo, hi = bisect.bisect_left(positions, start), bisect.bisect_left(positions, end)
+            if lo == hi:
+                continue
+            if hi - lo < end - start:
+                rows = X[np.asarray(positions[lo:hi], dtype=np.int64) - start]
+            else:
+                rows = X
+            output.extend(reverse_class_map[y] for y in clf.predict(rows))
+    return outputs
+
+def main(num_features, model_file, algorithm, train_batch, test_name, label):
+    feature_d = load_features(algorithm, train_batch)
+    sparse_arrays_file =  algorithm + os.sep + test_name + '_sparse_arrays.txt'
+
+    # maintain order of instances for decoding batch classification
+    instances = [x.strip().split() for x in \
+        open(sparse_arrays_file,'r').readlines()]
+    reverse_class_map = load_class_map(label)
+    print ('{} instances'.format(len(instances)))
+    clf = load_model(model_file)
 
     try:
-        output = clf.predict(X)
+        output = classify(clf, [x[1:] for x in instances], num_features, feature_d, \
+            reverse_class_map)
         print ('instances classified\n')
      
         # output files (depending on pos neg flag) 
         # so they may be used by downstream algorithms
         output_pos =  algorithm + os.sep + test_name + '_pos_instances.txt'
         output_neg =  algorithm + os.sep + test_name + '_neg_instances.txt'
+        positive_hit = positive_labels(algorithm)
         
         with open(output_pos,'w') as pos_out:
             with open(output_neg,'w') as neg_out:
                 for i in range(len(output)):                
-                    system_out = reverse_class_map[output[i]]
-                    if algorithm == 'positive' : 
-                        positive_hit = set(['Positive'])
-                    elif algorithm == 'method':
-                        positive_hit = set(['MutationalAnalysis','FISH'])
-                    elif algorithm == 'insufficient':
-                        positive_hit = set(['Insufficient'])
-                    else:
-                        positive_hit = set(['Negative','Positive', 'Reported'])
+                    system_out = output[i]
                     if system_out in positive_hit: 
                         pos_out.write(instances[i][0] + '\t' + system_out + '\n')
                     else:
                         neg_out.write(instances[i][0] + '\t' + system_out + '\n')
     except:
-        print ('ERR: outputs not processed')
\ No newline at end of file
+        print ('ERR: outputs not processed')
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+binary alternative to the <TEST>_feature_vectors.txt interchange format;
+a directory with the feature vocabulary and report ids (one per line) and
+csr style arrays of vocabulary ids, counts and row offsets, written as they
+are produced and read back memory mapped
+usage:
+    python feature_store.py convert Input/EGFR_feature_vectors.txt Input/EGFR_feature_vectors
+    python feature_store.py convert Input/EGFR_feature_vectors Input/EGFR_feature_vectors.txt
+    python feature_store.py compare Input/EGFR_feature_vectors.txt [--algorithm reported --batch IR_10469]
+'''
+import argparse
+import array
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+
+VOCABULARY_FILE = 'vocabulary.txt'
+REPORT_IDS_FILE = 'report_ids.txt'
+# raw little endian arrays (no header, so they can be appended to while writing)
+ARRAY_FILES = {'ids': ('ids.bin', '<i4'), 'counts': ('counts.bin', '<i4'), \
+    'offsets': ('offsets.bin', '<i8')}
+# rows buffered before they are appended to the array files
+FLUSH_ROWS = 10000
+
+
+def store_path(test_name, output_dir):
+    '''
+    feature store directory for a test (next to <TEST>_feature_vectors.txt)
+    '''
+    return output_dir + os.sep + test_name + '_feature_vectors'
+
+
+def is_store(path):
+    return os.path.isdir(path)
+
+
+class FeatureStoreWriter(object):
+    '''
+    append (report id, {feature name: count}) rows to a feature store
+    '''
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.vocabulary = {}
+        self.report_ids = open(path + os.sep + REPORT_IDS_FILE, 'w', encoding='utf-8')
+        self.vocabulary_out = open(path + os.sep + VOCABULARY_FILE, 'w', encoding='utf-8')
+        self.arrays = dict((name, open(path + os.sep + f, 'wb')) for name, (f, dtype) \
+            in ARRAY_FILES.items())
+        self.num_entries = 0
+        self.buffers = self.new_buffers()
+        self.buffers['offsets'].append(0)
+
+    def new_buffers(self):
+        return {'ids': array.array('i'), 'counts': array.array('i'), 'offsets': array.array('q')}
+
+    def add(self, report_id, vector):
+        for name, count in vector.items():
+            if name not in self.vocabulary:
+                self.vocabulary[name] = len(self.vocabulary)
+                self.vocabulary_out.write(name + '\n')
+            self.buffers['ids'].append(self.vocabulary[name])
+            self.buffers['counts'].append(int(count))
+        self.num_entries += len(vector)
+        self.buffers['offsets'].append(self.num_entries)
+        self.report_ids.write(report_id + '\n')
+        if len(self.buffers['offsets']) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        for name, values in self.buffers.items():
+            if sys.byteorder != 'little':
+                values.byteswap()
+            values.tofile(self.arrays[name])
+        self.buffers = self.new_buffers()
+
+    def close(self):
+        self.flush()
+        for out in list(self.arrays.values()) + [self.report_ids, self.vocabulary_out]:
+            out.close()
+
+
+class FeatureStore(object):
+    '''
+    read only, memory mapped feature store
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.vocabulary = [x.rstrip('\n') for x in \
+            open(path + os.sep + VOCABULARY_FILE, 'r', encoding='utf-8')]
+        self.report_ids = [x.rstrip('\n') for x in \
+            open(path + os.sep + REPORT_IDS_FILE, 'r', encoding='utf-8')]
+        for name, (f, dtype) in ARRAY_FILES.items():
+            if os.path.getsize(path + os.sep + f):
+                setattr(self, name, np.memmap(path + os.sep + f, dtype=dtype, mode='r'))
+            else:
+                setattr(self, name, np.zeros(0, dtype=dtype))
+
+    def __len__(self):
+        return len(self.report_ids)
+
+    def row(self, i):
+        '''
+        (feature names, counts) of a row, in the order they were written
+        '''
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [self.vocabulary[k] for k in self.ids[start:end]], self.counts[start:end]
+
+    def has_feature(self, name):
+        '''
+        boolean array; which rows contain a feature
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        if name in self.vocabulary:
+            positions = np.flatnonzero(self.ids == self.vocabulary.index(name))
+            mask[np.searchsorted(self.offsets, positions, side='right') - 1] = True
+        return mask
+
+    def column_map(self, feature_mapping, feature_d):
+        '''
+        model column for each vocabulary id (-1 for features the model doesn't
+        use); feature_mapping is name -> index, feature_d index -> name
+        '''
+        columns = np.full(len(self.vocabulary), -1, dtype=np.int64)
+        for k, name in enumerate(self.vocabulary):
+            index = feature_mapping.get(name)
+            if index is not None and index in feature_d:
+                columns[k] = int(index)
+        return columns
+
+    def matrix(self, rows, column_map, num_features):
+        '''
+        binary csr matrix of the given rows in model columns
+        (same matrix as decoder.make_matrix on the sparse arrays)
+        '''
+        from scipy.sparse import csr_matrix
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = np.asarray(self.offsets[rows])
+        lengths = np.asarray(self.offsets[rows + 1]) - starts
+        row_starts = np.zeros(len(rows), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=row_starts[1:])
+        positions = np.arange(lengths.sum()) + np.repeat(starts - row_starts, lengths)
+        columns = column_map[np.asarray(self.ids[positions])]
+        keep = columns >= 0
+        X = csr_matrix((np.ones(keep.sum(), dtype=np.float64), \
+            (np.repeat(np.arange(len(rows)), lengths)[keep], columns[keep])), \
+            shape=(len(rows), num_features))
+        # features mapped to the same column are counted once
+        X.data[:] = 1
+        return X
+
+    def sparse_arrays(self, rows, feature_mapping):
+        '''
+        (report id, feature indices) like vector_to_array.sparse_array,
+        in row order; feature_mapping is name -> index
+        '''
+        for i in rows:
+            yield self.report_ids[i], [feature_mapping[self.vocabulary[k]] for k in \
+                self.ids[self.offsets[i]:self.offsets[i + 1]] if self.vocabulary[k] in feature_mapping]
+
+
+class MemoryFeatureStore(FeatureStore):
+    '''
+    feature store built in memory from (report id, feature names) instances
+    (see svm_pipeline.read_feature_vectors; counts are all 1), so that the
+    feature names are turned into vocabulary ids once and each model's
+    matrix is only a column_map away
+    '''
+    def __init__(self, instances):
+        self.path = None
+        vocabulary = {}
+        ids = array.array('i')
+        offsets = array.array('q', [0])
+        for report_id, features in instances:
+            ids.extend(vocabulary.setdefault(name, len(vocabulary)) for name in features)
+            offsets.append(len(ids))
+        self.vocabulary = list(vocabulary)
+        self.report_ids = [report_id for report_id, features in instances]
+        self.ids = np.array(ids, dtype=ARRAY_FILES['ids'][1])
+        self.counts = np.ones(len(ids), dtype=ARRAY_FILES['counts'][1])
+        self.offsets = np.array(offsets, dtype=ARRAY_FILES['offsets'][1])
+
+
+def text_to_store(vector_file, path):
+    '''
+    convert a tab delimited feature vector file to a feature store
+    '''
+    writer = FeatureStoreWriter(path)
+    with open(vector_file, 'r') as f:
+        for lines in f:
+            vec = lines.rstrip('\n').split('\t')
+            writer.add(vec[0], dict(zip(vec[1::2], vec[2::2])))
+    writer.close()
+
+
+def store_to_text(path, vector_file):
+    '''
+    convert a feature store back to a tab delimited feature vector file
+    '''
+    store = FeatureStore(path)
+    with open(vector_file, 'w') as out:
+        for i in range(len(store)):
+            names, counts = store.row(i)
+            out.write(store.report_ids[i] + ''.join('\t{}\t{}'.format(k, v) \
+                for k, v in zip(names, counts)) + '\n')
+
+
+def directory_size(path):
+    return sum(os.path.getsize(path + os.sep + f) for f in os.listdir(path))
+
+
+def compare(vector_file, algorithm=None, train_batch=None):
+    '''
+    size and load time of a feature vector file and the equivalent store;
+    with an algorithm, also the time to get its model matrix from each
+    '''
+    import svm_pipeline
+    import vector_to_array
+    import decoder
+    path = tempfile.mkdtemp()
+    try:
+        begin = datetime.today()
+        text_to_store(vector_file, path + os.sep + 'store')
+        print ('converted in {:.2f} seconds'.format((datetime.today() - begin).total_seconds()))
+        print ('text: {} bytes, store: {} bytes'.format(os.path.getsize(vector_file), \
+            directory_size(path + os.sep + 'store')))
+        begin = datetime.today()
+        instances = svm_pipeline.read_feature_vectors(vector_file)
+        print ('text load: {} instances in {:.2f} seconds'.format(len(instances), \
+            (datetime.today() - begin).total_seconds()))
+        begin = datetime.today()
+        store = FeatureStore(path + os.sep + 'store')
+        print ('store load: {} instances in {:.2f} seconds'.format(len(store), \
+            (datetime.today() - begin).total_seconds()))
+        if algorithm:
+            num_features = int(open(algorithm + os.sep + 'num_features.txt', 'r').read().strip())
+            feature_mapping = vector_to_array.load_feature_mapping(algorithm, train_batch)
+            feature_d = decoder.load_features(algorithm, train_batch)
+            begin = datetime.today()
+            expected = decoder.make_matrix([vector_to_array.sparse_array(features, feature_mapping) \
+                for report_id, features in instances], num_features, feature_d)
+            print ('text {} matrix in {:.2f} seconds'.format(algorithm, \
+                (datetime.today() - begin).total_seconds()))
+            begin = datetime.today()
+            observed = store.matrix(np.arange(len(store)), \
+                store.column_map(feature_mapping, feature_d), num_features)
+            print ('store {} matrix in {:.2f} seconds'.format(algorithm, \
+                (datetime.today() - begin).total_seconds()))
+            if (expected != observed).nnz:
+                print ('ERR: matrices differ')
+        del store
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='binary feature vector store')
+    subparsers = parser.add_subparsers(dest='command')
+    convert_parser = subparsers.add_parser('convert', help='text -> store or store -> text')
+    convert_parser.add_argument('source')
+    convert_parser.add_argument('destination')
+    compare_parser = subparsers.add_parser('compare', help='size and load time of both formats')
+    compare_parser.add_argument('vector_file')
+    compare_parser.add_argument('--algorithm', help='also compare building the model matrix')
+    compare_parser.add_argument('--batch', default='IR_10469', help='training batch of the models')
+    args = parser.parse_args()
+    if args.command == 'convert':
+        if is_store(args.source):
+            store_to_text(args.source, args.destination)
+        else:
+            text_to_store(args.source, args.destination)
+    elif args.command == 'compare':
+        compare(args.vector_file, args.algorithm, args.batch)
+    else:
+        parser.print_help()
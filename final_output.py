@@ -5,32 +5,189 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+'''
+aggregate the insufficient, positive, and method pos/neg instance files
+(svm_pipeline.py --debug-files) into one final label per report
+usage: python final_output.py [--test EGFR] [--input-order Input/EGFR_feature_vectors.txt]
+'''
+import argparse
+import heapq
+import itertools
 import os
+import shutil
+import sys
+import tempfile
+from operator import itemgetter
 
-def output_final_class_labels(test_name, FINAL_OUTPUT_DIRECTORY):
+ALGORITHMS = ['insufficient','positive','method']
+# lines sorted in memory at a time; longer files are sorted in runs
+# on disk that are merged (see external_sort)
+SORT_CHUNK = 1000000
+
+
+def output_final_class_labels(test_name, FINAL_OUTPUT_DIRECTORY, input_order_file=None, \
+    chunk_size=SORT_CHUNK):
     '''
     aggregate the results from the insufficient, positive, and method
     classifications and produce a final label for the report
+    each stage's pos/neg files are sorted by report id (on disk, past
+    chunk_size lines) and the three stages are merge joined, so memory
+    use doesn't depend on the number of reports; the final labels are
+    written in report id order, or in the order of the report ids (first
+    column) of input_order_file, e.g. the feature vector file
+    returns the number of reports written and of reports missing a stage
+    '''
+    counts = {'reports': 0, 'missing_method': 0, 'missing_positive': 0, \
+        'unlabeled': 0, 'not_in_input_order': 0}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        labels = final_labels(merged_stage_labels(test_name, tmp_dir, chunk_size), counts)
+        if input_order_file:
+            labels = input_order_labels(labels, input_order_file, tmp_dir, chunk_size, counts)
+        with open(FINAL_OUTPUT_DIRECTORY + os.sep + test_name + \
+            '_final_output.txt','w') as out:
+            for report, label in labels:
+                out.write(report + '\t' + label + '\n')
+                counts['reports'] += 1
+    finally:
+        shutil.rmtree(tmp_dir)
+    return counts
+
+
+def read_fields(file_name, num_fields):
+    '''
+    first num_fields tab delimited fields of each (non blank) line
+    '''
+    with open(file_name, 'r') as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if fields[0]:
+                yield fields[:num_fields]
+
+
+def external_sort(records, key, tmp_dir, chunk_size=SORT_CHUNK):
+    '''
+    stable sort of lists of strings (without tabs or newlines); up to
+    chunk_size records are sorted in memory, larger inputs are written to
+    tmp_dir in sorted runs of chunk_size records and merged as they are read
+    '''
+    records = iter(records)
+    runs = []
+    for chunk in iter(lambda: list(itertools.islice(records, chunk_size)), []):
+        chunk.sort(key=key)
+        if not runs and len(chunk) < chunk_size:
+            return iter(chunk)
+        run = tempfile.TemporaryFile('w+', dir=tmp_dir)
+        run.writelines('\t'.join(record) + '\n' for record in chunk)
+        run.seek(0)
+        runs.append(run)
+    # (heapq.merge takes equal records from earlier runs first)
+    return heapq.merge(*[(line.rstrip('\n').split('\t') for line in run) for run in runs], key=key)
+
+
+def stage_labels(algorithm, test_name, tmp_dir, chunk_size):
+    '''
+    (report id, algorithm, label) from a stage's pos and neg files,
+    sorted by report id
+    '''
+    lines = itertools.chain(read_fields(algorithm + os.sep + test_name + '_pos_instances.txt', 2), \
+        read_fields(algorithm + os.sep + test_name + '_neg_instances.txt', 2))
+    for report_id, label in external_sort(lines, itemgetter(0), tmp_dir, chunk_size):
+        yield report_id, algorithm, label
+
+
+def merged_stage_labels(test_name, tmp_dir, chunk_size):
+    '''
+    (report id, {algorithm: label}) in report id order; a report listed
+    more than once keeps its last label (neg file over pos file)
+    '''
+    stages = [stage_labels(algorithm, test_name, tmp_dir, chunk_size) for algorithm in ALGORITHMS]
+    for report_id, group in itertools.groupby(heapq.merge(*stages, key=itemgetter(0)), key=itemgetter(0)):
+        yield report_id, dict((algorithm, label) for r, algorithm, label in group)
+
+
+def final_labels(report_labels, counts):
+    '''
+    (report id, final label) for each (report id, algorithm labels);
+    reports with a positive but no method label (or vice versa) are counted
+    and left out, since they can't get a final label
+    '''
+    for report_id, algorithm_labels in report_labels:
+        if ('positive' in algorithm_labels) != ('method' in algorithm_labels):
+            counts['missing_positive' if 'method' in algorithm_labels else 'missing_method'] += 1
+            continue
+        yield report_id, final_label(algorithm_labels)
+
+
+def input_order_labels(labels, input_order_file, tmp_dir, chunk_size, counts):
+    '''
+    (report id, final label) pairs (sorted by report id) in the order of
+    the report ids in the first column of input_order_file (at the first
+    occurrence of a repeated one); input reports without a label are
+    counted, labeled reports that aren't in the file are counted and
+    written last (in report id order)
+    '''
+    positions = ((fields[0], str(i)) for i, fields in enumerate(read_fields(input_order_file, 1)))
+    joined = join_positions(external_sort(positions, itemgetter(0), tmp_dir, chunk_size), labels, counts)
+    ordered = external_sort(joined, lambda record: (int(record[0]) if record[0] else sys.maxsize, \
+        record[1]), tmp_dir, chunk_size)
+    for position, report_id, label in ordered:
+        yield report_id, label
+
+
+def join_positions(positions, labels, counts):
+    '''
+    merge join of (report id, input position) and (report id, label) pairs,
+    both sorted by report id; (position, report id, label) for the first
+    (lowest) position of a labeled report, so a report id repeated in the
+    input order file is written once, and ('', report id, label) for
+    labeled reports without a position
+    '''
+    records = heapq.merge(((report_id, 0, position) for report_id, position in positions), \
+        ((report_id, 1, label) for report_id, label in labels), key=itemgetter(0))
+    for report_id, group in itertools.groupby(records, key=itemgetter(0)):
+        group = list(group)
+        # (the label, if there is one, comes after the positions)
+        if group[-1][1] == 0:
+            counts['unlabeled'] += 1
+            continue
+        label = group[-1][2]
+        if len(group) == 1:
+            counts['not_in_input_order'] += 1
+            yield '', report_id, label
+        else:
+            yield min((position for r, tag, position in group[:-1]), key=int), report_id, label
+
+
+def final_label(algorithm_labels):
+    '''
+    one label per report from its insufficient, positive, and method labels
+    (e.g. "Negative by MutationalAnalysis" or "Insufficient")
+    '''
+    if 'positive' in algorithm_labels:
+        return algorithm_labels['positive'] + ' by ' + algorithm_labels['method']
+    else:
+        return algorithm_labels['insufficient']
+
+
+def write_final_labels(test_name, FINAL_OUTPUT_DIRECTORY, report_labels):
+    '''
+    write the final label for each (report, algorithm labels) pair
     '''
-    report_label_dict = {}
-    for algorithm in ['insufficient','positive','method']:
-        system_labels = [x.strip().split('\t') for x in open(algorithm + \
-            os.sep + test_name + '_pos_instances.txt','r').readlines()] + \
-            [y.strip().split('\t') for y in open(algorithm + os.sep + \
-             test_name + '_neg_instances.txt','r').readlines()]
-        for each in system_labels:
-            report_id = each[0]
-            report_label_dict[report_id] = report_label_dict.get(report_id, {})
-            report_label_dict[report_id][algorithm] = each[1]
-    
     with open(FINAL_OUTPUT_DIRECTORY + os.sep + test_name + \
         '_final_output.txt','w') as out:
-        for report, algorithm_labels in report_label_dict.items():
-            out.write(report + '\t')
-            if 'positive' in algorithm_labels:
-                out.write(algorithm_labels['positive'] + ' by ' + \
-                    algorithm_labels['method'] + '\n')
-            else:
-                out.write(algorithm_labels['insufficient'] + '\n')
-        
-    
+        for report, algorithm_labels in report_labels:
+            out.write(report + '\t' + final_label(algorithm_labels) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='final label per report from the pos/neg instance files')
+    parser.add_argument('--test', default='EGFR')
+    parser.add_argument('--output-dir', default='final_output')
+    parser.add_argument('--input-order', \
+        help='write the labels in the order of the report ids (first column) of this file')
+    args = parser.parse_args()
+    counts = output_final_class_labels(args.test, args.output_dir, args.input_order)
+    print ('{reports} reports written, {missing_method} without a method label, '.format(**counts) + \
+        '{missing_positive} without a positive label, {unlabeled} input reports without labels, '.format(**counts) + \
+        '{not_in_input_order} labeled reports not in the input order file'.format(**counts))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+export the pickled reported/insufficient/positive/method pipelines as compact
+linear scorers; the selected feature ids, weights, intercepts and class map
+are saved next to the pickle (<TRAIN_BATCH>_scorer.npz) and scored with one
+sparse dot product per batch, without sklearn or the feature selection step
+models that aren't linear (or one-vs-one multiclass SVCs) are not exported,
+and the decoder keeps using the sklearn pipeline for them
+usage:
+    python linear_scorer.py export [--batch IR_10469]
+    python linear_scorer.py check --test EGFR [--batch IR_10469]
+'''
+import argparse
+import os
+import numpy as np
+from scipy.sparse import issparse
+
+
+class LinearScorer(object):
+    '''
+    numpy only stand in for a (feature selection -> linear classifier)
+    pipeline; predict returns the same integer classes as the pipeline
+    '''
+    def __init__(self, selected, coef, intercept, classes, class_names, num_features):
+        self.selected = selected
+        self.coef = coef
+        self.intercept = intercept
+        self.classes = classes
+        self.class_names = class_names
+        # weights for every feature (zero if not selected) so the
+        # full instance matrix can be scored without column slicing
+        self.weights = np.zeros((num_features, coef.shape[0]), dtype=np.float64)
+        self.weights[selected] = coef.T
+
+    def decision_function(self, X):
+        scores = X.dot(self.weights) + self.intercept
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            return self.classes[(scores > 0).astype(int)]
+        return self.classes[scores.argmax(axis=1)]
+
+
+def scorer_file(model_file):
+    '''
+    exported scorer that goes with a pickled pipeline
+    '''
+    return os.path.splitext(model_file)[0] + '_scorer.npz'
+
+
+def linear_parameters(clf):
+    '''
+    (selected feature ids, coef, intercept, classes) of a fitted pipeline,
+    or None when the pipeline can't be scored as a single linear function
+    '''
+    steps = [step for name, step in clf.steps]
+    if len(steps) != 2 or not hasattr(steps[0], 'get_support'):
+        return None
+    model = steps[1]
+    if not hasattr(model, 'coef_') or not hasattr(model, 'intercept_'):
+        # non-linear kernels have no primal weights
+        return None
+    classes = np.asarray(model.classes_)
+    coef = model.coef_.toarray() if issparse(model.coef_) else np.asarray(model.coef_)
+    # libsvm (SVC) multiclass models are one-vs-one; coef_ rows are not per class
+    if len(classes) > 2 and (hasattr(model, 'support_vectors_') or coef.shape[0] != len(classes)):
+        return None
+    return (np.flatnonzero(steps[0].get_support()).astype(np.int64), coef.astype(np.float64), \
+        np.asarray(model.intercept_, dtype=np.float64), classes)
+
+
+def export_scorer(model_file, label, num_features):
+    '''
+    write the scorer for a pickled pipeline; returns the scorer file name,
+    or None if the model has to stay on the sklearn path
+    '''
+    import decoder
+    parameters = linear_parameters(decoder.load_model(model_file, use_scorer=False))
+    if parameters is None:
+        return None
+    selected, coef, intercept, classes = parameters
+    reverse_class_map = decoder.load_class_map(label)
+    class_names = np.array([reverse_class_map[int(c)] for c in classes])
+    np.savez(scorer_file(model_file), selected=selected, coef=coef, intercept=intercept, \
+        classes=classes, class_names=class_names, num_features=np.array([num_features]))
+    return scorer_file(model_file)
+
+
+def load_scorer(model_file):
+    '''
+    exported scorer for a pickled pipeline, or None if there isn't one
+    (or it is older than the pickle)
+    '''
+    exported = scorer_file(model_file)
+    if not os.path.exists(exported) or \
+        os.path.getmtime(exported) < os.path.getmtime(model_file):
+        return None
+    artifact = np.load(exported)
+    return LinearScorer(artifact['selected'], artifact['coef'], artifact['intercept'], \
+        artifact['classes'], artifact['class_names'], int(artifact['num_features'][0]))
+
+
+def check_scorer(algorithm, label, train_batch, sparse_arrays_file):
+    '''
+    compare the predictions of the exported scorer and the pickled pipeline
+    on a validation set of sparse arrays (report id followed by feature ids);
+    returns the number of instances that disagree
+    '''
+    import decoder
+    model_file = algorithm + os.sep + train_batch + '.pkl'
+    num_features = int(open(algorithm + os.sep + 'num_features.txt', 'r').read().strip())
+    feature_d = decoder.load_features(algorithm, train_batch)
+    reverse_class_map = decoder.load_class_map(label)
+    instances = [x.strip().split()[1:] for x in open(sparse_arrays_file,'r').readlines()]
+    scorer = load_scorer(model_file)
+    if scorer is None:
+        print ('{}: no exported scorer, sklearn pipeline is used'.format(algorithm))
+        return 0
+    expected = decoder.classify(decoder.load_model(model_file, use_scorer=False), instances, \
+        num_features, feature_d, reverse_class_map)
+    observed = decoder.classify(scorer, instances, num_features, feature_d, reverse_class_map)
+    mismatches = sum(1 for i in range(len(expected)) if expected[i] != observed[i])
+    print ('{}: {} instances, {} mismatches'.format(algorithm, len(instances), mismatches))
+    return mismatches
+
+
+if __name__ == '__main__':
+    from svm_pipeline import ALGORITHM_ORDER
+    parser = argparse.ArgumentParser(description='export/check linear scorers of the SVM pipelines')
+    parser.add_argument('command', choices=['export', 'check'])
+    parser.add_argument('--batch', default='IR_10469', help='training batch of the models')
+    parser.add_argument('--test', default='EGFR', \
+        help='test whose <algorithm>/<TEST>_sparse_arrays.txt is the validation set')
+    parser.add_argument('--algorithms', nargs='+', default=[a for a, l in ALGORITHM_ORDER])
+    args = parser.parse_args()
+    labels = dict(ALGORITHM_ORDER)
+    if args.command == 'export':
+        for algorithm in args.algorithms:
+            model_file = algorithm + os.sep + args.batch + '.pkl'
+            num_features = int(open(algorithm + os.sep + 'num_features.txt', 'r').read().strip())
+            exported = export_scorer(model_file, labels[algorithm], num_features)
+            print ('{}: {}'.format(algorithm, exported or 'not linear, keeping the sklearn pipeline'))
+    else:
+        mismatches = 0
+        for algorithm in args.algorithms:
+            mismatches += check_scorer(algorithm, labels[algorithm], args.batch, \
+                algorithm + os.sep + args.test + '_sparse_arrays.txt')
+        if mismatches:
+            raise SystemExit(1)
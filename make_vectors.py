@@ -10,7 +10,12 @@ script to make feature vectors for EGFR/ALK (and other) tests from pathology rep
 this process consists of iterative text munging with feature vector additions
 '''
 from datetime import datetime
-import os, re, json
+import os, re, sys, json
+import argparse, bisect, collections, gzip, hashlib, itertools, multiprocessing
+import combined_patterns
+import pattern_bundle
+import report_index
+import vector_cache
 
 # a file that (at minimum) contains the unique id of the report (instance)
 # the pathology report accession number 
@@ -21,139 +26,590 @@ INSTANCES_FILE = 'Input/IR 10469_Path_Text_2020-06-29.txt'
 TEXT_COL = 7
 REPORT_ID_COL = 2
 ACC_NUM_COL = 5
+# the report text may contain escaped characters (e.g. \t)
+INSTANCES_ENCODING = 'unicode_escape'
 
 # the test/marker to be classified - note this needs to be the standardized
 # key that is present in the "test_patterns.json" resource file
 TEST_NAME = 'ALK'
 
 # one output file per batch, per test type
-OUTPUT_FILE = 'Input' + os.sep + TEST_NAME + '_feature_vectors.txt'
+OUTPUT_DIR = 'Input'
+OUTPUT_FILE = OUTPUT_DIR + os.sep + TEST_NAME + '_feature_vectors.txt'
 RESOURCE_DIR = 'Resources'
+# digits of an accession number (see get_other_acc_num)
+ACC_NUM_DIGITS = '[\d]{2,4}[\- ]{1,3}[\d]{2,8}'
+ACC_NUM = re.compile('[\W]([\(]?[A-Z]{1,2}[\- ]?' + ACC_NUM_DIGITS + '[\)]?)[\W]')
+ACC_NUM_REPLACEMENTS = [' THIS_ACC_NUM ', ' OTHER_ACC_NUM ']
 STOP_LIST = '[\s\^](TO|THE|FOR|A|AN|AS|THIS|THAT|THESE|THEY|IN|OF|ON|OR|BY)( THE|A|AN)?[\s\$]'
 
 # windows dictate the number of tokens on either side of the test name
 # that are considered in the feature engineering
 PRE_WINDOW = 10
 POST_WINDOW = 10
+# tokens that end a window
+WINDOW_BREAKS = set(['_SECTION_', 'PUNCTUATION', 'SPECIMEN_LABEL', 'OTHER_TEST'])
 
-    
-def vector_creation():
+# number of worker processes for vector creation (1 = single process)
+NUM_WORKERS = 1
+# number of reports handed to a worker process at a time
+CHUNK_SIZE = 200
+# number of reports between progress/throughput updates
+PROGRESS_INTERVAL = 10000
+# models whose feature mappings make up the vocabulary for pruned vectors
+# (see --prune-batch), and features used outside of the models
+MODEL_ALGORITHMS = ['reported', 'insufficient', 'method', 'positive']
+PIPELINE_FEATURES = ['NO_KEYWORD_IN_TEXT']
+# window feature prefixes; pre and post windows also have bigrams and skipgrams
+UNIGRAM_PREFIXES = ['immediately_pre_window=', 'immediately_post_window=', 'pre_window=', 'post_window=']
+PAIR_PREFIXES = ['pre_window=', 'post_window=']
+
+def compile_patterns(pattern_dictionary, uppercase_boolean, cushion1, cushion2):
     '''
-    initial/main method for vector creation
-    '''  
-    def compile_patterns(pattern_dictionary, uppercase_boolean, cushion1, cushion2):
-        '''
-        helper method to compile patterns for each regex dictionary 
-        with appropriate "cushions" before and after primary capture groups
-        allows for optomizing pattern matching while 
-        allowing for slightly better readibility in json docs
-        '''
-        compiled_d = {}
-        for key, val in pattern_dictionary.items():
-            compiled_patterns = []
-            k = key.replace('<newline>','\n')
-            for each in val:
-                ## make sure match pattern is isolated from alphanumeric characters
+    helper method to compile patterns for each regex dictionary 
+    with appropriate "cushions" before and after primary capture groups
+    allows for optomizing pattern matching while 
+    allowing for slightly better readibility in json docs
+    '''
+    compiled_d = {}
+    for key, val in pattern_dictionary.items():
+        compiled_patterns = []
+        k = key.replace('<newline>','\n')
+        for each in val:
+            ## make sure match pattern is isolated from alphanumeric characters
+            compiled_patterns.append(re.compile(r'' + cushion1 + \
+                '('+each+')' + cushion2, re.MULTILINE))
+            if uppercase_boolean:
                 compiled_patterns.append(re.compile(r'' + cushion1 + \
-                    '('+each+')' + cushion2, re.MULTILINE))
-                if uppercase_boolean:
-                    compiled_patterns.append(re.compile(r'' + cushion1 + \
-                        '('+each.upper()+')' + cushion2, re.MULTILINE))
-                
-            compiled_d[k] = compiled_patterns
-        return compiled_d
-    
+                    '('+each.upper()+')' + cushion2, re.MULTILINE))
+            
+        compiled_d[k] = compiled_patterns
+    return compiled_d
+
+
+def load_pattern_resources():
+    '''
+    load json objects containing regex patterns
+    (test names, other keywords, and section headers)
+    '''
     # resources needed for text standardization and feature engineering
     test_pattern_file = '{}{}{}'.format(RESOURCE_DIR, os.path.sep, 'test_patterns.json')
     other_pattern_file = '{}{}{}'.format(RESOURCE_DIR, os.path.sep, 'other_keyword_patterns.json')
     section_pattern_file = '{}{}{}'.format(RESOURCE_DIR, os.path.sep, 'section_patterns.json')
-    
-    # load json objects containing regex patterns        
     test_patterns = json.load(open(test_pattern_file,'r'))
     other_patterns = json.load(open(other_pattern_file,'r'))
     section_patterns = json.load(open(section_pattern_file,'r'))
+    return test_patterns, other_patterns, section_patterns
+
+
+def make_pattern_trees(test_patterns, other_patterns, section_patterns):
+    '''
+    combined pattern trees in the order make_standardized_text applies them
+    '''
+    return [combined_patterns.compile_tree(sources) for sources in \
+        tree_sources(test_patterns, other_patterns, section_patterns)]
+
 
-    # here we only uppercase all patterns (based on boolean flag)
-    # as long as no regex character classes are used in pattern 
-    # e.g. we don't want [\w] to turn into [\W]
-    compiled_test_patterns = compile_patterns(test_patterns, True, '[\W\^]', '[\W$]')
-    compiled_other_patterns = compile_patterns(other_patterns, False, '[\W\^]', '[\W$]')
-    compiled_section_patterns = compile_patterns(section_patterns, True, '^', '$')
+def tree_sources(test_patterns, other_patterns, section_patterns):
+    '''
+    regex sources of the combined pattern trees; same cushions and
+    uppercasing as the individually compiled patterns
+    '''
+    return [combined_patterns.tree_sources(test_patterns, True, '[\W\^]', '[\W$]', ' OTHER_TEST '),
+        combined_patterns.tree_sources(section_patterns, True, '^', '$'),
+        combined_patterns.tree_sources(other_patterns, False, '[\W\^]', '[\W$]')]
+
+
+def bundle_sources(test_patterns, other_patterns, section_patterns, test_names=None):
+    '''
+    regex sources of everything prepare_patterns compiles (the contents of
+    the pattern bundle, see pattern_bundle.py); the standardization trees
+    and, for each test (default every test in test_patterns.json), its test
+    instance patterns and their combined prescreen
+    '''
+    targets = {}
+    for test_name in test_names or test_patterns.keys():
+        target_patterns = {test_name: test_patterns[test_name]}
+        # here we only uppercase all patterns (based on boolean flag)
+        # as long as no regex character classes are used in pattern 
+        # e.g. we don't want [\w] to turn into [\W]
+        targets[test_name] = {'test_instance': [expression.pattern for expression in \
+            compile_patterns(target_patterns, True, '[\W\^]', '[\W$]')[test_name]],
+            'prescreen': combined_patterns.tree_sources(target_patterns, True, '[\W\^]', '[\W$]')}
+    return {'trees': tree_sources(test_patterns, other_patterns, section_patterns), 'targets': targets}
+
+    
+def prepare_patterns(test_names, prune_batch=None, sources=None, lazy=True):
+    '''
+    compile the patterns needed to vectorize reports for a list of tests;
+    the target test patterns (and a combined prescreen of them) per test,
+    and the combined trees for the text standardization
+    the sources (see pattern_sources) are looked up unless given; the
+    combined trees are compiled lazily, pattern by pattern, as reports need
+    them (unless lazy is False)
+    with a prune_batch, only the features used by the models of that
+    training batch are kept (see make_ngram_vocabulary)
+    '''
+    sources = sources or pattern_sources(test_names)
+    targets = {}
+    for test_name in test_names:
+        target = sources['targets'][test_name]
+        targets[test_name] = {'test_instance': [re.compile(source, re.MULTILINE) for source in \
+            target['test_instance']], 'prescreen': combined_patterns.compile_tree(target['prescreen'], lazy)}
+    # combined pattern trees for the single pass standardization
+    return {'targets': targets, 'trees': [combined_patterns.compile_tree(tree, lazy) for tree in sources['trees']], \
+        'ngram_vocabulary': make_ngram_vocabulary(load_model_vocabulary(prune_batch)) if prune_batch else None}
+
+
+def pattern_sources(test_names):
+    '''
+    regex sources for prepare_patterns; from the pattern bundle (see
+    pattern_bundle.py) while it is up to date, otherwise from the json resources
+    '''
+    sources = pattern_bundle.load_bundle(RESOURCE_DIR)
+    if sources is None:
+        sources = bundle_sources(*load_pattern_resources(), test_names=test_names)
+    return sources
+
+
+def load_model_vocabulary(train_batch):
+    '''
+    union of the features of the MODEL_ALGORITHMS feature mappings
+    for a training batch (and the PIPELINE_FEATURES)
+    '''
+    import vector_to_array
+    vocabulary = set(PIPELINE_FEATURES)
+    for algorithm in MODEL_ALGORITHMS:
+        vocabulary.update(vector_to_array.load_feature_mapping(algorithm, train_batch))
+    return vocabulary
+
+
+def make_ngram_vocabulary(vocabulary):
+    '''
+    integer ids for the tokens that occur in the window features of the
+    vocabulary, and the feature name for each token id (unigrams) and
+    pair of token ids (bigrams and skipgrams) per window type, so that
+    make_pruned_ngrams looks features up instead of building strings
+    tokens may contain underscores, so every split of a pair feature is kept;
+    any split that matches rebuilds exactly the same feature name
+    '''
+    tokens = {}
+    unigram_keys = []
+    pair_keys = []
+    for feature in vocabulary:
+        for prefix in UNIGRAM_PREFIXES:
+            if feature.startswith(prefix):
+                rest = feature[len(prefix):]
+                unigram_keys.append((prefix, tokens.setdefault(rest, len(tokens)), feature))
+                if prefix in PAIR_PREFIXES:
+                    for i in [i for i, c in enumerate(rest) if c == '_']:
+                        pair_keys.append((prefix, tokens.setdefault(rest[:i], len(tokens)), \
+                            tokens.setdefault(rest[i + 1:], len(tokens)), feature))
+    num_tokens = len(tokens)
+    unigrams = dict((prefix, {}) for prefix in UNIGRAM_PREFIXES)
+    for prefix, token, feature in unigram_keys:
+        unigrams[prefix][token] = feature
+    pairs = dict((prefix, {}) for prefix in PAIR_PREFIXES)
+    for prefix, first, second, feature in pair_keys:
+        pairs[prefix][first * num_tokens + second] = feature
+    # tokens the pairs are anchored on (the current token of the window loops);
+    # the pair lookups are skipped for every other token
+    anchors = {'pre_window=': set(second for prefix, first, second, feature in pair_keys \
+        if prefix == 'pre_window='), 'post_window=': set(first for prefix, first, second, feature \
+        in pair_keys if prefix == 'post_window=')}
+    return {'features': vocabulary, 'tokens': tokens, 'num_tokens': num_tokens, \
+        'unigrams': unigrams, 'pairs': pairs, 'anchors': anchors}
+
+
+def prune_vector(vector, vocabulary):
+    '''
+    features of a vector that are in the vocabulary (in the same order)
+    '''
+    return dict((k, v) for k, v in vector.items() if k in vocabulary)
 
-    counter = 0
+    
+def vector_creation(num_workers=NUM_WORKERS, instances_file=None, output_file=None, \
+    columns=None, encoding=INSTANCES_ENCODING, test_names=None, output_dir=None, \
+    vector_format='text', prune_batch=None, cache_file=None, cache_max_bytes=vector_cache.MAX_BYTES, \
+    index=True):
+    '''
+    initial/main method for vector creation
+    reports are streamed one at a time from the instances file 
+    ("-" for stdin, .gz files are decompressed on the fly)
+    columns are the (report id, accession, text) column indices or header names
+    one <TEST>_feature_vectors.txt per test in test_names (default TEST_NAME)
+    is written to output_dir from a single read of the instances; output_file
+    overrides the file name when there is only one test
+    vector_format "binary" writes a feature store directory (see
+    feature_store.py) per test instead of the text file
+    prune_batch keeps only the features used by the models of that training
+    batch (see load_model_vocabulary)
+    cache_file is a vector cache (see vector_cache.py); only the reports
+    (and tests) that aren't in it are vectorized
+    num_workers > 1 spreads the reports across a pool of processes;
+    output lines are still written in input order
+    index writes a report id index next to each output (see report_index.py)
+    '''  
+    test_names = test_names or [TEST_NAME]
+    if output_file and len(test_names) == 1:
+        output_files = [output_file]
+    else:
+        output_files = [vector_file(test_name, output_dir, vector_format) for test_name in test_names]
+    # number of reports that went down each vector creation path (per test)
+    # and number of rows that could not be read
+    paths = dict((test_name, {'full': 0, 'standardized': 0, 'minimal': 0}) for test_name in test_names)
+    counts = {'malformed': 0}
+    begin = datetime.today()
+    # the patterns come first, so a bad resource, test name or prune batch
+    # fails before any output file, feature store or cache is created
+    sources = pattern_sources(test_names)
+    patterns = prepare_patterns(test_names, prune_batch, sources)
+    handle = open_instances(instances_file or INSTANCES_FILE)
+    # byte offset of each report's row, for the index
+    offsets = collections.deque() if index else None
+    instances = read_instances(handle, columns, encoding, counts, offsets)
+    cache = None
+    if cache_file:
+        cache = vector_cache.VectorCache(cache_file, cache_settings(prune_batch), cache_max_bytes)
+        instances = cache.lookup(instances, test_names)
+    if vector_format == 'binary':
+        # (numpy is only imported for binary output)
+        import feature_store
+        outs = [feature_store.FeatureStoreWriter(f) for f in output_files]
+    else:
+        outs = [open(f, 'w') for f in output_files]
+    indexes = [None] * len(test_names)
+    if index:
+        indexes = [report_index.IndexWriter(f, instances_file or INSTANCES_FILE, columns or (REPORT_ID_COL, \
+            ACC_NUM_COL, TEXT_COL), encoding, test_name, vector_format, prune_batch, \
+            getattr(out, 'encoding', None)) for f, test_name, out in zip(output_files, test_names, outs)]
     # loop through instances
-    with open(OUTPUT_FILE, 'w') as out:
-        num_processed = 0
-        for lines in open(INSTANCES_FILE, 'r', encoding='unicode_escape').readlines()[1:]:   #, encoding='unicode_escape'
-            separate_columns = lines.split('\t')
-            if True:  # place holder for individual instance debugging
-                counter += 1  
-                pathnum = separate_columns[ACC_NUM_COL]
-                report_id = separate_columns[REPORT_ID_COL]                
-                text = separate_columns[TEXT_COL]
-
-                # seems unnecessary, but need to maintain regex behavior
-                text = text.replace('<newline>','\n').strip()
-                # dictionary of feature counts for models
-                vector = {} 
-                
-                # cytometry check
-                vector['CYTO_RELATED_REPORT'] = int(get_cyto(text))
-                # standardize test instance
-                text, vector = strip_test_name(compiled_test_patterns[TEST_NAME], text, \
-                    vector)
-                # standardize all mentions of other test names in the text 
-                text = make_standardized_text(compiled_test_patterns, text, \
-                    compiled_other_patterns, counter, compiled_section_patterns)                
-                
-                ## get reference to other path accession feature
-                other_acc_num, text = get_other_acc_num(text, pathnum)
-                vector['OTHER_ACC_NUM_IN_TEXT'] = vector.get('OTHER_ACC_NUM_IN_TEXT', 0) + int(other_acc_num)
-                # general check for language about technical difficulties
-                vector['INSUFFICIENT'] = vector.get('INSUFFICIENT', 0) + int(get_insufficient(text))
-                ## condense some duplicate standardizations    
-                for string in ['OTHER_TEST','PUBLICATION','TEST_INSTANCE','IHC',
-                    'PATHOLOGIST','BLOCK_ACC', 'SPECIFIC_MUT','MUT_ANALYSIS',
-                    'FISH','AUTHOR']:
-                    text = re.sub(string + r'[,.\(\):\-;andor' + string + \
-                        ' ]{1,}' + string, ' ' + string + ' ', text)
-                
-                # condense coordinated test instance 
-                # (eg test 1 and test 2 are pending) 
-                # we dont want to break on test2
-                text = re.sub('TEST_INSTANCE[,.\(\):\-;andor ]{1,}OTHER_TEST', 'TEST_INSTANCE', text)
-                # strip out punctuation at the last minute for skipgram features 
-                text = re.sub('[0-9]{2}[\-\\\/][0-9]{2}[\-\\\/][0-9]{2,5}',' DATE ',text)    
-                text = re.sub('($|\s)[A-H][\)]?[.]',' SPECIMEN_LABEL', text)
-                text = re.sub('[\"\(\\\)\-\/\']', ' ', text)                
-                text = re.sub('[.,;:\?]', ' PUNCTUATION ', text)
-                text = text.replace('[', ' ').replace(']', ' ')
-                
-                # strip out long trails of  ____ - 
-                # there ARE single underscores IN the standardized features
-                text = re.sub('_{2,}',' ', text)
-                text = text.upper()
-                # twice through to capture SOME MORE of the coordinations
-                text = re.sub(STOP_LIST,' ', text)
-                text = re.sub(STOP_LIST,' ', text)  
-                text = text.split()  
-                vector = make_ngrams(text, vector)                  
-               
-                vector['COUNT_TEST_INSTANCE'] = text.count('TEST_INSTANCE')
-                if not vector['COUNT_TEST_INSTANCE']:
-                    vector['NO_KEYWORD_IN_TEXT'] = 1    
-                
-                # output feature vectors to text specific file
-                out.write(report_id)
-                try:
-                    for k,v in vector.items():
-                        out.write('\t{}\t{}'.format(k, v))
-                except:
-                    print ('{} processed {}{}'.format(num_processed, report_id,k))
-                    sys.exit()
-                out.write('\n')
-                num_processed += 1
+    num_processed = 0
+    if num_workers > 1:
+        results = parallel_vectors(instances, num_workers, test_names, prune_batch, sources)
+    else:
+        results = (vectorize(instance, patterns) for instance in instances)
+    if cache:
+        results = cache.merge(results)
+    for report_id, test_results in results:
+        instance_offset = offsets.popleft() if index else None
+        # output feature vectors to text specific file
+        for test_name, out, index_writer, (vector, path) in zip(test_names, outs, indexes, test_results):
+            if vector_format == 'binary':
+                out.add(report_id, vector)
+                line = None
+            else:
+                line = format_vector(report_id, vector)
+                out.write(line)
+            if index:
+                index_writer.add(report_id, instance_offset, line)
+            paths[test_name][path] += 1
+        num_processed += 1
+        if num_processed % PROGRESS_INTERVAL == 0:
+            report_progress(num_processed, begin)
+    for out in outs:
+        out.close()
+    if index:
+        for index_writer in indexes:
+            index_writer.close()
+    if cache:
+        cache.close()
+    if handle is not sys.stdin.buffer:
+        handle.close()
+    report_progress(num_processed, begin)
+    for test_name in test_names:
+        print ('{}: {} reports on the full path, {} keyword free (standardized), {} keyword free (minimal)'.format(\
+            test_name, paths[test_name]['full'], paths[test_name]['standardized'], paths[test_name]['minimal']))
+    print ('{} malformed rows skipped'.format(counts['malformed']))
+    if cache:
+        print (cache.summary())
+
+
+def cache_settings(prune_batch=None):
+    '''
+    everything besides the report and the test that a feature vector
+    depends on (part of every vector cache key)
+    '''
+    resources = {}
+    for f in sorted(os.listdir(RESOURCE_DIR)):
+        if f.endswith('.json'):
+            resources[f] = hashlib.sha256(open(RESOURCE_DIR + os.sep + f, 'rb').read()).hexdigest()
+    return {'resources': resources, 'pre_window': PRE_WINDOW, 'post_window': POST_WINDOW, \
+        'window_breaks': sorted(WINDOW_BREAKS), 'acc_num': ACC_NUM.pattern, 'stop_list': STOP_LIST, \
+        'vocabulary': sorted(load_model_vocabulary(prune_batch)) if prune_batch else None}
+
+
+def vector_file(test_name, output_dir=None, vector_format='text'):
+    '''
+    feature vector file for a test (one output file per batch, per test type)
+    '''
+    if vector_format == 'binary':
+        import feature_store
+        return feature_store.store_path(test_name, output_dir or OUTPUT_DIR)
+    return (output_dir or OUTPUT_DIR) + os.sep + test_name + '_feature_vectors.txt'
+
+
+def open_instances(instances_file):
+    '''
+    binary handle for the instances file; "-" reads from stdin
+    and files ending in .gz are decompressed as they are read
+    '''
+    if instances_file == '-':
+        return sys.stdin.buffer
+    if instances_file.endswith('.gz'):
+        return gzip.open(instances_file, 'rb')
+    return open(instances_file, 'rb')
+
+
+def resolve_columns(header, columns):
+    '''
+    column indices for the (report id, accession, text) columns,
+    each given either as an index or as a name in the header row
+    '''
+    names = [x.strip() for x in header.split('\t')]
+    indices = []
+    for column in columns:
+        if str(column).isdigit():
+            indices.append(int(column))
+        elif column in names:
+            indices.append(names.index(column))
+        else:
+            raise ValueError('column {} is not in the header of the instances file'.format(column))
+    return indices
+
+
+def read_instances(handle, columns=None, encoding=INSTANCES_ENCODING, counts=None, offsets=None):
+    '''
+    stream (report id, accession number, text) for each report from a binary
+    handle, decoding one line at a time; the first line is the header
+    rows that are too short or can't be decoded are counted as "malformed"
+    and skipped
+    offsets (a deque) gets the byte offset of each report's row as it is read
+    '''
+    if counts is None:
+        counts = {'malformed': 0}
+    header = handle.readline()
+    position = len(header)
+    header = header.decode(encoding, 'replace')
+    report_id_col, acc_num_col, text_col = resolve_columns(header, \
+        columns or (REPORT_ID_COL, ACC_NUM_COL, TEXT_COL))
+    num_cols = max(report_id_col, acc_num_col, text_col) + 1
+    for lines in handle:
+        offset = position
+        position += len(lines)
+        try:
+            separate_columns = lines.rstrip(b'\r\n').decode(encoding).split('\t')
+        except UnicodeDecodeError:
+            separate_columns = []
+        if len(separate_columns) < num_cols:
+            counts['malformed'] += 1
+            continue
+        pathnum = separate_columns[acc_num_col]
+        report_id = separate_columns[report_id_col]                
+        if offsets is not None:
+            offsets.append(offset)
+        yield report_id, pathnum, clean_text(separate_columns[text_col])
+
+
+def clean_text(text):
+    '''
+    report text as the patterns expect it
+    '''
+    # seems unnecessary, but need to maintain regex behavior
+    return text.replace('<newline>','\n').strip()
+
+
+def vectorize(instance, patterns):
+    '''
+    report id and the feature vector of one (report id, accession, text)
+    instance along with the vector creation path it took, for each target test
+    (or only for the tests in an optional fourth element; see vector_cache.py)
+    '''
+    report_id, pathnum, text = instance[:3]
+    if len(instance) > 3:
+        patterns = dict(patterns, targets=collections.OrderedDict((test_name, \
+            patterns['targets'][test_name]) for test_name in instance[3]))
+    return report_id, make_test_vectors(text, pathnum, patterns)
+
+
+def format_vector(report_id, vector):
+    '''
+    tab delimited report id followed by feature/count pairs
+    '''
+    return report_id + ''.join('\t{}\t{}'.format(k, v) for k, v in vector.items()) + '\n'
+
+
+def report_progress(num_processed, begin):
+    '''
+    print the number of reports processed so far and the throughput
+    '''
+    seconds = max((datetime.today() - begin).total_seconds(), 0.001)
+    print ('{} reports processed in {:.0f} seconds ({:.1f} reports per second)'.format(\
+        num_processed, seconds, num_processed / seconds))
+
+
+def parallel_vectors(instances, num_workers, test_names, prune_batch=None, sources=None):
+    '''
+    vectorize instances in chunks across a process pool; each worker
+    compiles the patterns once, and a bounded number of chunks are in 
+    flight at a time so results can be yielded in input order
+    the pattern sources are looked up once (here, unless given) and handed
+    to the workers
+    '''
+    pool = multiprocessing.Pool(num_workers, initializer=init_worker, \
+        initargs=(test_names, prune_batch, sources or pattern_sources(test_names)))
+    try:
+        pending = collections.deque()
+        for chunk in iter(lambda: list(itertools.islice(instances, CHUNK_SIZE)), []):
+            pending.append(pool.apply_async(vectorize_chunk, (chunk,)))
+            if len(pending) >= num_workers * 2:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
+
+
+def init_worker(test_names, prune_batch=None, sources=None):
+    '''
+    compile patterns once per worker process
+    '''
+    global WORKER_PATTERNS
+    WORKER_PATTERNS = prepare_patterns(test_names, prune_batch, sources)
+
+
+def vectorize_chunk(chunk):
+    '''
+    vectorize a list of instances in a worker process
+    '''
+    return [vectorize(instance, WORKER_PATTERNS) for instance in chunk]
+
+
+def make_test_vectors(text, pathnum, patterns):
+    '''
+    (dictionary of feature counts, path) for each target test of a single report
+    reports without a mention of a test can't have window features for it,
+    so they skip the n-gram text munging ("standardized") and, when nothing
+    in the raw text can produce an accession or insufficient feature, the
+    text standardization as well ("minimal"); this keyword free vector does
+    not depend on the test, so it is created once and shared by every test
+    the report doesn't mention
+    '''
+    # cytometry check
+    cyto = int(get_cyto(text))
+    literal_instance = 'TEST_INSTANCE' in text.upper()
+    keyword_free = None
+    results = []
+    for test_name, target in patterns['targets'].items():
+        if literal_instance or combined_patterns.tree_matches(target['prescreen'], text):
+            results.append((make_vector(text, pathnum, patterns, test_name, cyto), 'full'))
+        else:
+            if keyword_free is None:
+                keyword_free = make_keyword_free_vector(text, pathnum, patterns, cyto)
+            results.append(keyword_free)
+    if patterns.get('ngram_vocabulary'):
+        features = patterns['ngram_vocabulary']['features']
+        results = [(prune_vector(vector, features), path) for vector, path in results]
+    return results
+
+
+def make_keyword_free_vector(text, pathnum, patterns, cyto):
+    '''
+    feature vector (and path) for a report that doesn't mention the test
+    '''
+    vector = {'CYTO_RELATED_REPORT': cyto}
+    # standardization inserts no digits or insufficient language, so
+    # without them in the raw text these features can only be zero; the
+    # words alone are enough to go through standardization, since its
+    # cushions rewrite the characters around them (e.g. "insufficient\nWould"
+    # becomes "insufficient HYPOTHETICAL", which get_insufficient matches)
+    if not re.search(ACC_NUM_DIGITS, text) and not re.search('insufficient|technical', text, re.IGNORECASE):
+        vector['OTHER_ACC_NUM_IN_TEXT'] = 0
+        vector['INSUFFICIENT'] = 0
+        path = 'minimal'
+    else:
+        text, vector = add_standardized_features(text, pathnum, patterns, vector)
+        path = 'standardized'
+    vector['COUNT_TEST_INSTANCE'] = 0
+    vector['NO_KEYWORD_IN_TEXT'] = 1
+    return vector, path
+
+
+def add_standardized_features(text, pathnum, patterns, vector):
+    '''
+    standardize the text and add the (other) accession number
+    and insufficient features computed on the standardized text
+    '''
+    # standardize all mentions of other test names in the text 
+    text = standardize_text(patterns['trees'], text)
+    
+    ## get reference to other path accession feature
+    other_acc_num, text = get_other_acc_num(text, pathnum)
+    vector['OTHER_ACC_NUM_IN_TEXT'] = vector.get('OTHER_ACC_NUM_IN_TEXT', 0) + int(other_acc_num)
+    # general check for language about technical difficulties
+    vector['INSUFFICIENT'] = vector.get('INSUFFICIENT', 0) + int(get_insufficient(text))
+    return text, vector
+
+
+def make_vector(text, pathnum, patterns, test_name, cyto):
+    '''
+    dictionary of feature counts for a report that mentions the test
+    '''
+    # dictionary of feature counts for models
+    vector = {} 
+    
+    # cytometry check
+    vector['CYTO_RELATED_REPORT'] = cyto
+    # standardize test instance
+    text, vector = strip_test_name(patterns['targets'][test_name]['test_instance'], text, \
+        vector)
+    text, vector = add_standardized_features(text, pathnum, patterns, vector)
+    text = ngram_tokens(text)
+    if patterns.get('ngram_vocabulary'):
+        vector = make_pruned_ngrams(text, vector, test_name, patterns['ngram_vocabulary'])
+    else:
+        vector = make_ngrams(text, vector, test_name)                  
    
+    vector['COUNT_TEST_INSTANCE'] = text.count('TEST_INSTANCE')
+    if not vector['COUNT_TEST_INSTANCE']:
+        vector['NO_KEYWORD_IN_TEXT'] = 1    
+    return vector
+   
+
+def ngram_tokens(text):
+    '''
+    tokens of the standardized text that the n-grams are made from
+    '''
+    ## condense some duplicate standardizations    
+    for string in ['OTHER_TEST','PUBLICATION','TEST_INSTANCE','IHC',
+        'PATHOLOGIST','BLOCK_ACC', 'SPECIFIC_MUT','MUT_ANALYSIS',
+        'FISH','AUTHOR']:
+        text = re.sub(string + r'[,.\(\):\-;andor' + string + \
+            ' ]{1,}' + string, ' ' + string + ' ', text)
+    
+    # condense coordinated test instance 
+    # (eg test 1 and test 2 are pending) 
+    # we dont want to break on test2
+    text = re.sub('TEST_INSTANCE[,.\(\):\-;andor ]{1,}OTHER_TEST', 'TEST_INSTANCE', text)
+    # strip out punctuation at the last minute for skipgram features 
+    text = re.sub('[0-9]{2}[\-\\\/][0-9]{2}[\-\\\/][0-9]{2,5}',' DATE ',text)    
+    text = re.sub('($|\s)[A-H][\)]?[.]',' SPECIMEN_LABEL', text)
+    text = re.sub('[\"\(\\\)\-\/\']', ' ', text)                
+    text = re.sub('[.,;:\?]', ' PUNCTUATION ', text)
+    text = text.replace('[', ' ').replace(']', ' ')
+    
+    # strip out long trails of  ____ - 
+    # there ARE single underscores IN the standardized features
+    text = re.sub('_{2,}',' ', text)
+    text = text.upper()
+    # twice through to capture SOME MORE of the coordinations
+    text = re.sub(STOP_LIST,' ', text)
+    text = re.sub(STOP_LIST,' ', text)  
+    text = text.split()  
+    return text
+
 
 def strip_test_name(regex, text, vector):
     '''
@@ -161,31 +617,128 @@ def strip_test_name(regex, text, vector):
     so that the model can be applied to all
     '''
     for expression in regex:
-        # the '+' get lost in the [\W] buffer around tests - pull them out 
-        # not pulling out '-', since it's ambiguous; minus or just a dash?
-        # strips off the "cushion" from the end of the test instance pattern
-        if re.search(expression.pattern[:-5] + '[\s]*[\+]',text):
-            vector['post_window=POSITIVE'] = vector.get('post_window=POSITIVE',0) + 1
-            vector['post_window=TEST_INSTANCE_POSITIVE'] = \
-                vector.get('post_window=TEST_INSTANCE_POSITIVE',0) + 1
-        text = re.sub(expression, ' TEST_INSTANCE ',text)       
+        text = strip_test_pattern(expression, text, vector)
     return text, vector
 
 
+def strip_test_pattern(expression, text, vector):
+    '''
+    replace one test instance pattern (see strip_test_name)
+    '''
+    # the '+' get lost in the [\W] buffer around tests - pull them out 
+    # not pulling out '-', since it's ambiguous; minus or just a dash?
+    # strips off the "cushion" from the end of the test instance pattern
+    if re.search(expression.pattern[:-5] + '[\s]*[\+]',text):
+        vector['post_window=POSITIVE'] = vector.get('post_window=POSITIVE',0) + 1
+        vector['post_window=TEST_INSTANCE_POSITIVE'] = \
+            vector.get('post_window=TEST_INSTANCE_POSITIVE',0) + 1
+    return re.sub(expression, ' TEST_INSTANCE ',text)
+
+
 def get_other_acc_num(text, pathnum):
     '''
     attempt to acertain whether other/previous pathology reports are mentioned
+    each accession number found is classified as this report's (THIS_ACC_NUM)
+    or another report's (OTHER_ACC_NUM) and all of its occurrences are
+    replaced in a single pass over the text (see replace_acc_nums)
     '''
     other_acc_bool = False
     pathnum = pathnum.replace('-', '')
-    for acc in re.finditer('[\W]([\(]?[A-Z]{1,2}[\- ]?[\d]{2,4}[\- ]{1,3}[\d]{2,8}[\)]?)[\W]', text):
+    replacements = []
+    for acc in ACC_NUM.finditer(text):
+        # parentheses are kept in the compared number (a parenthesized number
+        # never counts as this report's), but not in the replaced text
         current_acc = re.sub('[\- ]', '', acc.group(1))
         if current_acc == pathnum:            
-            text = re.sub(re.sub('[\(\)]', '' ,acc.group(1)), ' THIS_ACC_NUM ', text)
+            replacements.append((re.sub('[\(\)]', '', acc.group(1)), ' THIS_ACC_NUM '))
         else:
-            text = re.sub(re.sub('[\(\)]', '', acc.group(1)), ' OTHER_ACC_NUM ', text)
+            replacements.append((re.sub('[\(\)]', '', acc.group(1)), ' OTHER_ACC_NUM '))
             other_acc_bool = True
+    if replacements:
+        text = replace_acc_nums(text, replacements)
     return other_acc_bool, text
+
+
+def replace_acc_nums(text, replacements):
+    '''
+    replace every occurrence of each (accession number, replacement) in order,
+    as one substitution per number over the whole text would; the first
+    replacement of a number wins, since later ones no longer find it
+    the text is rewritten in one pass, each occurrence with the replacement
+    of its number; only where the order of the substitutions can matter (a
+    number that can overlap another number or a replacement) are they done
+    one after the other, and then only within the run of characters around
+    the occurrence that numbers are made of (no occurrence, original or
+    created by a replacement, can extend past a character no number contains)
+    '''
+    first = collections.OrderedDict()
+    for number, replacement in replacements:
+        first.setdefault(number, replacement)
+    numbers = re.compile('|'.join(re.escape(number) for number in first))
+    # numbers whose occurrences can overlap (or be made by) one another or a replacement
+    interacting = overlapping(list(first) + ACC_NUM_REPLACEMENTS) - set(ACC_NUM_REPLACEMENTS)
+    if not interacting:
+        return numbers.sub(lambda match: first[match.group(0)], text)
+    # numbers that a replacement can make (or run into)
+    joining = set(number for number in interacting \
+        if number in overlapping([number] + ACC_NUM_REPLACEMENTS))
+    order = collections.defaultdict(list)
+    for i, (number, replacement) in enumerate(replacements):
+        order[number].append(i)
+    alphabet = ''.join(sorted(set(''.join(first))))
+    run_end = re.compile('[' + re.escape(alphabet) + ']*')
+    pieces = []
+    done = 0
+    for match in numbers.finditer(text):
+        if match.start() < done:
+            continue
+        # the run of number characters around the occurrence
+        start = match.start()
+        while start > done and text[start - 1] in alphabet:
+            start -= 1
+        end = run_end.match(text, match.end()).end()
+        run = text[start:end]
+        found = set(number.group(0) for number in numbers.finditer(run))
+        if not joining and not found & interacting:
+            run = numbers.sub(lambda number: first[number.group(0)], run)
+        else:
+            # (numbers that aren't in the run and can't be made in it don't change it)
+            for i in sorted(i for number in found | interacting for i in order[number]):
+                run = run.replace(*replacements[i])
+        pieces.extend([text[done:start], run])
+        done = end
+    pieces.append(text[done:])
+    return ''.join(pieces)
+
+
+def overlapping(strings):
+    '''
+    the strings whose occurrences can overlap those of another (distinct)
+    string; one starting inside the other, or one inside the other
+    for each position of each string that some string starts with, look
+    for the strings that start with the rest (binary search in sorted order)
+    or that the rest starts with (one lookup per string length)
+    '''
+    ordered = sorted(set(strings))
+    members = set(ordered)
+    starts = set(string[0] for string in ordered)
+    lengths = set(len(string) for string in ordered)
+    found = set()
+    for string in ordered:
+        for i in range(len(string)):
+            if string[i] not in starts:
+                continue
+            rest = string[i:]
+            q = bisect.bisect_left(ordered, rest)
+            while q < len(ordered) and ordered[q].startswith(rest):
+                # (a string overlapping itself doesn't matter)
+                if ordered[q] != string:
+                    found.update([string, ordered[q]])
+                q += 1
+            for l in lengths:
+                if (l < len(rest) or (i > 0 and l == len(rest))) and rest[:l] in members:
+                    found.update([string, rest[:l]])
+    return found
     
 
 def get_insufficient(text):
@@ -226,95 +779,250 @@ def make_standardized_text(compiled_test_patterns, text, compiled_other_patterns
         for standardization,regex in compiled_other_patterns.items():
             text = regex_sub(regex, standardization, text)
     return text
+
+
+def standardize_text(pattern_trees, text):
+    '''
+    single pass equivalent of make_standardized_text; each category is 
+    scanned once with its combined pattern tree and only the patterns 
+    that actually match are substituted
+    '''
+    ## same two passes as make_standardized_text (overlapping patterns)
+    for i in range(2):
+        for tree in pattern_trees:
+            text = combined_patterns.apply_pattern_tree(tree, text)
+    return text
     
-def make_ngrams(text, vector):
-    '''
-    loop through tokens to look for windows around test instances
-    create unigrams, bigrams, and skipgrams
-    '''
-    for v in range(len(text)):
-        current = text[v]                          
-        if current == 'TEST_INSTANCE':
-            try:
-                ## find the first and closest second section to the test instance
-                reversed_snippet = [text[b] for b in range(v-1, -1, -1)]
-                if '_SECTION_' in reversed_snippet:
-                    section = reversed_snippet[reversed_snippet.index('_SECTION_') - 1]
-                    vector['SECTION='+section] = vector.get('SECTION='+section,0) + 1
-            except IndexError:
-                pass                        
-            
-            # include standardized test name in feature set
-            vector[TEST_NAME] = 1
-            # create window around test mention without extending
-            # beyohnd beginning or end of full text
-            pre_window_index = max(v - PRE_WINDOW,0)                           
-            post_window_index = min(len(text), v + POST_WINDOW)                            
-            window = text[pre_window_index:post_window_index]
-            
-            # break window size for new sections or other tests, etc
-            breaks = [i for i in range(len(window)) if \
-            (window[i] == "_SECTION_" or window[i] == "PUNCTUATION" \
-             or  window[i] == "SPECIMEN_LABEL" or window[i] == "OTHER_TEST")]                                        
-            breaks.append(0)                            
-            pre_break = max([x + 1 for x in breaks if x < len(window)/ 2])
-            breaks[-1] = len(window)    
-            post_break = min([x for x in breaks if x > len(window)/ 2])                          
-            window = text[pre_window_index + pre_break:pre_window_index + post_break]
-            post_window_index = post_break + pre_window_index
-            pre_window_index = pre_break + pre_window_index
+def test_instance_windows(text):
+    '''
+    loop through tokens to look for windows around test instances;
+    yields (token index, preceding section or None, pre window index,
+    post window index) for each TEST_INSTANCE
+    the nearest section header and the break positions come from a
+    single forward pass (see window_index), so each window is found with
+    a binary search instead of rescanning the text before the mention
+    '''
+    breaks, instances = window_index(text)
+    for v, section_index in instances:
+        section = None
+        if section_index is not None:
+            ## the token after the closest preceding section; the first token of
+            ## the text if the section is right before the test instance
+            ## (as indexing the reversed text with -1 did)
+            section = text[section_index + 1] if section_index < v - 1 else text[0]
+
+        # create window around test mention without extending
+        # beyohnd beginning or end of full text
+        pre_window_index = max(v - PRE_WINDOW,0)
+        post_window_index = min(len(text), v + POST_WINDOW)
+        middle = pre_window_index + (post_window_index - pre_window_index) / 2.0
+
+        # break window size for new sections or other tests, etc; the last break
+        # before the middle of the window (at least one token in) and the first
+        # one after it (or the end of the window)
+        i = bisect.bisect_left(breaks, middle)
+        pre_break = 1
+        if i > 0 and breaks[i - 1] >= pre_window_index:
+            pre_break = max(pre_break, breaks[i - 1] - pre_window_index + 1)
+        i = bisect.bisect_right(breaks, middle)
+        post_break = post_window_index - pre_window_index
+        if i < len(breaks) and breaks[i] < post_window_index:
+            post_break = breaks[i] - pre_window_index
+        post_window_index = post_break + pre_window_index
+        pre_window_index = pre_break + pre_window_index
+        yield v, section, pre_window_index, post_window_index
+
+
+def window_index(text):
+    '''
+    one forward pass over the tokens; the (sorted) positions of the window
+    breaks and (token index, index of the closest preceding section or None)
+    for each TEST_INSTANCE
+    '''
+    breaks = []
+    instances = []
+    section_index = None
+    for v, token in enumerate(text):
+        if token == 'TEST_INSTANCE':
+            instances.append((v, section_index))
+        elif token in WINDOW_BREAKS:
+            breaks.append(v)
+            if token == '_SECTION_':
+                section_index = v
+    return breaks, instances
+
+
+def make_ngrams(text, vector, test_name):
+    '''
+    create unigrams, bigrams, and skipgrams in the windows around test instances
+    '''
+    for v, section, pre_window_index, post_window_index in test_instance_windows(text):
+        if section is not None:
+            vector['SECTION='+section] = vector.get('SECTION='+section,0) + 1
+        # include standardized test name in feature set
+        vector[test_name] = 1
+  
+        # move from the current token backwards for pre window features
+        pre_pointer = v-1      
+        if v > 0 and pre_pointer >= pre_window_index :\
+            vector['immediately_pre_window=' + text[pre_pointer]]=1
+        while pre_pointer >= pre_window_index:                              
+            #unigrams 
+            vector['pre_window='+text[pre_pointer]] = \
+                vector.get('pre_window=' + text[pre_pointer],0) + 1
+            if  v - 1 > pre_window_index:
+                #bigrams
+                vector['pre_window=' + text[pre_pointer-1] + '_' + \
+                    text[pre_pointer]] = vector.get('pre_window=' + \
+                    text[pre_pointer-1] + '_' + text[pre_pointer],0) + 1
+                if v - 2 > pre_window_index:
+                    #one skipgram                                  
+                    vector['pre_window=' + text[pre_pointer-2] + \
+                        '_' + text[pre_pointer]] = \
+                        vector.get('pre_window=' + text[pre_pointer-2] + \
+                        '_' + text[pre_pointer],0) +1
+                    if v - 3 > pre_window_index:
+                        #two skipgram
+                        vector['pre_window=' + text[pre_pointer-3] + \
+                            '_' + text[pre_pointer]] = vector.get('pre_window=' + \
+                            text[pre_pointer-3] +'_' + text[pre_pointer], 0) + 1 
+            pre_pointer -= 1
+        
       
-            # move from the current token backwards for pre window features
-            pre_pointer = v-1      
-            if v > 0 and pre_pointer >= pre_window_index :\
-                vector['immediately_pre_window=' + text[pre_pointer]]=1
-            while pre_pointer >= pre_window_index:                              
-                #unigrams 
-                vector['pre_window='+text[pre_pointer]] = \
-                    vector.get('pre_window=' + text[pre_pointer],0) + 1
-                if  v - 1 > pre_window_index:
-                    #bigrams
-                    vector['pre_window=' + text[pre_pointer-1] + '_' + \
-                        text[pre_pointer]] = vector.get('pre_window=' + \
-                        text[pre_pointer-1] + '_' + text[pre_pointer],0) + 1
-                    if v - 2 > pre_window_index:
-                        #one skipgram                                  
-                        vector['pre_window=' + text[pre_pointer-2] + \
-                            '_' + text[pre_pointer]] = \
-                            vector.get('pre_window=' + text[pre_pointer-2] + \
-                            '_' + text[pre_pointer],0) +1
-                        if v - 3 > pre_window_index:
-                            #two skipgram
-                            vector['pre_window=' + text[pre_pointer-3] + \
-                                '_' + text[pre_pointer]] = vector.get('pre_window=' + \
-                                text[pre_pointer-3] +'_' + text[pre_pointer], 0) + 1 
-                pre_pointer -= 1
-            
-          
-            ## move from the current token forwards for post window features
-            post = v+1
-            if post < len(text) and post < post_window_index: vector['immediately_post_window=' + text[post]] = 1
-            while post < min(len(text) ,post_window_index):                                   
-                #unigrams                                                                    
-                vector['post_window=' + text[post]] = vector.get('post_window=' + text[post], 0) + 1
-                if  post < post_window_index - 1:
-                    #bigrams
-                    vector['post_window='+text[post]+'_'+text[post+1]] = vector.get('post_window='+text[post]+'_'+text[post+1],0)+1
-                    if post < post_window_index - 2:
-                        #one skipgram
-                        vector['post_window='+text[post]+'_'+text[post+2]]= vector.get('post_window='+text[post]+'_'+text[post+2],0)+1
-                        if post < post_window_index - 3:
-                            #two skipgram
-                            vector['post_window='+text[post]+'_'+text[post+3]] = vector.get('post_window='+text[post]+'_'+text[post+3],0)+1
-                post+=1 
+        ## move from the current token forwards for post window features
+        post = v+1
+        if post < len(text) and post < post_window_index: vector['immediately_post_window=' + text[post]] = 1
+        while post < min(len(text) ,post_window_index):                                   
+            #unigrams                                                                    
+            vector['post_window=' + text[post]] = vector.get('post_window=' + text[post], 0) + 1
+            if  post < post_window_index - 1:
+                #bigrams
+                vector['post_window='+text[post]+'_'+text[post+1]] = vector.get('post_window='+text[post]+'_'+text[post+1],0)+1
+                if post < post_window_index - 2:
+                    #one skipgram
+                    vector['post_window='+text[post]+'_'+text[post+2]]= vector.get('post_window='+text[post]+'_'+text[post+2],0)+1
+                    if post < post_window_index - 3:
+                        #two skipgram
+                        vector['post_window='+text[post]+'_'+text[post+3]] = vector.get('post_window='+text[post]+'_'+text[post+3],0)+1
+            post+=1 
+    return vector
+
+
+def make_pruned_ngrams(text, vector, test_name, ngram_vocabulary):
+    '''
+    make_ngrams restricted to the features in an ngram vocabulary (see
+    make_ngram_vocabulary); the tokens of each window are mapped to integer
+    ids and the window features are looked up by id instead of concatenated,
+    so features the models don't use are never built; the features that are
+    kept are added in the same order as make_ngrams would add them
+    '''
+    features = ngram_vocabulary['features']
+    token_id = ngram_vocabulary['tokens'].get
+    num_tokens = ngram_vocabulary['num_tokens']
+    unigrams = ngram_vocabulary['unigrams']
+    pre_unigrams = unigrams['pre_window=']
+    post_unigrams = unigrams['post_window=']
+    pre_pairs = ngram_vocabulary['pairs']['pre_window=']
+    post_pairs = ngram_vocabulary['pairs']['post_window=']
+    pre_anchors = ngram_vocabulary['anchors']['pre_window=']
+    post_anchors = ngram_vocabulary['anchors']['post_window=']
+    for v, section, pre_window_index, post_window_index in test_instance_windows(text):
+        # ids of the window tokens (and the skipgram tokens before it);
+        # ids[i - start] is the id of text[i]
+        # (make_ngrams wraps around to the end of the text for skipgrams
+        # at the start of the text, so ids can start at a negative index)
+        # (breaks can put the pre window index past the test instance)
+        start = min(pre_window_index, v + 1) - 3
+        ids = [-1] * max(0, -len(text) - start) + [token_id(text[i], -1) for i in \
+            range(max(start, -len(text)), max(post_window_index, v + 1))]
+        if section is not None and 'SECTION='+section in features:
+            vector['SECTION='+section] = vector.get('SECTION='+section,0) + 1
+        if test_name in features:
+            vector[test_name] = 1
+
+        # pre window; bigram, one and two skipgrams (as far as the window allows)
+        pre_pointer = v-1
+        if v > 0 and pre_pointer >= pre_window_index:
+            feature = unigrams['immediately_pre_window='].get(ids[pre_pointer-start])
+            if feature:
+                vector[feature] = 1
+        max_skip = min(3, v - 1 - pre_window_index)
+        while pre_pointer >= pre_window_index:
+            token = ids[pre_pointer-start]
+            if token >= 0:
+                feature = pre_unigrams.get(token)
+                if feature:
+                    vector[feature] = vector.get(feature, 0) + 1
+                for k in range(1, max_skip + 1 if token in pre_anchors else 1):
+                    if ids[pre_pointer-k-start] >= 0:
+                        feature = pre_pairs.get(ids[pre_pointer-k-start] * num_tokens + token)
+                        if feature:
+                            vector[feature] = vector.get(feature, 0) + 1
+            pre_pointer -= 1
+
+        # post window
+        post = v+1
+        if post < len(text) and post < post_window_index:
+            feature = unigrams['immediately_post_window='].get(ids[post-start])
+            if feature:
+                vector[feature] = 1
+        while post < min(len(text), post_window_index):
+            token = ids[post-start]
+            if token >= 0:
+                feature = post_unigrams.get(token)
+                if feature:
+                    vector[feature] = vector.get(feature, 0) + 1
+                for k in range(1, min(3, post_window_index - 1 - post) + 1 if token in post_anchors else 1):
+                    if ids[post+k-start] >= 0:
+                        feature = post_pairs.get(token * num_tokens + ids[post+k-start])
+                        if feature:
+                            vector[feature] = vector.get(feature, 0) + 1
+            post += 1
     return vector
 
 if __name__ == '__main__':
     ## timeit variable for performance testing ##
+    parser = argparse.ArgumentParser(description='create feature vectors from pathology reports')
+    parser.add_argument('--input', default=INSTANCES_FILE, \
+        help='tab delimited instances file; "-" for stdin, .gz files are decompressed')
+    parser.add_argument('--tests', nargs='+', default=[TEST_NAME], \
+        help='tests to create feature vectors for (keys in test_patterns.json)')
+    parser.add_argument('--output', help='feature vector output file (single test only)')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, \
+        help='directory for the <TEST>_feature_vectors.txt files')
+    parser.add_argument('--report-id-col', default=REPORT_ID_COL, help='column index or header name')
+    parser.add_argument('--acc-num-col', default=ACC_NUM_COL, help='column index or header name')
+    parser.add_argument('--text-col', default=TEXT_COL, help='column index or header name')
+    parser.add_argument('--encoding', default=INSTANCES_ENCODING, help='encoding of the instances file')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, \
+        help='number of worker processes (default: single process)')
+    parser.add_argument('--format', choices=['text', 'binary'], default='text', \
+        help='text feature vector files or binary feature stores (see feature_store.py)')
+    parser.add_argument('--prune-batch', \
+        help='training batch whose model feature mappings the features are pruned to (e.g. IR_10469)')
+    parser.add_argument('--cache', help='vector cache file (see vector_cache.py), e.g. Input/vector_cache.sqlite')
+    parser.add_argument('--cache-max-mb', type=int, default=vector_cache.MAX_BYTES // 2 ** 20, \
+        help='size limit of the vector cache; least recently used vectors are evicted')
+    parser.add_argument('--no-index', action='store_true', \
+        help="don't write the report id index next to the feature vectors (see report_index.py)")
+    parser.add_argument('--profile', \
+        help='write per pattern hit counts and times to this json (or .csv) report (see profiling.py)')
+    args = parser.parse_args()
+    if args.profile:
+        import profiling
+        profiling.enable(sys.modules[__name__])
+        if args.workers > 1:
+            print ('profiling runs in a single process; ignoring --workers')
+            args.workers = 1
     BEGIN = datetime.today()
     print ('vector creation started at {}'.format(BEGIN))
-    vector_creation()
+    vector_creation(args.workers, args.input, args.output, \
+        (args.report_id_col, args.acc_num_col, args.text_col), args.encoding, \
+        args.tests, args.output_dir, args.format, args.prune_batch, args.cache, args.cache_max_mb * 2 ** 20, \
+        not args.no_index)
     ## timeit - print out the amount of time it took to process all the reports ##
     print ('{} seconds to create vectors'.format((datetime.today()-BEGIN).days * 86400 + \
         (datetime.today()-BEGIN).seconds))
-
+    if args.profile:
+        profiling.PROFILE.summary()
+        profiling.PROFILE.write(args.profile)
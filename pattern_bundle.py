@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+precompiled pattern bundle; the three Resources/*.json pattern files are
+validated and expanded once (cushions, uppercased duplicates and the
+combined alternations of combined_patterns.py) into a versioned json bundle
+that make_vectors.prepare_patterns loads instead of rebuilding every pattern
+from the json on each run
+the bundle records a hash of each pattern file, of combined_patterns.py and
+of the make_vectors functions that build the sources, so it is ignored, and
+the patterns built from the json files, as soon as any of them changes
+python can't keep compiled regular expressions between runs (a pickled
+pattern is compiled again from its source), so the bundle only saves
+reading, expanding and checking the json; the patterns themselves are
+compiled lazily (see combined_patterns.LazyPattern), which is where most of
+the start up time goes
+usage:
+    python pattern_bundle.py build      (after editing Resources/*.json)
+    python pattern_bundle.py check      (validate the json files)
+'''
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import combined_patterns
+
+# bundle file in the resource directory; None skips the bundle
+BUNDLE_FILE = 'patterns.bundle'
+# bump when the layout of the bundle changes
+BUNDLE_VERSION = 1
+# make_vectors functions that build the bundled sources (cushions, uppercasing)
+SOURCE_FUNCTIONS = ['compile_patterns', 'tree_sources', 'bundle_sources']
+# pattern files and whether their patterns are also compiled uppercased
+RESOURCE_FILES = [('test_patterns.json', True), ('section_patterns.json', True), \
+    ('other_keyword_patterns.json', False)]
+# a lowercase escape (\w, \s, \d, \b...) turns into its opposite when uppercased
+LOWERCASE_ESCAPE = re.compile(r'\\[a-z]')
+# back references and named groups don't survive the combined alternations
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P[<=]')
+# bundles already reported as out of date (once per process)
+STALE_WARNED = set()
+
+
+def file_hash(path):
+    return hashlib.sha256(open(path, 'rb').read()).hexdigest()
+
+
+def function_source(function):
+    '''
+    source of a module level function; its lines up to the next unindented
+    line (inspect.getsource without importing inspect, which is slow to import)
+    '''
+    lines = open(function.__code__.co_filename, 'r').read().split('\n')
+    start = end = function.__code__.co_firstlineno - 1
+    end += 1
+    while end < len(lines) and (not lines[end] or lines[end][0] in ' \t'):
+        end += 1
+    return '\n'.join(lines[start:end]).rstrip()
+
+
+def fingerprint(resource_dir):
+    '''
+    what a bundle is built from; the hash of each pattern file, of the
+    combined pattern builder and of the SOURCE_FUNCTIONS of make_vectors,
+    the branching and the bundle version
+    '''
+    import make_vectors
+    return {'version': BUNDLE_VERSION, 'branching': combined_patterns.BRANCHING, \
+        'builder': file_hash(os.path.splitext(combined_patterns.__file__)[0] + '.py'), \
+        'sources': hashlib.sha256('\n'.join(function_source(getattr(make_vectors, f)) \
+            for f in SOURCE_FUNCTIONS).encode('utf-8')).hexdigest(), \
+        'resources': dict((f, file_hash(resource_dir + os.sep + f)) for f, uppercase in RESOURCE_FILES)}
+
+
+def validate(resource_dir):
+    '''
+    problems with the pattern files; each has to be a json object of lists
+    of patterns that compile (uppercased too, where they are uppercased),
+    without back references or named groups
+    '''
+    problems = []
+    for f, uppercase in RESOURCE_FILES:
+        try:
+            patterns = json.load(open(resource_dir + os.sep + f, 'r'))
+        except (IOError, ValueError) as e:
+            problems.append('{}: {}'.format(f, e))
+            continue
+        if not isinstance(patterns, dict):
+            problems.append('{}: not a json object of pattern lists'.format(f))
+            continue
+        for key, val in patterns.items():
+            if not isinstance(val, list) or not val or not all(isinstance(each, str) for each in val):
+                problems.append('{} "{}": not a (non empty) list of patterns'.format(f, key))
+                continue
+            for each in val:
+                for variant in ([each, each.upper()] if uppercase else [each]):
+                    try:
+                        re.compile('(' + variant + ')', re.MULTILINE)
+                    except re.error as e:
+                        problems.append('{} "{}": {} does not compile ({})'.format(f, key, variant, e))
+                if uppercase and LOWERCASE_ESCAPE.search(each):
+                    problems.append('{} "{}": {} is uppercased, which changes its escapes'.format(f, key, each))
+                if GROUP_REFERENCE.search(each):
+                    problems.append('{} "{}": {} has a back reference or named group'.format(f, key, each))
+    return problems
+
+
+def bundle_path(resource_dir):
+    return resource_dir + os.sep + BUNDLE_FILE
+
+
+def build_bundle(resource_dir):
+    '''
+    validate the pattern files and write the bundle (every pattern and
+    combined alternation in it is compiled once to check it)
+    '''
+    import make_vectors
+    problems = validate(resource_dir)
+    if problems:
+        raise ValueError('invalid pattern resources:\n  ' + '\n  '.join(problems))
+    test_patterns, section_patterns, other_patterns = [json.load(open(resource_dir + os.sep + f, 'r')) \
+        for f, uppercase in RESOURCE_FILES]
+    bundle = make_vectors.bundle_sources(test_patterns, other_patterns, section_patterns)
+    for tree in bundle['trees'] + [target['prescreen'] for target in bundle['targets'].values()]:
+        combined_patterns.compile_tree(tree)
+    bundle.update(fingerprint(resource_dir))
+    with open(bundle_path(resource_dir) + '.tmp', 'w') as out:
+        json.dump(bundle, out)
+    os.replace(bundle_path(resource_dir) + '.tmp', bundle_path(resource_dir))
+    return bundle
+
+
+def load_bundle(resource_dir):
+    '''
+    the bundled pattern sources (see make_vectors.bundle_sources), or None
+    if there is no bundle or it wasn't built from the current pattern files
+    '''
+    if BUNDLE_FILE is None or not os.path.exists(bundle_path(resource_dir)):
+        return None
+    try:
+        bundle = json.load(open(bundle_path(resource_dir), 'r'))
+    except ValueError:
+        bundle = {}
+    if any(bundle.get(k) != v for k, v in fingerprint(resource_dir).items()):
+        if bundle_path(resource_dir) not in STALE_WARNED:
+            STALE_WARNED.add(bundle_path(resource_dir))
+            print ('{} is out of date; patterns are built from the json resources until it is rebuilt ' \
+                '(python pattern_bundle.py build)'.format(bundle_path(resource_dir)))
+        return None
+    return bundle
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='validate the pattern resources and build the pattern bundle')
+    parser.add_argument('command', choices=['build', 'check'])
+    parser.add_argument('--resources', default='Resources', help='pattern resource directory')
+    args = parser.parse_args()
+    problems = validate(args.resources)
+    for problem in problems:
+        print ('ERR: ' + problem)
+    if problems:
+        sys.exit(1)
+    if args.command == 'build':
+        bundle = build_bundle(args.resources)
+        print ('{}: {} standardization trees, {} tests'.format(bundle_path(args.resources), \
+            len(bundle['trees']), len(bundle['targets'])))
+    else:
+        print ('{} pattern files are valid'.format(len(RESOURCE_FILES)))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+opt in profiling of vector creation and the classification pipeline;
+hit counts and time of every compiled pattern in the text standardization
+(standardize_text, the combined pattern version of make_standardized_text)
+and in strip_test_name, the time of the vector creation steps, and the
+stage timings of svm_pipeline.run_pipeline, written as a json or csv report
+nothing is instrumented until enable() swaps the instrumented versions of
+those functions into their modules, so without it the code runs unchanged
+usage:
+    python make_vectors.py --profile vector_profile.json (or .csv)
+    python svm_pipeline.py --profile pipeline_profile.json
+'''
+import csv
+import functools
+import json
+import os
+import time
+import combined_patterns
+
+# pattern resources of the text standardization with their uppercasing
+# and "cushions" (as in make_vectors.make_pattern_trees)
+STANDARDIZATION_RESOURCES = [('test_patterns.json', True, '[\W\^]', '[\W$]'), \
+    ('section_patterns.json', True, '^', '$'), ('other_keyword_patterns.json', False, '[\W\^]', '[\W$]')]
+# vector creation steps timed per call (calls can be nested, so their times overlap)
+TIMED_FUNCTIONS = ['make_test_vectors', 'make_vector', 'make_keyword_free_vector', \
+    'standardize_text', 'strip_test_name', 'get_other_acc_num', 'get_insufficient', 'get_cyto', \
+    'ngram_tokens', 'make_ngrams', 'make_pruned_ngrams']
+CSV_COLUMNS = ['kind', 'stage', 'resource', 'key', 'pattern', 'calls', 'hits', 'seconds']
+
+# the active profile (None unless enable() was called)
+PROFILE = None
+
+
+class Profile(object):
+    '''
+    per pattern and per stage counters
+    '''
+    def __init__(self, sources=None):
+        # (stage, resource, key, pattern) -> [calls, hits, seconds]
+        self.patterns = {}
+        # stage -> [calls, items, seconds]
+        self.stages = {}
+        # id of a compiled pattern (or combined node) -> its row key
+        self.labels = {}
+        # standardization pattern source -> (resource, key)
+        self.sources = sources or {}
+
+    def label(self, node, stage):
+        '''
+        row key of a pattern tree node; combined nodes are labeled with the
+        resource of their first pattern and the number of patterns they cover
+        '''
+        key = self.labels.get(id(node))
+        if key is None:
+            pattern, children, first = node
+            if first is None:
+                resource, name = self.sources.get(pattern.pattern, ('', ''))
+                key = (stage, resource, name, pattern.pattern)
+            else:
+                leaf = node
+                while leaf[2] is not None:
+                    leaf = leaf[1][0]
+                resource = self.sources.get(leaf[0].pattern, ('', ''))[0]
+                key = (stage + ' (combined scan)', resource, '', 'p{}..p{}'.format(first, \
+                    first + count_leaves(node) - 1))
+            self.labels[id(node)] = key
+        return key
+
+    def add_pattern(self, key, hits, seconds):
+        counters = self.patterns.setdefault(key, [0, 0, 0.0])
+        counters[0] += 1
+        counters[1] += hits
+        counters[2] += seconds
+
+    def add_stage(self, stage, items, seconds):
+        counters = self.stages.setdefault(stage, [0, 0, 0.0])
+        counters[0] += 1
+        counters[1] += items
+        counters[2] += seconds
+
+    def rows(self):
+        '''
+        report rows; patterns (most expensive first), including the resource
+        patterns of the standardization that were never applied, then stages
+        '''
+        patterns = dict(self.patterns)
+        for source, (resource, name) in self.sources.items():
+            patterns.setdefault(('standardize_text', resource, name, source), [0, 0, 0.0])
+        rows = [dict(zip(CSV_COLUMNS, ['pattern', stage, resource, name, source, calls, hits, round(seconds, 6)])) \
+            for (stage, resource, name, source), (calls, hits, seconds) in \
+            sorted(patterns.items(), key=lambda item: (-item[1][2], item[0]))]
+        rows.extend(dict(zip(CSV_COLUMNS, ['stage', stage, '', '', '', calls, items, round(seconds, 6)])) \
+            for stage, (calls, items, seconds) in self.stages.items())
+        return rows
+
+    def write(self, report_file):
+        '''
+        csv (for a .csv file name) or json report
+        '''
+        rows = self.rows()
+        with open(report_file, 'w', newline='') as out:
+            if report_file.endswith('.csv'):
+                writer = csv.DictWriter(out, fieldnames=CSV_COLUMNS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump({'patterns': [row for row in rows if row['kind'] == 'pattern'], \
+                    'stages': dict((row['stage'], {'calls': row['calls'], 'items': row['hits'], \
+                    'seconds': row['seconds']}) for row in rows if row['kind'] == 'stage')}, \
+                    out, indent=2)
+
+    def summary(self, top=10):
+        rows = [row for row in self.rows() if row['kind'] == 'pattern' and 'combined' not in row['stage']]
+        unmatched = sum(1 for row in rows if not row['hits'])
+        print ('{} patterns, {} without a hit; most expensive:'.format(len(rows), unmatched))
+        for row in rows[:top]:
+            print ('  {:.3f} s {} hits {} {} {}'.format(row['seconds'], row['hits'], row['resource'], \
+                row['key'], row['pattern']))
+
+
+def pattern_sources(resource_dir):
+    '''
+    compiled pattern source -> (resource file, key) for the standardization patterns
+    '''
+    sources = {}
+    for resource, uppercase_boolean, cushion1, cushion2 in STANDARDIZATION_RESOURCES:
+        patterns = json.load(open(resource_dir + os.sep + resource, 'r'))
+        for key, val in patterns.items():
+            for each in val:
+                for variant in ([each, each.upper()] if uppercase_boolean else [each]):
+                    sources.setdefault(cushion1 + '(' + variant + ')' + cushion2, (resource, key))
+    return sources
+
+
+def count_leaves(node):
+    if node[2] is None:
+        return 1
+    return sum(count_leaves(child) for child in node[1])
+
+
+def profiled_apply_pattern_tree(node, text):
+    '''
+    combined_patterns.apply_pattern_tree, timing each combined scan and
+    each pattern substitution
+    '''
+    pattern, children, first = node
+    begin = time.perf_counter()
+    if first is None:
+        text, hits = pattern.subn(children, text)
+        PROFILE.add_pattern(PROFILE.label(node, 'standardize_text'), hits, time.perf_counter() - begin)
+        return text
+    found = pattern.search(text) is not None
+    PROFILE.add_pattern(PROFILE.label(node, 'standardize_text'), int(found), time.perf_counter() - begin)
+    if not found:
+        return text
+    for child in children:
+        text = profiled_apply_pattern_tree(child, text)
+    return text
+
+
+def profiled_strip_test_pattern(strip_test_pattern):
+    '''
+    make_vectors.strip_test_pattern, timing and counting each test pattern
+    '''
+    @functools.wraps(strip_test_pattern)
+    def wrapper(expression, text, vector):
+        begin = time.perf_counter()
+        stripped = strip_test_pattern(expression, text, vector)
+        seconds = time.perf_counter() - begin
+        key = PROFILE.labels.get(id(expression))
+        if key is None:
+            resource, name = PROFILE.sources.get(expression.pattern, ('test_patterns.json', ''))
+            key = PROFILE.labels[id(expression)] = ('strip_test_name', resource, name, expression.pattern)
+        PROFILE.add_pattern(key, len(expression.findall(text)) if stripped != text else 0, seconds)
+        return stripped
+    return wrapper
+
+
+def timed(stage, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        begin = time.perf_counter()
+        result = function(*args, **kwargs)
+        PROFILE.add_stage(stage, 1, time.perf_counter() - begin)
+        return result
+    return wrapper
+
+
+def enable(make_vectors=None):
+    '''
+    start profiling; with the make_vectors module (the __main__ module when
+    make_vectors.py is run as a script), the instrumented functions are
+    swapped into it and combined_patterns (in this process only; vector
+    creation should run with a single worker), otherwise only pipeline
+    stages are recorded
+    '''
+    global PROFILE
+    if PROFILE is not None:
+        return PROFILE
+    if make_vectors is None:
+        PROFILE = Profile()
+        return PROFILE
+    PROFILE = Profile(pattern_sources(make_vectors.RESOURCE_DIR))
+    combined_patterns.apply_pattern_tree = profiled_apply_pattern_tree
+    make_vectors.strip_test_pattern = profiled_strip_test_pattern(make_vectors.strip_test_pattern)
+    for name in TIMED_FUNCTIONS:
+        setattr(make_vectors, name, timed(name, getattr(make_vectors, name)))
+    return PROFILE
+
+
+def record_stage(stage, items, seconds):
+    '''
+    add a pipeline stage timing when profiling is enabled
+    '''
+    if PROFILE is not None:
+        PROFILE.add_stage(stage, items, seconds)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+report id index of a vector creation run; make_vectors.vector_creation
+writes <TEST>_feature_vectors.txt.index next to each feature vector file,
+with the byte offset of every report in the instances file and in the
+feature vector file (the row, for a binary feature store), sorted by report id
+reports are looked up with a binary search over the memory mapped index and
+read back from the memory mapped instances and feature vector files, so a
+disputed report can be shown, re-vectorized and reclassified without
+rerunning the pipeline or searching the whole extract
+usage (from the directory with the models and Resources):
+    python report_index.py show Input/EGFR_feature_vectors.txt.index <report id> [<report id> ...]
+    python report_index.py reclassify Input/EGFR_feature_vectors.txt.index <report id> [...] [--batch IR_10469]
+'''
+import argparse
+import gzip
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from operator import itemgetter
+import final_output
+
+INDEX_SUFFIX = '.index'
+
+
+def index_file(vector_file):
+    '''
+    index next to a feature vector file (or feature store directory)
+    '''
+    return vector_file.rstrip(os.sep) + INDEX_SUFFIX
+
+
+def file_state(path):
+    '''
+    size and modification time, to tell whether a file changed since the index was written
+    '''
+    return [os.path.getsize(path), int(os.path.getmtime(path))] if path and os.path.exists(path) else None
+
+
+class IndexWriter(object):
+    '''
+    (report id, instance offset, vector offset) of each report as its vector
+    is written; the entries are sorted by report id (on disk, see
+    final_output.external_sort) when the index is closed
+    '''
+    def __init__(self, vector_file, instances_file, columns, encoding, test_name, \
+        vector_format='text', prune_batch=None, vector_encoding='utf-8'):
+        self.path = index_file(vector_file)
+        self.meta = {'test': test_name, 'instances_file': None if instances_file == '-' else \
+            os.path.abspath(instances_file), 'columns': list(columns), 'encoding': encoding, \
+            'vector_file': os.path.abspath(vector_file), 'format': vector_format, 'prune_batch': prune_batch, \
+            'vector_encoding': vector_encoding}
+        self.entries = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.position = 0
+        self.count = 0
+
+    def add(self, report_id, instance_offset, line=None):
+        '''
+        a report and its feature vector line (None for a feature store row)
+        '''
+        vector_offset = self.count if line is None else self.position
+        self.entries.write('{}\t{}\t{}\n'.format(report_id, -1 if instance_offset is None else \
+            instance_offset, vector_offset))
+        if line is not None:
+            self.position += len(line.encode(self.meta['vector_encoding']))
+        self.count += 1
+
+    def close(self):
+        self.meta.update({'reports': self.count, 'instances_state': file_state(self.meta['instances_file']), \
+            'vector_state': file_state(self.meta['vector_file']) if self.meta['format'] == 'text' else None})
+        self.entries.seek(0)
+        records = (line.rstrip('\n').split('\t') for line in self.entries)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as out:
+                out.write(json.dumps(self.meta) + '\n')
+                for record in final_output.external_sort(records, itemgetter(0), tmp_dir):
+                    out.write('\t'.join(record) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+        finally:
+            shutil.rmtree(tmp_dir)
+            self.entries.close()
+
+
+class ReportIndex(object):
+    '''
+    lookups in a report index; the index, the instances file and the
+    feature vector file are memory mapped (a .gz instances file is read
+    by seeking in the decompressed stream instead)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path, 'rb')
+        self.meta = json.loads(self.handle.readline().decode('utf-8'))
+        self.start = self.handle.tell()
+        self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.instances = None
+        self.vectors = None
+
+    def changed(self):
+        '''
+        the indexed files that changed (or disappeared) since the index was written
+        '''
+        changed = []
+        if self.meta['instances_file'] and file_state(self.meta['instances_file']) != self.meta['instances_state']:
+            changed.append(self.meta['instances_file'])
+        if self.meta['vector_state'] and file_state(self.meta['vector_file']) != self.meta['vector_state']:
+            changed.append(self.meta['vector_file'])
+        return changed
+
+    def find(self, report_id):
+        '''
+        (instance offset, vector offset) of every entry of a report id;
+        binary search for the first line of the id over the sorted lines
+        '''
+        key = report_id.encode('utf-8')
+        lo, hi = self.start, len(self.map)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = max(self.map.rfind(b'\n', self.start, mid) + 1, self.start)
+            line_end = self.map.find(b'\n', mid)
+            if self.map[line_start:self.map.find(b'\t', line_start)] < key:
+                lo = line_end + 1
+            else:
+                hi = line_start
+        entries = []
+        while lo < len(self.map):
+            line_end = self.map.find(b'\n', lo)
+            fields = self.map[lo:line_end].split(b'\t')
+            if fields[0] != key:
+                break
+            entries.append((int(fields[1]), int(fields[2])))
+            lo = line_end + 1
+        return entries
+
+    def instance(self, offset):
+        '''
+        (report id, accession, text) of the instances file row at a byte offset
+        '''
+        import make_vectors
+        if self.instances is None:
+            if self.meta['instances_file'] is None:
+                raise ValueError('the indexed vectors were made from stdin; there is no instances file to read')
+            if self.meta['instances_file'].endswith('.gz'):
+                self.instances = gzip.open(self.meta['instances_file'], 'rb')
+                header = self.instances.readline()
+            else:
+                handle = open(self.meta['instances_file'], 'rb')
+                self.instances = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                header = self.instances[:self.instances.find(b'\n') + 1]
+            self.columns = make_vectors.resolve_columns(header.decode(self.meta['encoding'], 'replace'), \
+                self.meta['columns'])
+        if isinstance(self.instances, mmap.mmap):
+            end = self.instances.find(b'\n', offset)
+            line = self.instances[offset:end if end >= 0 else len(self.instances)]
+        else:
+            self.instances.seek(offset)
+            line = self.instances.readline()
+        separate_columns = line.rstrip(b'\r\n').decode(self.meta['encoding']).split('\t')
+        report_id_col, acc_num_col, text_col = self.columns
+        return separate_columns[report_id_col], separate_columns[acc_num_col], \
+            make_vectors.clean_text(separate_columns[text_col])
+
+    def vector(self, offset):
+        '''
+        (report id, {feature: count}) stored at a vector file offset (or store row)
+        '''
+        if self.meta['format'] == 'binary':
+            import feature_store
+            if self.vectors is None:
+                self.vectors = feature_store.FeatureStore(self.meta['vector_file'])
+            names, counts = self.vectors.row(offset)
+            return self.vectors.report_ids[offset], dict(zip(names, (int(c) for c in counts)))
+        if self.vectors is None:
+            handle = open(self.meta['vector_file'], 'rb')
+            self.vectors = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = self.vectors[offset:self.vectors.find(b'\n', offset)].decode(self.meta['vector_encoding']).split('\t')
+        return fields[0], dict(zip(fields[1::2], (int(c) for c in fields[2::2])))
+
+
+def trace_vector(text, pathnum, patterns, test_name):
+    '''
+    the feature vector and vector creation path of a report (as
+    make_vectors.make_test_vectors makes them) along with the intermediate
+    texts of that path
+    '''
+    import make_vectors
+    vector, path = make_vectors.make_test_vectors(text, pathnum, patterns)[0]
+    steps = []
+    if path == 'full':
+        text, v = make_vectors.strip_test_name(patterns['targets'][test_name]['test_instance'], text, {})
+        steps.append(('test instances', text))
+    if path != 'minimal':
+        text, v = make_vectors.add_standardized_features(text, pathnum, patterns, {})
+        steps.append(('standardized', text))
+    if path == 'full':
+        steps.append(('n-gram tokens', make_vectors.ngram_tokens(text)))
+    return vector, path, steps
+
+
+def reclassify(index, report_ids, train_batch, out=sys.stdout):
+    '''
+    re-vectorize and reclassify reports by id, printing the stored and
+    the new vector, the intermediate texts and the label of every stage
+    '''
+    import make_vectors
+    import svm_pipeline
+    test_name = index.meta['test']
+    patterns = make_vectors.prepare_patterns([test_name], index.meta['prune_batch'])
+    models = svm_pipeline.load_models(train_batch)
+    for report_id in report_ids:
+        entries = index.find(report_id)
+        if not entries:
+            out.write('{}: not in {}\n'.format(report_id, index.path))
+            continue
+        for instance_offset, vector_offset in entries:
+            row_id, pathnum, text = index.instance(instance_offset)
+            stored_id, stored = index.vector(vector_offset)
+            vector, path, steps = trace_vector(text, pathnum, patterns, test_name)
+            out.write('{} ({}; instances file byte {}, vector {} {})\n'.format(report_id, test_name, \
+                instance_offset, 'row' if index.meta['format'] == 'binary' else 'byte', vector_offset))
+            out.write('  accession: {}\n  text: {}\n'.format(pathnum, text))
+            for step, step_text in steps:
+                out.write('  {} text: {}\n'.format(step, step_text))
+            out.write('  vector creation path: {}, {} features\n'.format(path, len(vector)))
+            added = sorted(set(vector) - set(stored))
+            removed = sorted(set(stored) - set(vector))
+            recounted = sorted(k for k in set(vector) & set(stored) if vector[k] != stored[k])
+            if added or removed or recounted:
+                out.write('  differs from the stored vector: new {}; gone {}; recounted {}\n'.format(\
+                    ' '.join(added) or '-', ' '.join(removed) or '-', ' '.join(recounted) or '-'))
+            else:
+                out.write('  same as the stored vector\n')
+            instances = [(report_id, list(vector.keys()))]
+            labels = svm_pipeline.run_cascade(instances, test_name, train_batch, models=models, verbose=False)
+            for algorithm in ['rule_based_reported'] + [algorithm for algorithm, label in svm_pipeline.ALGORITHM_ORDER]:
+                out.write('  {}: {}\n'.format(algorithm, labels[algorithm].get(report_id, '(not routed here)')))
+            report_labels = dict(svm_pipeline.final_report_labels([report_id], labels))
+            out.write('  final label: {}\n'.format(final_output.final_label(report_labels[report_id])))
+
+
+def show(index, report_ids, out=sys.stdout):
+    '''
+    print the instances file row and the stored vector of reports by id
+    '''
+    for report_id in report_ids:
+        entries = index.find(report_id)
+        if not entries:
+            out.write('{}: not in {}\n'.format(report_id, index.path))
+        for instance_offset, vector_offset in entries:
+            row_id, pathnum, text = index.instance(instance_offset)
+            stored_id, stored = index.vector(vector_offset)
+            out.write('{} ({})\n  accession: {}\n  text: {}\n  vector: {}\n'.format(report_id, \
+                index.meta['test'], pathnum, text, ' '.join('{}={}'.format(k, v) for k, v in stored.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='look up, re-vectorize and reclassify reports by id')
+    parser.add_argument('command', choices=['show', 'reclassify'])
+    parser.add_argument('index', help='<TEST>_feature_vectors.txt.index (written by make_vectors.py)')
+    parser.add_argument('report_ids', nargs='+')
+    parser.add_argument('--batch', default='IR_10469', help='reclassify: training batch of the models')
+    args = parser.parse_args()
+    index = ReportIndex(args.index)
+    for changed in index.changed():
+        print ('WARNING: {} changed since the index was written; offsets may be wrong'.format(changed))
+    if args.command == 'show':
+        show(index, args.report_ids)
+    else:
+        reclassify(index, args.report_ids, args.batch)
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+sharded run of vector creation and the classification cascade; the instances
+file is split into N shards by a hash of the report id, each shard is
+vectorized and classified as an independent job (by local worker processes,
+or by workers on several machines that share the work directory) and the
+shard outputs are merged into one <TEST>_final_output.txt per test, in the
+order of the instances file (the same file a single svm_pipeline.py run writes)
+every step of a shard leaves a checkpoint, so rerunning the workers only
+redoes the shards (and steps) that did not finish
+usage:
+    python shard_driver.py run --input <instances file> --shards 64 --workers 8 --work-dir shards
+    python shard_driver.py split --input <instances file> --shards 64 --work-dir /shared/shards
+    python shard_driver.py worker --work-dir /shared/shards     (on each machine, from this directory)
+    python shard_driver.py merge --work-dir /shared/shards [--output-dir final_output]
+    python shard_driver.py status --work-dir /shared/shards
+'''
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import time
+import traceback
+import zlib
+import make_vectors
+import report_index
+import svm_pipeline
+import final_output
+
+CONFIG_FILE = 'shards.json'
+INSTANCES_FILE = 'instances.txt'
+# input row number of each shard row (report id, row)
+POSITIONS_FILE = 'positions.txt'
+LOCK_FILE = 'lock'
+FAILED_FILE = 'failed.txt'
+# a shard lock older than this (seconds) is taken to be left by a worker that died
+LOCK_TIMEOUT = 24 * 3600
+
+
+def shard_dir(work_dir, shard):
+    return work_dir + os.sep + 'shard_{:04d}'.format(shard)
+
+
+def write_json(path, obj):
+    '''
+    write a json file atomically (readers never see a partial checkpoint)
+    '''
+    with open(path + '.tmp', 'w') as out:
+        json.dump(obj, out, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_config(work_dir):
+    config_file = work_dir + os.sep + CONFIG_FILE
+    if not os.path.exists(config_file):
+        raise ValueError('{} has not been split (no {})'.format(work_dir, CONFIG_FILE))
+    return json.load(open(config_file, 'r'))
+
+
+def shard_of(report_id, num_shards):
+    '''
+    shard of a report; crc32 of the report id, so it is the same on every machine
+    '''
+    return zlib.crc32(report_id.encode('utf-8')) % num_shards
+
+
+def split_instances(instances_file, num_shards, work_dir, test_names=None, train_batch=None, \
+    columns=None, encoding=make_vectors.INSTANCES_ENCODING):
+    '''
+    split the instances file into num_shards instances files (each with the
+    header row) and record the input row of every report; rows are decoded
+    as make_vectors.read_instances decodes them, and the ones it would skip
+    as malformed are left out; an existing split with the same settings is
+    kept while the input file is unchanged (size and modification time, see
+    report_index.file_state), and split again (from scratch) once it changes
+    '''
+    config = {'input': os.path.abspath(instances_file) if instances_file != '-' else '-', \
+        'shards': num_shards, 'tests': test_names or [make_vectors.TEST_NAME], \
+        'train_batch': train_batch or svm_pipeline.TRAIN_BATCH, \
+        'columns': list(columns or (make_vectors.REPORT_ID_COL, make_vectors.ACC_NUM_COL, \
+        make_vectors.TEXT_COL)), 'encoding': encoding, \
+        'input_state': report_index.file_state(instances_file) if instances_file != '-' else None}
+    if os.path.exists(work_dir + os.sep + CONFIG_FILE):
+        existing = load_config(work_dir)
+        if any(existing.get(k) != v for k, v in config.items() if k != 'input_state'):
+            raise ValueError('{} holds a different split; use a new work directory'.format(work_dir))
+        if existing.get('input_state') == config['input_state']:
+            print ('{} is already split into {} shards'.format(work_dir, num_shards))
+            return existing
+        running = [shard for shard in range(num_shards) if \
+            os.path.exists(shard_dir(work_dir, shard) + os.sep + LOCK_FILE)]
+        if running:
+            raise ValueError('{} changed since it was split, but shards {} are running'.format(\
+                instances_file, ' '.join(str(shard) for shard in running)))
+        print ('{} changed since it was split; splitting it again'.format(instances_file))
+        os.remove(work_dir + os.sep + CONFIG_FILE)
+        for shard in range(num_shards):
+            if os.path.isdir(shard_dir(work_dir, shard)):
+                shutil.rmtree(shard_dir(work_dir, shard))
+    handle = make_vectors.open_instances(instances_file)
+    header = handle.readline()
+    report_id_col, acc_num_col, text_col = make_vectors.resolve_columns(\
+        header.decode(encoding, 'replace'), config['columns'])
+    num_cols = max(report_id_col, acc_num_col, text_col) + 1
+    outs = []
+    positions = []
+    for shard in range(num_shards):
+        if not os.path.isdir(shard_dir(work_dir, shard)):
+            os.makedirs(shard_dir(work_dir, shard))
+        outs.append(open(shard_dir(work_dir, shard) + os.sep + INSTANCES_FILE, 'wb'))
+        outs[-1].write(header if header.endswith(b'\n') else header + b'\n')
+        positions.append(open(shard_dir(work_dir, shard) + os.sep + POSITIONS_FILE, 'w', encoding='utf-8'))
+    counts = {'rows': [0] * num_shards, 'malformed': 0}
+    for row, lines in enumerate(handle):
+        try:
+            separate_columns = lines.rstrip(b'\r\n').decode(encoding).split('\t')
+        except UnicodeDecodeError:
+            separate_columns = []
+        if len(separate_columns) < num_cols:
+            counts['malformed'] += 1
+            continue
+        report_id = separate_columns[report_id_col]
+        shard = shard_of(report_id, num_shards)
+        outs[shard].write(lines if lines.endswith(b'\n') else lines + b'\n')
+        positions[shard].write(report_id + '\t' + str(row) + '\n')
+        counts['rows'][shard] += 1
+    for out in outs + positions:
+        out.close()
+    if handle is not sys.stdin.buffer:
+        handle.close()
+    config.update(counts)
+    write_json(work_dir + os.sep + CONFIG_FILE, config)
+    print ('{} rows split into {} shards ({} to {} rows per shard), {} malformed rows skipped'.format(\
+        sum(counts['rows']), num_shards, min(counts['rows']), max(counts['rows']), counts['malformed']))
+    return config
+
+
+def steps(config):
+    '''
+    checkpointed steps of a shard, in order
+    '''
+    return ['vectors'] + ['classify_' + test_name for test_name in config['tests']]
+
+
+def is_done(directory, step):
+    return os.path.exists(directory + os.sep + step + '.done')
+
+
+def mark_done(directory, step, begin):
+    write_json(directory + os.sep + step + '.done', {'host': socket.gethostname(), 'pid': os.getpid(), \
+        'seconds': round(time.time() - begin, 3), 'finished': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def run_shard(work_dir, shard, config, models):
+    '''
+    vector creation and the cascade (per test) of one shard, skipping the
+    steps that already have a checkpoint
+    '''
+    directory = shard_dir(work_dir, shard)
+    if not is_done(directory, 'vectors'):
+        begin = time.time()
+        make_vectors.vector_creation(1, directory + os.sep + INSTANCES_FILE, None, config['columns'], \
+            config['encoding'], config['tests'], directory, index=False)
+        mark_done(directory, 'vectors', begin)
+    for test_name in config['tests']:
+        if is_done(directory, 'classify_' + test_name):
+            continue
+        begin = time.time()
+        instances = svm_pipeline.read_feature_vectors(make_vectors.vector_file(test_name, directory))
+        labels = svm_pipeline.run_cascade(instances, test_name, config['train_batch'], models=models, \
+            verbose=False)
+        final_output.write_final_labels(test_name, directory, \
+            svm_pipeline.final_report_labels(svm_pipeline.report_ids(instances), labels))
+        mark_done(directory, 'classify_' + test_name, begin)
+
+
+def claim(directory, lock_timeout=LOCK_TIMEOUT):
+    '''
+    take the lock of a shard (exclusive create, which also works on a shared
+    file system); a lock older than lock_timeout seconds is taken over
+    '''
+    lock = directory + os.sep + LOCK_FILE
+    for attempt in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if attempt == 0 and time.time() - os.path.getmtime(lock) > lock_timeout:
+                    os.remove(lock)
+                    continue
+            except OSError:
+                pass
+            return False
+        os.write(fd, lock_owner().encode('utf-8'))
+        os.close(fd)
+        return True
+    return False
+
+
+def lock_owner():
+    return '{} {}\n'.format(socket.gethostname(), os.getpid())
+
+
+def release(directory):
+    '''
+    remove the lock of a shard, unless another worker took it over
+    (after lock_timeout) in the meantime
+    '''
+    lock = directory + os.sep + LOCK_FILE
+    try:
+        with open(lock, 'r') as f:
+            owner = f.read()
+        if owner == lock_owner():
+            os.remove(lock)
+    except OSError:
+        pass
+
+
+def worker(work_dir, shards=None, lock_timeout=LOCK_TIMEOUT):
+    '''
+    run every unfinished shard (or the given shards) that no other worker
+    holds; a shard that fails records its traceback and is left for the
+    next run; returns the number of shards run and failed
+    '''
+    config = load_config(work_dir)
+    models = None
+    counts = {'run': 0, 'failed': 0}
+    for shard in shards if shards is not None else range(config['shards']):
+        directory = shard_dir(work_dir, shard)
+        if all(is_done(directory, step) for step in steps(config)) or not claim(directory, lock_timeout):
+            continue
+        try:
+            if models is None:
+                models = svm_pipeline.load_models(config['train_batch'])
+            print ('shard {} started on {} ({})'.format(shard, socket.gethostname(), os.getpid()))
+            run_shard(work_dir, shard, config, models)
+            if os.path.exists(directory + os.sep + FAILED_FILE):
+                os.remove(directory + os.sep + FAILED_FILE)
+            counts['run'] += 1
+        except Exception:
+            with open(directory + os.sep + FAILED_FILE, 'w') as out:
+                out.write(traceback.format_exc())
+            print ('ERR: shard {} failed (see {})'.format(shard, directory + os.sep + FAILED_FILE))
+            counts['failed'] += 1
+        finally:
+            release(directory)
+    return counts
+
+
+def run_workers(work_dir, num_workers, shards=None, lock_timeout=LOCK_TIMEOUT):
+    '''
+    num_workers local worker processes (or the current process for one)
+    '''
+    if num_workers <= 1:
+        worker(work_dir, shards, lock_timeout)
+        return
+    processes = [multiprocessing.Process(target=worker, args=(work_dir, shards, lock_timeout)) \
+        for i in range(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def shard_labels(directory, test_name):
+    '''
+    (input row, report id, label) for the final output of a shard; the
+    labels are in shard order, so the rows are increasing
+    '''
+    with open(directory + os.sep + POSITIONS_FILE, 'r', encoding='utf-8') as positions:
+        with open(directory + os.sep + test_name + '_final_output.txt', 'r') as labels:
+            for line in labels:
+                report_id, label = line.rstrip('\n').split('\t', 1)
+                # (reports the vector creation skipped have no label)
+                for position in positions:
+                    position_id, row = position.rstrip('\n').split('\t')
+                    if position_id == report_id:
+                        break
+                else:
+                    raise ValueError('report {} is not in the positions of {}'.format(report_id, directory))
+                yield int(row), report_id, label
+
+
+def merge(work_dir, output_dir=None):
+    '''
+    merge the shard outputs of each test into output_dir/<TEST>_final_output.txt
+    in input order; every shard has to be finished
+    '''
+    config = load_config(work_dir)
+    output_dir = output_dir or svm_pipeline.FINAL_OUTPUT_DIRECTORY
+    unfinished = [shard for shard in range(config['shards']) if not \
+        all(is_done(shard_dir(work_dir, shard), step) for step in steps(config))]
+    if unfinished:
+        raise ValueError('{} shards are not finished: {}'.format(len(unfinished), \
+            ' '.join(str(shard) for shard in unfinished)))
+    for test_name in config['tests']:
+        output_file = output_dir + os.sep + test_name + '_final_output.txt'
+        num_reports = 0
+        with open(output_file + '.tmp', 'w') as out:
+            for row, report_id, label in heapq.merge(*[shard_labels(shard_dir(work_dir, shard), test_name) \
+                for shard in range(config['shards'])]):
+                out.write(report_id + '\t' + label + '\n')
+                num_reports += 1
+        os.replace(output_file + '.tmp', output_file)
+        print ('{}: {} reports merged from {} shards into {}'.format(test_name, num_reports, \
+            config['shards'], output_file))
+
+
+def status(work_dir):
+    '''
+    finished, running (locked), failed and pending shards
+    '''
+    config = load_config(work_dir)
+    states = {'finished': [], 'running': [], 'failed': [], 'pending': []}
+    for shard in range(config['shards']):
+        directory = shard_dir(work_dir, shard)
+        if all(is_done(directory, step) for step in steps(config)):
+            states['finished'].append(shard)
+        elif os.path.exists(directory + os.sep + LOCK_FILE):
+            states['running'].append(shard)
+        elif os.path.exists(directory + os.sep + FAILED_FILE):
+            states['failed'].append(shard)
+        else:
+            states['pending'].append(shard)
+    for state, shards in states.items():
+        print ('{}: {}{}'.format(state, len(shards), ' (' + ' '.join(str(s) for s in shards) + ')' \
+            if shards and state != 'finished' else ''))
+    return states
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sharded vector creation and classification')
+    parser.add_argument('command', choices=['run', 'split', 'worker', 'merge', 'status'])
+    parser.add_argument('--work-dir', default='shards', help='shard directory (shared between machines)')
+    parser.add_argument('--input', default=make_vectors.INSTANCES_FILE, help='split: instances file')
+    parser.add_argument('--shards', type=int, default=16, help='split: number of shards')
+    parser.add_argument('--tests', nargs='+', default=[svm_pipeline.TEST_NAME], help='split: tests')
+    parser.add_argument('--batch', default=svm_pipeline.TRAIN_BATCH, help='split: training batch of the models')
+    parser.add_argument('--report-id-col', default=make_vectors.REPORT_ID_COL, help='split: column index or name')
+    parser.add_argument('--acc-num-col', default=make_vectors.ACC_NUM_COL, help='split: column index or name')
+    parser.add_argument('--text-col', default=make_vectors.TEXT_COL, help='split: column index or name')
+    parser.add_argument('--encoding', default=make_vectors.INSTANCES_ENCODING)
+    parser.add_argument('--workers', type=int, default=1, help='run/worker: local worker processes')
+    parser.add_argument('--only', type=int, nargs='+', help='worker: only these shards')
+    parser.add_argument('--lock-timeout', type=float, default=LOCK_TIMEOUT / 3600.0, \
+        help='worker: hours after which a shard lock is taken over')
+    parser.add_argument('--output-dir', default=svm_pipeline.FINAL_OUTPUT_DIRECTORY, help='merge: output directory')
+    args = parser.parse_args()
+    if args.command in ('run', 'split'):
+        split_instances(args.input, args.shards, args.work_dir, args.tests, args.batch, \
+            (args.report_id_col, args.acc_num_col, args.text_col), args.encoding)
+    if args.command in ('run', 'worker'):
+        run_workers(args.work_dir, args.workers, args.only, args.lock_timeout * 3600)
+    if args.command == 'run' or args.command == 'status':
+        states = status(args.work_dir)
+    if args.command == 'merge' or (args.command == 'run' and not \
+        (states['failed'] or states['pending'] or states['running'])):
+        merge(args.work_dir, args.output_dir)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+streaming classification; (report id, accession, text) reports are taken
+from any iterable (e.g. a feed of newly signed out reports), vectorized and
+run through the rule based filter and the SVM cascade in micro batches, and
+(report id, final label) is yielded as soon as the micro batch of a report
+is classified, with the same label as final_output.py
+the stages are connected by bounded queues, so a slow consumer holds back
+the vectorization, which holds back reading the input; a partial micro
+batch is classified once no report has come in for MAX_WAIT seconds
+usage:
+    python stream_pipeline.py --input <instances file> [--test EGFR] [--batch-size 64] [--output labels.txt]
+    tail -n +1 -f new_reports.txt | python stream_pipeline.py --input - --max-wait 1
+    in python:
+        for report_id, label in stream_pipeline.stream_labels(reports, 'EGFR'): ...
+        async for report_id, label in stream_pipeline.astream_labels(reports, 'EGFR'): ...
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import queue
+import sys
+import threading
+import time
+import make_vectors
+import svm_pipeline
+import final_output
+
+# reports per micro batch (the batch the cascade and decoder classify at once)
+BATCH_SIZE = 64
+# micro batches queued between stages (reports read ahead: BATCH_SIZE * MAX_PENDING)
+MAX_PENDING = 4
+# seconds a partial micro batch waits for more reports
+MAX_WAIT = 0.5
+# how often (seconds) a blocked stage checks whether the stream was closed
+POLL_INTERVAL = 0.1
+
+# end of stream marker on the queues
+END = object()
+
+
+class StreamClassifier(object):
+    '''
+    patterns and models of one test, loaded once; vectorizes and
+    classifies micro batches of reports
+    '''
+    def __init__(self, test_name=None, train_batch=None, patterns=None, models=None):
+        self.test_name = test_name or svm_pipeline.TEST_NAME
+        self.train_batch = train_batch or svm_pipeline.TRAIN_BATCH
+        self.patterns = patterns or make_vectors.prepare_patterns([self.test_name])
+        self.models = models or svm_pipeline.load_models(self.train_batch)
+
+    def vectorize(self, reports):
+        '''
+        (report id, feature names) for each (report id, accession, text, ...)
+        '''
+        vectors = []
+        for report in reports:
+            report_id, test_results = make_vectors.vectorize(report[:3], self.patterns)
+            vectors.append((report_id, list(test_results[0][0].keys())))
+        return vectors
+
+    def classify(self, vectors):
+        '''
+        (report id, final label) for each (report id, feature names)
+        '''
+        # batch positions as ids, so a report id seen twice in a batch keeps both labels
+        instances = [(str(i), features) for i, (report_id, features) in enumerate(vectors)]
+        labels = svm_pipeline.run_cascade(instances, self.test_name, self.train_batch, \
+            models=self.models, verbose=False)
+        report_labels = dict(svm_pipeline.final_report_labels(svm_pipeline.report_ids(instances), labels))
+        return [(report_id, final_output.final_label(report_labels[str(i)])) \
+            for i, (report_id, features) in enumerate(vectors)]
+
+    def classify_reports(self, reports):
+        return self.classify(self.vectorize(reports))
+
+
+def put(queue_, item, stopped):
+    '''
+    put an item on a bounded queue, giving up once stopped is set
+    '''
+    while not stopped.is_set():
+        try:
+            queue_.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_reports(reports, inbox, stopped):
+    '''
+    reader stage; reports onto the inbox, then END (or the exception)
+    '''
+    try:
+        for report in reports:
+            if not put(inbox, report, stopped):
+                return
+        put(inbox, END, stopped)
+    except Exception as e:
+        put(inbox, e, stopped)
+
+
+def micro_batches(inbox, batch_size, max_wait, stopped):
+    '''
+    lists of up to batch_size reports from the inbox; a partial batch is
+    returned once max_wait seconds pass without a new report
+    '''
+    batch = []
+    while not stopped.is_set():
+        try:
+            report = inbox.get(timeout=max_wait if batch else POLL_INTERVAL)
+        except queue.Empty:
+            if batch:
+                yield batch
+                batch = []
+            continue
+        if report is END or isinstance(report, Exception):
+            if batch:
+                yield batch
+            if isinstance(report, Exception):
+                raise report
+            return
+        batch.append(report)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+
+def vectorize_batches(classifier, inbox, vectors, batch_size, max_wait, stopped):
+    '''
+    vectorizer stage; vectorized micro batches onto the vectors queue, then END
+    '''
+    try:
+        for batch in micro_batches(inbox, batch_size, max_wait, stopped):
+            if not put(vectors, classifier.vectorize(batch), stopped):
+                return
+        put(vectors, END, stopped)
+    except Exception as e:
+        put(vectors, e, stopped)
+
+
+def stream_labels(reports, test_name=None, batch_size=BATCH_SIZE, max_pending=MAX_PENDING, \
+    max_wait=MAX_WAIT, classifier=None, train_batch=None):
+    '''
+    (report id, final label) for each (report id, accession, text) of the
+    reports iterable, in input order; reading and vectorization run in
+    threads ahead of the classification (by at most max_pending micro
+    batches of batch_size reports), which runs as the labels are consumed
+    classifier (a StreamClassifier) keeps the patterns and models across streams
+    '''
+    for labels in stream_label_batches(reports, test_name, batch_size, max_pending, max_wait, \
+        classifier, train_batch):
+        for report_id, label in labels:
+            yield report_id, label
+
+
+def stream_label_batches(reports, test_name=None, batch_size=BATCH_SIZE, max_pending=MAX_PENDING, \
+    max_wait=MAX_WAIT, classifier=None, train_batch=None):
+    '''
+    stream_labels one micro batch at a time; a list of (report id, final
+    label) per micro batch, e.g. to flush the output after each of them
+    '''
+    classifier = classifier or StreamClassifier(test_name, train_batch)
+    inbox = queue.Queue(batch_size * max_pending)
+    vectors = queue.Queue(max_pending)
+    stopped = threading.Event()
+    stages = [threading.Thread(target=read_reports, args=(reports, inbox, stopped)), \
+        threading.Thread(target=vectorize_batches, args=(classifier, inbox, vectors, batch_size, \
+        max_wait, stopped))]
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+    try:
+        while True:
+            batch = vectors.get()
+            if batch is END:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield list(classifier.classify(batch))
+    finally:
+        # (also when the consumer stops early)
+        stopped.set()
+
+
+async def aiterate(reports, executor):
+    '''
+    async iteration of an iterable (next() runs in the executor, so a
+    blocking read doesn't hold up the event loop) or of an async iterable
+    '''
+    if hasattr(reports, '__aiter__'):
+        async for report in reports:
+            yield report
+        return
+    loop = asyncio.get_running_loop()
+    iterator = iter(reports)
+    while True:
+        report = await loop.run_in_executor(executor, next, iterator, END)
+        if report is END:
+            return
+        yield report
+
+
+async def amicro_batches(reports, batch_size, max_wait):
+    '''
+    lists of up to batch_size reports from an async iterable; a partial
+    batch is yielded once max_wait seconds pass without a new report
+    '''
+    loop = asyncio.get_running_loop()
+    iterator = reports.__aiter__()
+    batch = []
+    deadline = None
+    next_report = None
+    while True:
+        if next_report is None:
+            next_report = asyncio.ensure_future(iterator.__anext__())
+        done, waiting = await asyncio.wait([next_report], \
+            timeout=max(deadline - loop.time(), 0) if batch else None)
+        if not done:
+            yield batch
+            batch = []
+            continue
+        try:
+            report = next_report.result()
+        except StopAsyncIteration:
+            break
+        next_report = None
+        if not batch:
+            deadline = loop.time() + max_wait
+        batch.append(report)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def astream_labels(reports, test_name=None, batch_size=BATCH_SIZE, max_pending=MAX_PENDING, \
+    max_wait=MAX_WAIT, classifier=None, train_batch=None):
+    '''
+    asyncio version of stream_labels; reports is an iterable or an async
+    iterable, and the micro batches are vectorized and classified in a
+    worker thread (at most max_pending of them in flight) while the event
+    loop keeps taking in reports
+    '''
+    batches = astream_label_batches(reports, test_name, batch_size, max_pending, max_wait, \
+        classifier, train_batch)
+    try:
+        async for labels in batches:
+            for report_id, label in labels:
+                yield report_id, label
+    finally:
+        # (stops the producer when the consumer stops early)
+        await batches.aclose()
+
+
+async def astream_label_batches(reports, test_name=None, batch_size=BATCH_SIZE, max_pending=MAX_PENDING, \
+    max_wait=MAX_WAIT, classifier=None, train_batch=None):
+    '''
+    asyncio version of stream_label_batches
+    '''
+    loop = asyncio.get_running_loop()
+    reader = concurrent.futures.ThreadPoolExecutor(1)
+    worker = concurrent.futures.ThreadPoolExecutor(1)
+    if classifier is None:
+        classifier = await loop.run_in_executor(worker, StreamClassifier, test_name, train_batch)
+    # futures of the classified micro batches, in input order
+    pending = asyncio.Queue(max_pending)
+
+    async def submit_batches():
+        try:
+            async for batch in amicro_batches(aiterate(reports, reader), batch_size, max_wait):
+                await pending.put(loop.run_in_executor(worker, classifier.classify_reports, batch))
+        except Exception as e:
+            failed = loop.create_future()
+            failed.set_exception(e)
+            await pending.put(failed)
+        await pending.put(None)
+
+    producer = asyncio.ensure_future(submit_batches())
+    try:
+        while True:
+            labels = await pending.get()
+            if labels is None:
+                return
+            yield list(await labels)
+    finally:
+        producer.cancel()
+        reader.shutdown(wait=False)
+        worker.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='classify a stream of reports as they arrive')
+    parser.add_argument('--input', default='-', help='tab delimited instances file; "-" for stdin')
+    parser.add_argument('--test', default=svm_pipeline.TEST_NAME)
+    parser.add_argument('--batch', default=svm_pipeline.TRAIN_BATCH, help='training batch of the models')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='reports per micro batch')
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING, help='micro batches queued between stages')
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT, \
+        help='seconds a partial micro batch waits for more reports')
+    parser.add_argument('--encoding', default=make_vectors.INSTANCES_ENCODING)
+    parser.add_argument('--output', help='write report id/label lines here instead of stdout')
+    parser.add_argument('--asyncio', action='store_true', help='run the asyncio version')
+    args = parser.parse_args()
+    handle = make_vectors.open_instances(args.input)
+    counts = {'malformed': 0}
+    reports = make_vectors.read_instances(handle, None, args.encoding, counts)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    begin = time.perf_counter()
+    written = {'reports': 0, 'first': 0.0}
+
+    def write_labels(labels):
+        for report_id, label in labels:
+            out.write(report_id + '\t' + label + '\n')
+        if labels and not written['reports']:
+            written['first'] = time.perf_counter() - begin
+        written['reports'] += len(labels)
+        # every micro batch (full or cut short by max_wait) is flushed, for the next stage of a live feed
+        out.flush()
+
+    if args.asyncio:
+        async def write_batches():
+            async for labels in astream_label_batches(reports, args.test, args.batch_size, \
+                args.max_pending, args.max_wait, train_batch=args.batch):
+                write_labels(labels)
+        asyncio.run(write_batches())
+    else:
+        for labels in stream_label_batches(reports, args.test, args.batch_size, args.max_pending, \
+            args.max_wait, train_batch=args.batch):
+            write_labels(labels)
+    print ('{} reports classified in {:.1f} seconds (first label after {:.2f} seconds), {} malformed rows skipped'.format(\
+        written['reports'], time.perf_counter() - begin, written['first'], counts['malformed']), file=sys.stderr)
@@ -6,25 +6,28 @@
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
 
+import argparse
 import os
 import warnings
-import vector_to_array
-import decoder
+from datetime import datetime
 import final_output
+import feature_store
+import profiling
 
 
 TEST_NAME = 'EGFR'
 TRAIN_BATCH = 'IR_10469'
 VECTOR_FILE = '{}{}{}{}'.format('Input', os.sep, TEST_NAME, '_feature_vectors.txt')
+# tests classified by a single invocation of run_all
+TEST_NAMES = ['EGFR', 'ALK']
 ALGORITHM_ORDER = [('reported','result'),('insufficient','result'),
     ('method','method'),('positive','result')]
 FINAL_OUTPUT_DIRECTORY = 'final_output'
+# not routed to an algorithm (in the disagreement report)
+NOT_ROUTED = '-'
 
-# initial output files for keyword rule based filter
-pos_inst = 'rule_based_reported' + os.sep + TEST_NAME + '_pos_instances.txt'
-neg_inst = 'rule_based_reported' + os.sep + TEST_NAME + '_neg_instances.txt'
-
-def run_pipeline():  
+def run_pipeline(test_name=None, vector_file=None, debug_files=False, vector_format='text', \
+    train_batches=None):
     '''
     pipeline for classification of EGFR and ALK test use, result, and method
      - reported will further classify the reports that passed through 
@@ -36,43 +39,387 @@ def run_pipeline():
      - insufficient will ascertain insuff vs unknown for the reports that 
          were labeled "not reported" by rule based and svm reported classifiers
      - final class labels will be output to the FINAL_OUTPUT_DIRECTORY 
+    test_name defaults to TEST_NAME and vector_file to its feature vectors in Input
+    (the feature store directory with vector_format "binary", see feature_store.py)
+    the feature vectors are read once and the instances are routed from one
+    algorithm to the next in memory; debug_files also writes the intermediate
+    sparse array and pos/neg instance files of each algorithm
+    train_batches (default TRAIN_BATCH) are the model sets to classify with;
+    with more than one, the instances are classified by all of them in one
+    pass (see run_cascades), each batch's labels are written to its own
+    sub directory of the FINAL_OUTPUT_DIRECTORY and the reports whose labels
+    differ from those of the first batch to <TEST>_disagreements.txt
     '''
-    # rule based keyword filter
-    with open(pos_inst, 'w') as pos_out:
-        with open(neg_inst, 'w') as neg_out:
-            for instances in open(VECTOR_FILE,'r').readlines():
-                vec = instances.strip().split('\t')
-                if 'NO_KEYWORD_IN_TEXT' in vec:
-                    neg_out.write(vec[0] + '\tNotReported\n')
-                else:
-                    pos_out.write(vec[0] + '\tReported\n')
-    
-    # loop through SVM classifiers; "positive" and "negative" instances
-    # will be written to algorithm specific directories s
-    # o they can be used by subsequent algorithms
-    for algorithm_tuple in ALGORITHM_ORDER:
-        algorithm = algorithm_tuple[0]
-        label = algorithm_tuple[1]
+    test_name = test_name or TEST_NAME
+    train_batches = train_batches or [TRAIN_BATCH]
+    if vector_file is None and vector_format == 'binary':
+        vector_file = feature_store.store_path(test_name, 'Input')
+    vector_file = vector_file or '{}{}{}{}'.format('Input', os.sep, test_name, '_feature_vectors.txt')
+    begin = datetime.today()
+    if feature_store.is_store(vector_file):
+        instances = feature_store.FeatureStore(vector_file)
+    else:
+        instances = read_feature_vectors(vector_file)
+    report_stage('feature vectors', len(instances), begin)
+
+    batch_labels = run_cascades(instances, test_name, train_batches, debug_files)
+
+    begin = datetime.today()
+    if len(train_batches) == 1:
+        final_output.write_final_labels(test_name, FINAL_OUTPUT_DIRECTORY, \
+            final_report_labels(report_ids(instances), batch_labels[train_batches[0]]))
+    else:
+        for train_batch in train_batches:
+            output_dir = FINAL_OUTPUT_DIRECTORY + os.sep + train_batch
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+            final_output.write_final_labels(test_name, output_dir, \
+                final_report_labels(report_ids(instances), batch_labels[train_batch]))
+        counts = write_disagreements(test_name, FINAL_OUTPUT_DIRECTORY, report_ids(instances), \
+            train_batches, batch_labels)
+        for train_batch in train_batches[1:]:
+            print ('{} vs {}: {reports} reports labeled differently, {final} with a different final label;'.format(\
+                train_batches[0], train_batch, **counts[train_batch]) + ''.join(' {}={}'.format(algorithm, \
+                counts[train_batch][algorithm]) for algorithm, label in ALGORITHM_ORDER))
+    report_stage('final output', len(instances), begin)
+
+
+def report_ids(instances):
+    '''
+    report ids of the instances (or feature store rows), in order
+    '''
+    if isinstance(instances, feature_store.FeatureStore):
+        return instances.report_ids
+    return [report_id for report_id, features in instances]
+
+
+def unique_report_ids(report_ids):
+    '''
+    report ids in order, each one only at its first occurrence
+    '''
+    seen = set()
+    for report_id in report_ids:
+        if report_id not in seen:
+            seen.add(report_id)
+            yield report_id
+
+
+def read_feature_vectors(vector_file):
+    '''
+    (report id, feature names) for each instance, in file order
+    (feature counts are skipped; all features are binary in the models)
+    '''
+    instances = []
+    with open(vector_file,'r') as f:
+        for lines in f:
+            vec = lines.strip().split('\t')
+            instances.append((vec[0], vec[1::2]))
+    return instances
 
-        model_file = algorithm + os.sep + TRAIN_BATCH + '.pkl' 
+
+def load_models(train_batch):
+    '''
+    model, feature count, feature mappings, and class map of each algorithm
+    in ALGORITHM_ORDER, so they can be loaded once and used for many batches
+    '''
+    # the classification stages (and scipy) are imported once they are needed
+    import decoder
+    import vector_to_array
+    models = {}
+    for algorithm, label in ALGORITHM_ORDER:
+        model_file = algorithm + os.sep + train_batch + '.pkl'
         num_features = int(open(algorithm + os.sep + 'num_features.txt', \
             'r').read().strip())
-        print ('starting model {} - {} features'.format(model_file, num_features))
-        # turn text feature vector into integer array
-        vector_to_array.main(TEST_NAME, algorithm, TRAIN_BATCH, VECTOR_FILE)
-        print ('vector written')
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            fxn()            
-            decoder.main(num_features, model_file, algorithm, TRAIN_BATCH, TEST_NAME, label)
-            print ('instances decoded')
-    final_output.output_final_class_labels(TEST_NAME, FINAL_OUTPUT_DIRECTORY)
-    
+            fxn()
+            clf = decoder.load_model(model_file)
+        models[algorithm] = {'model_file': model_file, 'clf': clf, 'num_features': num_features, \
+            'feature_mapping': vector_to_array.load_feature_mapping(algorithm, train_batch), \
+            'features': decoder.load_features(algorithm, train_batch), \
+            'class_map': decoder.load_class_map(label)}
+    return models
+
+
+def run_cascade(instances, test_name, train_batch, debug_files=False, models=None, verbose=True):
+    '''
+    rule based keyword filter followed by the SVM classifiers in
+    ALGORITHM_ORDER; each algorithm only classifies the instances routed
+    to it by the previous algorithms
+    instances are (report id, feature names) pairs or a feature store
+    models (see load_models) are loaded for train_batch unless given;
+    verbose prints the wall time and label counts of each stage
+    returns a dictionary of {report id: label} per algorithm
+    '''
+    return run_cascades(instances, test_name, [train_batch], debug_files, \
+        None if models is None else {train_batch: models}, verbose)[train_batch]
+
+
+def run_cascades(instances, test_name, train_batches, debug_files=False, models=None, verbose=True):
+    '''
+    run_cascade with several training batches (model sets) over the same
+    instances, e.g. to compare newly trained models with the production ones
+    the rule based filter is shared; at each algorithm the instances routed
+    to it by any of the batches are turned into one matrix per feature set,
+    which the model of every batch using that feature set scores (only the
+    rows its own cascade routed there); the instances are read once and, for
+    several batches, their feature names are turned into vocabulary ids once
+    (see feature_store.MemoryFeatureStore), so only the column mapping and
+    the scoring are repeated per model set
+    models is {train batch: load_models(train batch)} (loaded if not given);
+    debug_files is only for a single batch (the files are per algorithm)
+    returns {train batch: {algorithm: {report id: label}}}
+    '''
+    import decoder
+    import vector_to_array
+    if debug_files and len(train_batches) > 1:
+        raise ValueError('debug files can only be written for a single training batch')
+    models = dict(models or {})
+    for train_batch in train_batches:
+        if train_batch not in models:
+            models[train_batch] = load_models(train_batch)
+    # rule based keyword filter
+    begin = datetime.today()
+    rule_based = {}
+    store = isinstance(instances, feature_store.FeatureStore)
+    if not store and len(train_batches) > 1:
+        # feature names -> vocabulary ids once, rather than to the feature indices of every batch
+        instances = feature_store.MemoryFeatureStore(instances)
+        store = True
+    ids = report_ids(instances)
+    if store:
+        keyword_free = instances.has_feature('NO_KEYWORD_IN_TEXT')
+    else:
+        keyword_free = ['NO_KEYWORD_IN_TEXT' in features for report_id, features in instances]
+    for report_id, no_keyword in zip(ids, keyword_free):
+        if no_keyword:
+            rule_based[report_id] = 'NotReported'
+        else:
+            rule_based[report_id] = 'Reported'
+    if verbose:
+        report_stage('rule_based_reported', len(instances), begin, rule_based)
+    if debug_files:
+        write_instances('rule_based_reported', test_name, rule_based, set(['Reported']))
+    labels = dict((train_batch, {'rule_based_reported': rule_based}) for train_batch in train_batches)
+
+    # loop through SVM classifiers; "positive" and "negative" instances
+    # are kept per algorithm so they can be used by subsequent algorithms
+    for algorithm, label in ALGORITHM_ORDER:
+        begin = datetime.today()
+        batch_sets = dict((train_batch, batch_instances(algorithm, labels[train_batch])) \
+            for train_batch in train_batches)
+        # instances to classify by any batch (in vector file order)
+        rows = [i for i in range(len(ids)) if any(ids[i] in batch_set for batch_set in batch_sets.values())]
+        # positions (in rows) of the instances each batch classifies
+        positions = dict((train_batch, [p for p in range(len(rows)) if ids[rows[p]] in batch_set]) \
+            for train_batch, batch_set in batch_sets.items())
+        for group in feature_set_groups(models, train_batches, algorithm):
+            model = models[group[0]][algorithm]
+            if verbose:
+                for train_batch in group:
+                    print ('starting model {} - {} features'.format(models[train_batch][algorithm]['model_file'], \
+                        model['num_features']))
+            if store:
+                # vocabulary ids -> model columns; the matrix is built from the store
+                column_map = instances.column_map(model['feature_mapping'], model['features'])
+                if debug_files:
+                    vector_to_array.write_sparse_arrays(algorithm + os.sep + test_name + \
+                        '_sparse_arrays.txt', instances.sparse_arrays(rows, model['feature_mapping']))
+                make_batch = lambda start, end: instances.matrix(rows[start:end], column_map, \
+                    model['num_features'])
+            else:
+                # turn feature names into integer arrays
+                arrays = [(ids[i], vector_to_array.sparse_array(instances[i][1], \
+                    model['feature_mapping'])) for i in rows]
+                if debug_files:
+                    vector_to_array.write_sparse_arrays(algorithm + os.sep + test_name + \
+                        '_sparse_arrays.txt', arrays)
+                make_batch = lambda start, end: decoder.make_matrix([array for report_id, array \
+                    in arrays[start:end]], model['num_features'], model['features'])
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                fxn()
+                outputs = decoder.classify_shared(make_batch, len(rows), [(models[train_batch][algorithm]['clf'], \
+                    models[train_batch][algorithm]['class_map'], positions[train_batch]) for train_batch in group])
+            for train_batch, output in zip(group, outputs):
+                labels[train_batch][algorithm] = dict((ids[rows[p]], system_out) for p, system_out \
+                    in zip(positions[train_batch], output))
+        if verbose:
+            if len(train_batches) == 1:
+                report_stage(algorithm, len(rows), begin, labels[train_batches[0]][algorithm])
+            else:
+                report_stage(algorithm, len(rows), begin)
+                for train_batch in train_batches:
+                    print ('  {}: {} instances{}'.format(train_batch, len(positions[train_batch]), \
+                        format_label_counts(labels[train_batch][algorithm])))
+        if debug_files:
+            write_instances(algorithm, test_name, labels[train_batches[0]][algorithm], \
+                decoder.positive_labels(algorithm))
+    return labels
+
+
+def feature_set_groups(models, train_batches, algorithm):
+    '''
+    training batches grouped by the feature set (feature mapping, model
+    features and number of features) of their model for an algorithm;
+    batches in a group classify the same matrix
+    '''
+    groups = []
+    for train_batch in train_batches:
+        model = models[train_batch][algorithm]
+        for group in groups:
+            first = models[group[0]][algorithm]
+            if all(first[k] == model[k] for k in ['num_features', 'features', 'feature_mapping']):
+                group.append(train_batch)
+                break
+        else:
+            groups.append([train_batch])
+    return groups
+
+
+def batch_instances(algorithm, labels):
+    '''
+    report ids to classify with an algorithm, depending on the output
+    of the previous algorithms (see vector_to_array.main)
+    '''
+    import decoder
+    if algorithm == 'reported':
+        return set(k for k, v in labels['rule_based_reported'].items() if v == 'Reported')
+    elif algorithm == 'positive' or algorithm == 'method':
+        positive_hit = decoder.positive_labels('reported')
+        return set(k for k, v in labels['reported'].items() if v in positive_hit)
+    elif algorithm == 'insufficient':
+        ## combine rule based and svm 'reported' output
+        positive_hit = decoder.positive_labels('reported')
+        return set(k for k, v in labels['rule_based_reported'].items() if v == 'NotReported').union(\
+            set(k for k, v in labels['reported'].items() if v not in positive_hit))
+
+
+def final_report_labels(report_ids, labels):
+    '''
+    (report id, {algorithm: label}) for the insufficient, positive, and
+    method labels of every classified report, in vector file order; a
+    report id repeated in the vector file is only written once, at its
+    first occurrence (the labels are kept per report id)
+    '''
+    for report_id in unique_report_ids(report_ids):
+        algorithm_labels = dict((algorithm, labels[algorithm][report_id]) for algorithm \
+            in ['insufficient','positive','method'] if report_id in labels[algorithm])
+        if algorithm_labels:
+            yield report_id, algorithm_labels
+
+
+def disagreements(report_ids, train_batches, batch_labels):
+    '''
+    (report id, train batch, algorithm, baseline label, batch label, baseline
+    final label, batch final label) for each report and batch whose cascade
+    labels differ from those of the first (baseline) batch, at the first
+    algorithm in ALGORITHM_ORDER where they differ (NOT_ROUTED where one of
+    the cascades didn't route the report to that algorithm); a repeated
+    report id is only compared once, at its first occurrence
+    '''
+    baseline = train_batches[0]
+    final_labels = dict((train_batch, dict(final_report_labels(report_ids, batch_labels[train_batch]))) \
+        for train_batch in train_batches)
+    for report_id in unique_report_ids(report_ids):
+        for train_batch in train_batches[1:]:
+            for algorithm, label in ALGORITHM_ORDER:
+                before = batch_labels[baseline][algorithm].get(report_id, NOT_ROUTED)
+                after = batch_labels[train_batch][algorithm].get(report_id, NOT_ROUTED)
+                if before != after:
+                    yield report_id, train_batch, algorithm, before, after, \
+                        final_output.final_label(final_labels[baseline][report_id]), \
+                        final_output.final_label(final_labels[train_batch][report_id])
+                    break
+
+
+def write_disagreements(test_name, output_dir, report_ids, train_batches, batch_labels):
+    '''
+    tab delimited disagreement report (see disagreements), in vector file
+    order; returns the number of reports per batch that differ at all, that
+    get a different final label, and that first differ at each algorithm
+    '''
+    counts = dict((train_batch, dict([('reports', 0), ('final', 0)] + [(algorithm, 0) \
+        for algorithm, label in ALGORITHM_ORDER])) for train_batch in train_batches[1:])
+    with open(output_dir + os.sep + test_name + '_disagreements.txt', 'w') as out:
+        out.write('\t'.join(['report_id', 'train_batch', 'algorithm', train_batches[0], 'batch_label', \
+            train_batches[0] + '_final', 'batch_final']) + '\n')
+        for disagreement in disagreements(report_ids, train_batches, batch_labels):
+            report_id, train_batch, algorithm, before, after, final_before, final_after = disagreement
+            counts[train_batch]['reports'] += 1
+            counts[train_batch][algorithm] += 1
+            if final_before != final_after:
+                counts[train_batch]['final'] += 1
+            out.write('\t'.join(disagreement) + '\n')
+    return counts
+
+
+def write_instances(algorithm, test_name, stage_labels, positive_hit):
+    '''
+    debug output; the pos/neg instance files a stage used to pass to the next
+    '''
+    with open(algorithm + os.sep + test_name + '_pos_instances.txt','w') as pos_out:
+        with open(algorithm + os.sep + test_name + '_neg_instances.txt','w') as neg_out:
+            for report_id, system_out in stage_labels.items():
+                if system_out in positive_hit:
+                    pos_out.write(report_id + '\t' + system_out + '\n')
+                else:
+                    neg_out.write(report_id + '\t' + system_out + '\n')
+
+
+def report_stage(stage, num_instances, begin, stage_labels=None):
+    '''
+    print wall time and instance counts (per label) for a pipeline stage
+    '''
+    seconds = (datetime.today() - begin).total_seconds()
+    print ('{}: {} instances{} in {:.2f} seconds'.format(stage, num_instances, \
+        format_label_counts(stage_labels), seconds))
+    profiling.record_stage(stage, num_instances, seconds)
+
+
+def format_label_counts(stage_labels):
+    '''
+    " label=count" for each label of a stage
+    '''
+    label_counts = {}
+    for system_out in (stage_labels or {}).values():
+        label_counts[system_out] = label_counts.get(system_out, 0) + 1
+    return ''.join(' {}={}'.format(k, v) for k, v in sorted(label_counts.items()))
+
+
+def run_all(test_names=None, debug_files=False, vector_format='text', train_batches=None):
+    '''
+    classify every requested test (default TEST_NAMES) in one invocation;
+    the feature vectors for all of them come from a single pass of
+    make_vectors.py --tests (one <TEST>_feature_vectors.txt per test)
+    '''
+    for test_name in test_names or TEST_NAMES:
+        print ('classifying {}'.format(test_name))
+        run_pipeline(test_name, debug_files=debug_files, vector_format=vector_format, \
+            train_batches=train_batches)
+
 def fxn():
     '''
     silence ski-kit learn deprication warning
     '''
     warnings.warn("deprecated", DeprecationWarning)
-   
+
 if __name__ == "__main__":
-    run_pipeline()
+    parser = argparse.ArgumentParser(description='EGFR/ALK classification pipeline')
+    parser.add_argument('--tests', nargs='+', default=[TEST_NAME], help='tests to classify')
+    parser.add_argument('--debug-files', action='store_true', \
+        help='write the intermediate sparse array and pos/neg instance files')
+    parser.add_argument('--format', choices=['text', 'binary'], default='text', \
+        help='read Input/<TEST>_feature_vectors.txt or the binary feature store')
+    parser.add_argument('--batches', nargs='+', default=[TRAIN_BATCH], \
+        help='training batches (model sets) to classify with; the labels of the others are compared ' \
+        'against the first one')
+    parser.add_argument('--profile', help='write the stage timings to this json (or .csv) report')
+    args = parser.parse_args()
+    if args.debug_files and len(args.batches) > 1:
+        parser.error('--debug-files can only be used with a single training batch')
+    if args.profile:
+        profiling.enable()
+    run_all(args.tests, args.debug_files, args.format, args.batches)
+    if args.profile:
+        profiling.PROFILE.write(args.profile)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+'''author@esilgard'''
+#
+# Copyright (c) 2015-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+'''
+content addressed (sqlite) cache of feature vectors for make_vectors.py;
+the vector of a report for a test is keyed by a hash of the report text,
+the accession number, the test name and the vector creation settings
+(pattern resources, windows, pruning vocabulary), so reports that are
+unchanged since the last extract are not vectorized again, and duplicate
+reports within an extract are vectorized once
+the least recently used vectors are evicted when the cache grows past
+its size limit
+usage:
+    python make_vectors.py --cache Input/vector_cache.sqlite [--cache-max-mb 1024]
+    python vector_cache.py Input/vector_cache.sqlite
+'''
+import argparse
+import collections
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+# default size limit (bytes of compressed vectors)
+MAX_BYTES = 2 ** 30
+# vectors written between commits (and size checks)
+COMMIT_ROWS = 1000
+# part of every key; bump it when the vector creation code changes
+# in a way the settings don't capture (older vectors are then never hit)
+CACHE_VERSION = 1
+
+
+class VectorCache(object):
+    '''
+    lookup wraps the instance stream on its way to the vectorizer and
+    merge wraps the results coming back (in the same order); only the
+    tests whose vectors aren't cached (or already being computed for an
+    earlier duplicate) are passed on to be vectorized
+    '''
+    def __init__(self, path, settings, max_bytes=MAX_BYTES):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS vectors (key BLOB PRIMARY KEY, ' + \
+            'vector BLOB, path TEXT, size INTEGER, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors (last_used)')
+        self.connection.commit()
+        self.settings = hashlib.sha256(json.dumps([CACHE_VERSION, settings], \
+            sort_keys=True).encode('utf-8')).digest()
+        self.max_bytes = max_bytes
+        self.size = self.stored_bytes()
+        self.counts = {'hits': 0, 'misses': 0, 'duplicates': 0, 'bytes_read': 0, \
+            'bytes_written': 0, 'evicted': 0}
+        # vectors computed since the last commit, keys hit since the last commit
+        self.inserts = collections.OrderedDict()
+        self.used = set()
+        # per instance in flight: ('hit', (vector, path)), ('miss', key) or ('duplicate', key)
+        self.pending = collections.deque()
+        # key -> [(vector, path) once computed, number of instances still waiting for it]
+        self.in_flight = {}
+
+    def key(self, test_name, pathnum, text):
+        h = hashlib.sha256(self.settings)
+        for part in (test_name, pathnum, text):
+            part = part.encode('utf-8')
+            h.update(str(len(part)).encode('ascii') + b':' + part)
+        return h.digest()
+
+    def fetch(self, keys):
+        '''
+        (compressed vector, path) of the keys that are stored
+        '''
+        found = dict((key, (blob, path)) for key, blob, path in self.connection.execute(\
+            'SELECT key, vector, path FROM vectors WHERE key IN ({})'.format(','.join('?' * len(keys))), keys))
+        for key in keys:
+            if key in self.inserts:
+                found[key] = self.inserts[key]
+        return found
+
+    def lookup(self, instances, test_names):
+        '''
+        (report id, accession, text, tests to vectorize) for each
+        (report id, accession, text) instance; the text is dropped when
+        every test is cached
+        '''
+        for report_id, pathnum, text in instances:
+            keys = [self.key(test_name, pathnum, text) for test_name in test_names]
+            found = self.fetch(keys)
+            sources = []
+            missing = []
+            for test_name, key in zip(test_names, keys):
+                if key in found:
+                    blob, path = found[key]
+                    sources.append(('hit', (json.loads(zlib.decompress(blob).decode('utf-8')), path)))
+                    self.used.add(key)
+                    self.counts['hits'] += 1
+                    self.counts['bytes_read'] += len(blob)
+                elif key in self.in_flight:
+                    self.in_flight[key][1] += 1
+                    sources.append(('duplicate', key))
+                    self.counts['duplicates'] += 1
+                else:
+                    self.in_flight[key] = [None, 1]
+                    sources.append(('miss', key))
+                    missing.append(test_name)
+                    self.counts['misses'] += 1
+            self.pending.append(sources)
+            yield report_id, pathnum, text if missing else '', tuple(missing)
+
+    def merge(self, results):
+        '''
+        (report id, [(vector, path) per test]) for each vectorized
+        instance; computed vectors are stored
+        '''
+        for report_id, computed in results:
+            computed = iter(computed)
+            test_results = []
+            for kind, value in self.pending.popleft():
+                if kind == 'hit':
+                    test_results.append(value)
+                    continue
+                entry = self.in_flight[value]
+                if kind == 'miss':
+                    entry[0] = next(computed)
+                    self.store(value, entry[0])
+                test_results.append(entry[0])
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.in_flight[value]
+            yield report_id, test_results
+            if len(self.inserts) >= COMMIT_ROWS:
+                self.commit()
+
+    def store(self, key, result):
+        vector, path = result
+        blob = zlib.compress(json.dumps(vector, separators=(',', ':')).encode('utf-8'))
+        self.inserts[key] = (blob, path)
+        self.counts['bytes_written'] += len(blob)
+
+    def commit(self):
+        '''
+        write the computed vectors, mark the hits as used and evict
+        the least recently used vectors if the cache is too big
+        '''
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?, ?)', \
+                ((key, blob, path, len(blob), now) for key, (blob, path) in self.inserts.items()))
+            self.connection.executemany('UPDATE vectors SET last_used = ? WHERE key = ?', \
+                ((now, key) for key in self.used))
+        self.size += sum(len(blob) for blob, path in self.inserts.values())
+        self.inserts = collections.OrderedDict()
+        self.used = set()
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        delete the least recently used vectors until the cache is within max_bytes
+        '''
+        self.size = self.stored_bytes()
+        excess = self.size - self.max_bytes
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM vectors ORDER BY last_used'):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self.size -= size
+        with self.connection:
+            self.connection.executemany('DELETE FROM vectors WHERE key = ?', evicted)
+        self.counts['evicted'] += len(evicted)
+
+    def stored_bytes(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM vectors').fetchone()[0]
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def summary(self):
+        return ('cache: {hits} hits, {misses} misses, {duplicates} duplicates computed once, ' + \
+            '{bytes_read} bytes read, {bytes_written} bytes written, {evicted} vectors evicted, ' + \
+            '{size} bytes cached').format(size=self.size, **self.counts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='size of a feature vector cache')
+    parser.add_argument('cache')
+    args = parser.parse_args()
+    connection = sqlite3.connect(args.cache)
+    entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM vectors').fetchone()
+    print ('{}: {} vectors, {} bytes'.format(args.cache, entries, size))
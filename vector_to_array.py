@@ -7,18 +7,46 @@
 #
 
 import os
+import feature_store
 
-def vector_to_array(sparse_array, feature_d, batch_set, input_vector_file):    
-    with open(sparse_array,'w') as out:
+def sparse_array(features, feature_d):
+    '''
+    feature indices (in the training batch feature set) for a list of feature names
+    '''
+    return [feature_d[f] for f in features if f in feature_d]
+
+def load_feature_mapping(algorithm, train_batch):
+    '''
+    feature name -> feature index for the training batch feature set
+    '''
+    feature_mapping_file = algorithm + os.sep + train_batch + '_features_mapping.txt'
+    return dict((a.split('\t')[0],a.strip().split('\t')[1]) for a in \
+        open(feature_mapping_file,'r').readlines())
+
+def write_sparse_arrays(sparse_array_file, arrays):
+    '''
+    one line per (report id, feature indices), space delimited
+    '''
+    with open(sparse_array_file,'w') as out:
+        for report_id, array in arrays:
+            out.write(report_id + ''.join(' ' + index for index in array) + '\n')
+
+def vector_to_array(sparse_array_file, feature_d, batch_set, input_vector_file):    
+    if feature_store.is_store(input_vector_file):
+        # binary feature vectors (see feature_store.py); no text to split
+        store = feature_store.FeatureStore(input_vector_file)
+        rows = [i for i in range(len(store)) if store.report_ids[i] in batch_set]
+        write_sparse_arrays(sparse_array_file, store.sparse_arrays(rows, feature_d))
+        return
+    with open(sparse_array_file,'w') as out:
         with open(input_vector_file,'r') as f:   
             for lines in f:                
                 l=lines.strip().split('\t')
                 if l[0].split('\t')[0] in batch_set:
                     out.write(l[0])
                     #sparse vector for binary features (skip over feature counts)
-                    for f in range(1,len(l),2):                           
-                        if l[f] in feature_d:
-                            out.write(' '+feature_d[l[f]])
+                    for index in sparse_array(l[1::2], feature_d):
+                        out.write(' '+index)
                     out.write('\n')
 
 def main(test_name, algorithm, train_batch, input_vector_file):
@@ -42,9 +70,7 @@ def main(test_name, algorithm, train_batch, input_vector_file):
     
     ## make smaller sparse array file from feature vectors
     array_file = algorithm + os.sep + test_name + '_sparse_arrays.txt'
-    feature_mapping_file = algorithm + os.sep + train_batch + '_features_mapping.txt'
-    feature_d = dict((a.split('\t')[0],a.strip().split('\t')[1]) for a in \
-        open(feature_mapping_file,'r').readlines())
+    feature_d = load_feature_mapping(algorithm, train_batch)
     vector_to_array(array_file, feature_d, batch_set, input_vector_file)
 
     return len(feature_d)